@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Extracts every MHLW report between two dates, to rebuild the 'Recoveries' and
+'Sum By Day' history after the extraction has been broken for a while.
+
+Reports are fetched and extracted in a process pool. Each complete report is
+appended to a checkpoint file, so an interrupted backfill picks up where it
+left off. Reports with missing values are extracted again on the next run. The results are written as one row per report date to CSV (or
+Parquet if the output ends in .parquet) and optionally to the spreadsheet, at
+the rows and columns of their dates (see writeReports).
+
+Run:
+python3 mhlw.py --backfill 2020-05-01..2020-05-31 --backfillOutput may.csv
+"""
+
+import os
+import re
+import json
+import datetime
+import unicodedata
+import concurrent.futures
+import multiprocessing
+
+import mhlw
+import sheets
+
+# Row 1 of Recoveries holds the dates of the columns, from column C.
+RECOVERIES_HEADER_RANGE = "'Recoveries'!1:1"
+
+reiwaDatePattern = re.compile(r'令和([0-9]+|元)年([0-9]+)月([0-9]+)日')
+
+
+def parseDateRange(dateRange):
+    """
+    Parses FROM..TO where both are YYYY-MM-DD.
+
+    @returns (from, to) as datetime.date
+    """
+    parts = dateRange.split('..')
+    if len(parts) != 2:
+        raise ValueError('Expected FROM..TO, got %s' % dateRange)
+    return tuple([datetime.datetime.strptime(p, '%Y-%m-%d').date() for p in parts])
+
+
+def parseLinkDate(text):
+    """
+    Returns the date in a report link such as （令和2年5月10日版）, or None.
+    """
+    match = reiwaDatePattern.search(unicodedata.normalize('NFKC', text))
+    if not match:
+        return None
+    year = 1 if match.group(1) == '元' else int(match.group(1))
+    return datetime.date(2018 + year, int(match.group(2)), int(match.group(3)))
+
+
+def extractReport(reportUrl, force=False):
+    """
+    Fetches and extracts a single report. Runs in a worker process.
+    """
+    reportSoup = mhlw.getReportFromUrl(reportUrl)
+    reportDate = mhlw.getReportDate(reportSoup)
+    summaryValues = {}
+
+    pdfData = mhlw.getPdfData(reportSoup)
+    prefectures = None
+    if pdfData:
+        frame, summaryValues['prefectureCasesRecoveries'] = mhlw.extractCasesRecoveryNumbersFromData(
+            pdfData, force=force)
+        prefectures = frameColumns(frame)
+
+    summaryTableUrl = mhlw.getSummaryTable(reportSoup)
+    if summaryTableUrl:
+        summaryValues.update(mhlw.extractDailySummary(
+            mhlw.absoluteUrl(reportUrl, summaryTableUrl), False, force=force))
+
+    return {'url': reportUrl, 'date': reportDate, 'values': summaryValues, 'prefectures': prefectures}
+
+
+def frameColumns(frame):
+    """
+    Returns the columns of the typed prefecture frame as lists, with None for
+    missing numbers, so that the report can be saved as JSON.
+    """
+    import pandas as pd
+    return dict([(column, [None if value is pd.NA else value for value in frame[column].tolist()])
+                 for column in frame.columns])
+
+
+def prefectureFrame(report):
+    """
+    Returns the typed prefecture frame of a report. Checkpoints written before
+    the frame was saved only have the strings, which are converted again.
+    """
+    import pandas as pd
+    if report.get('prefectures'):
+        frame = pd.DataFrame(report['prefectures'])
+        for column in ('recovery', 'cases'):
+            frame[column] = frame[column].astype('Int64')
+        return frame
+    return mhlw.casesRecoveryFrame(
+        [tuple(v) for v in report['values'].get('prefectureCasesRecoveries', [])])
+
+
+def isCompleteReport(report):
+    """
+    Returns True if the report has all prefectures and every summary value.
+    """
+    values = report.get('values', {})
+    return bool(report.get('date') and
+                len(values.get('prefectureCasesRecoveries') or []) == mhlw.PREFECTURE_COUNT and
+                not mhlw.missingSummaryKeys(values))
+
+
+def readCheckpoint(checkpoint):
+    reports = {}
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                if line.strip():
+                    report = json.loads(line)
+                    reports[report['url']] = report
+    return reports
+
+
+def checkpointedReports(checkpoint, force=False):
+    """
+    Returns the complete reports of the checkpoint by URL, or none if force is
+    set so that everything is extracted again.
+    """
+    if force:
+        return {}
+    return dict([(url, report) for url, report in readCheckpoint(checkpoint).items()
+                 if isCompleteReport(report)])
+
+
+def toFrame(reports):
+    import pandas as pd
+
+    rows = []
+    for report in reports:
+        values = report['values']
+        row = {'date': report['date'], 'url': report['url']}
+        for key in mhlw.SUMMARY_KEYS:
+            row[key] = values.get(key)
+        prefectures = prefectureFrame(report)
+        for prefecture, recovery, cases in zip(
+                prefectures['prefecture'], prefectures['recovery'], prefectures['cases']):
+            row['%s recovery' % prefecture] = None if pd.isna(recovery) else int(recovery)
+            row['%s cases' % prefecture] = None if pd.isna(cases) else int(cases)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def backfill(indexUrl, dateRange, output='backfill.csv', checkpoint=None, workers=2,
+             writeResults=False, force=False):
+    fromDate, toDate = parseDateRange(dateRange)
+
+    # Reports whose link text has no date are kept and filtered after extraction.
+    reportUrls = []
+    for url, text in mhlw.getCovidReportLinks(indexUrl):
+        linkDate = parseLinkDate(text)
+        if not linkDate or fromDate <= linkDate <= toDate:
+            if url not in reportUrls:
+                reportUrls.append(url)
+
+    reports = checkpointedReports(checkpoint, force)
+    pending = [url for url in reportUrls if url not in reports]
+    print('Backfilling %d reports (%d already done)' % (len(pending), len(reportUrls) - len(pending)))
+
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = dict([(pool.submit(extractReport, url, force), url) for url in pending])
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    report = future.result()
+                except Exception as e:
+                    print('Failed to extract %s: %s' % (futures[future], e))
+                    continue
+                print('Extracted %s %s' % (report['date'], report['url']))
+                reports[report['url']] = report
+                if not isCompleteReport(report):
+                    print('Not checkpointing incomplete report %s' % report['url'])
+                elif checkpoint:
+                    with open(checkpoint, 'a') as f:
+                        f.write(json.dumps(report) + '\n')
+
+    inRange = []
+    for url in reportUrls:
+        report = reports.get(url)
+        if report and report['date'] and fromDate.isoformat() <= report['date'][:10] <= toDate.isoformat():
+            inRange.append(report)
+    inRange.sort(key=lambda r: r['date'])
+
+    frame = toFrame(inRange)
+    if output.endswith('.parquet'):
+        frame.to_parquet(output, index=False)
+    else:
+        frame.to_csv(output, index=False)
+    print('Wrote %d reports to %s' % (len(inRange), output))
+
+    if writeResults:
+        print(writeReports(inRange))
+
+    return inRange
+
+
+def columnLetters(index):
+    """
+    Returns the A1 letters of the 0-based column index.
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def planDateInserts(plan, sheetId, dimension, existing, dates, offset, gridSize, descending=False):
+    """
+    Adds the structural requests that make room for the dates that are not in
+    existing, keeping the dates sorted. existing are the dates in the sheet, in
+    order from grid index offset. Dates that fall between existing ones get an
+    inserted row or column, dates after the last one use the empty cells after
+    it, growing the grid if needed.
+
+    @returns dict of date to its grid index once the requests have run.
+    """
+    if existing != sorted(set(existing), reverse=descending):
+        raise ValueError('Dates from index %d are not sorted: %s' % (offset, existing))
+    known = set(existing)
+    merged = sorted(known | set(dates), reverse=descending)
+    lastExisting = merged.index(existing[-1]) if existing else -1
+
+    inserted = 0
+    for i in range(len(merged)):
+        if merged[i] in known or i > lastExisting:
+            continue
+        # Ascending order, everything before index i is already in place.
+        plan.addRequest({
+            'insertDimension': {
+                'range': {
+                    'sheetId': sheetId,
+                    'dimension': dimension,
+                    'startIndex': offset + i,
+                    'endIndex': offset + i + 1
+                },
+                'inheritFromBefore': True
+            }
+        })
+        inserted += 1
+
+    missing = offset + len(merged) - (gridSize + inserted)
+    if missing > 0:
+        plan.addRequest({
+            'appendDimension': {
+                'sheetId': sheetId,
+                'dimension': dimension,
+                'length': missing
+            }
+        })
+    return dict([(merged[i], offset + i) for i in range(len(merged))])
+
+
+def sumByDayRow(values):
+    """
+    @returns the recoveries, deaths, critical and pcr cells of a Sum By Day
+        row, or None if one of them is missing.
+    """
+    row = [values.get('recoveries'), values.get('deaths'), values.get('critical'), values.get('pcr')]
+    if not all(row):
+        return None
+    return row
+
+
+def recoveriesColumn(report):
+    """
+    @returns the rows 2-50 of a Recoveries column: the prefectures, port
+        quarantine and 8 for "Unspecified".
+    """
+    values = report['values']
+    mhlw.checkPrefectureValues(values)
+    frame = prefectureFrame(report)
+    column = [[''] if recovery is None else [recovery] for recovery in frameColumns(frame)['recovery']]
+    column.append([values['portRecoveries']])
+    column.append([8])
+    return column
+
+
+def writeReports(reports):
+    """
+    Writes reports for past dates to the 'Sum By Day' rows and 'Recoveries'
+    columns of their dates, updating the ones that exist and inserting the
+    others in date order. 'Prefecture Data' holds the latest totals and is left
+    alone.
+
+    Everything is done with one batched read, at most one structural
+    batchUpdate and one values batchUpdate.
+
+    @returns the SheetWritePlan result, with the dates skipped per tab.
+    """
+    sheet = sheets.getSpreadsheet()
+    plan = mhlw.SheetWritePlan(sheet)
+    current = plan.read([mhlw.SUM_BY_DAY_RANGE, RECOVERIES_HEADER_RANGE])
+
+    # The last report of a date wins.
+    byDate = dict([(report['date'][:10], report) for report in reports if report['date']])
+    skipped = {'Sum By Day': [], 'Recoveries': []}
+
+    sumByDay = {}
+    for date in sorted(byDate):
+        row = sumByDayRow(byDate[date]['values'])
+        if row:
+            sumByDay[date] = row
+        else:
+            skipped['Sum By Day'].append(date)
+
+    recoveries = {}
+    for date in sorted(byDate):
+        try:
+            recoveries[date] = recoveriesColumn(byDate[date])
+        except (ValueError, KeyError) as e:
+            print('Not writing Recoveries for %s: %s' % (date, e))
+            skipped['Recoveries'].append(date)
+
+    if sumByDay:
+        currentRows = current.get(mhlw.SUM_BY_DAY_RANGE, [])
+        properties = plan.requireTabProperties('Sum By Day')
+        # Row 1 is the header.
+        rowIndexes = planDateInserts(
+            plan, properties['sheetId'], 'ROWS', [row[0] if row else '' for row in currentRows],
+            list(sumByDay), 1, properties['gridProperties']['rowCount'])
+        existing = dict([(row[0], row) for row in currentRows if row])
+        for date in sorted(sumByDay):
+            rowNumber = rowIndexes[date] + 1
+            if date not in existing:
+                plan.update("'Sum By Day'!A%d:F%d" % (rowNumber, rowNumber), [[date, ''] + sumByDay[date]])
+            elif ([mhlw.normalizeCellValue(v) for v in (existing[date] + [''] * 6)[2:6]] !=
+                  [mhlw.normalizeCellValue(v) for v in sumByDay[date]]):
+                plan.update("'Sum By Day'!C%d:F%d" % (rowNumber, rowNumber), [sumByDay[date]])
+
+    if recoveries:
+        headerRows = current.get(RECOVERIES_HEADER_RANGE, [])
+        properties = plan.requireTabProperties('Recoveries')
+        # Columns A and B are the prefecture names and totals, newest date first.
+        columnIndexes = planDateInserts(
+            plan, properties['sheetId'], 'COLUMNS', headerRows[0][2:] if headerRows else [],
+            list(recoveries), 2, properties['gridProperties']['columnCount'], descending=True)
+        for date in sorted(recoveries):
+            column = columnLetters(columnIndexes[date])
+            plan.update("'Recoveries'!%s1:%s50" % (column, column), [[date]] + recoveries[date])
+
+    result = plan.execute()
+    result['skipped'] = skipped
+    print('Wrote %d reports with %d API calls' % (len(byDate), plan.apiCalls))
+    return result
@@ -0,0 +1,531 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the extraction code, using the fixtures in test/.
+
+The PDF and index page fixtures are generated (test/make_prefecture_pdf.py and
+test/make_index_page.py); saved MHLW files can be passed instead.
+
+Run:
+python3 benchmark.py ocr
+python3 benchmark.py pdf saved/*.pdf
+python3 benchmark.py importtime --budget-ms 800
+python3 benchmark.py index saved/index.html
+python3 benchmark.py image
+python3 benchmark.py suite
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import resource
+import subprocess
+import argparse
+import time
+import datetime
+import platform
+import collections
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+SUMMARY_IMAGES = [
+    os.path.join(FIXTURE_DIR, 'mhlw.png'),
+    os.path.join(FIXTURE_DIR, '000780658.png'),
+]
+PREFECTURE_PDFS = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.pdf')))
+INDEX_PAGES = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def timeRepeated(fn, repeat):
+    """
+    Calls fn repeat times and returns (last result, list of seconds per call).
+    """
+    timings = []
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def printTimings(name, timings):
+    timings = sorted(timings)
+    print('%-40s min %8.2fms  median %8.2fms  max %8.2fms' % (
+        name, timings[0] * 1000, timings[len(timings) // 2] * 1000, timings[-1] * 1000))
+
+
+def benchmarkOcr(args):
+    import mhlw
+    import ocr
+
+    engines = []
+    for backend in args.backends:
+        try:
+            engines.append(ocr.getEngine(backend))
+        except ImportError as e:
+            print('Skipping %s: %s' % (backend, e))
+
+    for imagePath in args.images:
+        with open(imagePath, 'rb') as f:
+            image = mhlw.loadSummaryImage(f)
+        subImages = mhlw.extractImageAreas(image, image.size)
+        crops = [crop for key in subImages for crop in subImages[key]]
+        print('%s: %d crops' % (os.path.basename(imagePath), len(crops)))
+
+        texts = {}
+        for engine in engines:
+            # First call initialises the engine and is not counted.
+            engine.recognize(crops[0])
+            result, timings = timeRepeated(
+                lambda: [engine.recognize(crop).strip() for crop in crops], args.repeat)
+            texts[engine.name] = result
+            printTimings('  %s' % engine.name, timings)
+
+        if len(set([tuple(t) for t in texts.values()])) > 1:
+            print('  Results differ:')
+            for name in texts:
+                print('    %s: %s' % (name, texts[name]))
+
+
+def benchmarkPdf(args):
+    """
+    Times the text layer and camelot extractors on saved MHLW PDFs and checks
+    that both return the same values.
+    """
+    import mhlw
+    import pdf_text
+
+    if not args.pdfs:
+        print('No PDFs given and none found in %s' % FIXTURE_DIR)
+        return 1
+
+    mismatches = 0
+    for pdfPath in args.pdfs:
+        print(os.path.basename(pdfPath))
+        textValues, timings = timeRepeated(
+            lambda: pdf_text.extractCasesRecoveryNumbers(pdfPath), args.repeat)
+        printTimings('  text', timings)
+        camelotValues, timings = timeRepeated(
+            lambda: mhlw.readCasesRecoveryNumbersWithCamelot(pdfPath)[1], args.repeat)
+        printTimings('  camelot', timings)
+
+        if textValues != camelotValues:
+            mismatches += 1
+            print('  Results differ:')
+            for i in range(max(len(textValues), len(camelotValues))):
+                textRow = textValues[i] if i < len(textValues) else None
+                camelotRow = camelotValues[i] if i < len(camelotValues) else None
+                if textRow != camelotRow:
+                    print('    text %s camelot %s' % (textRow, camelotRow))
+
+    return 1 if mismatches else 0
+
+
+def benchmarkIndex(args):
+    """
+    Compares finding the report links with a full BeautifulSoup parse and with
+    the anchor-only scanner on saved copies of the index page.
+    """
+    import mhlw
+    from bs4 import BeautifulSoup
+
+    def fullParse(contents):
+        soup = BeautifulSoup(contents, features='html.parser')
+        for link in soup.find_all('a'):
+            if link and link.text and mhlw.covidReportPattern.search(link.text):
+                return mhlw.absoluteUrl(mhlw.DEFAULT_MHLW_INDEX_URL, link['href'])
+        return None
+
+    def scanFirst(contents):
+        reports = mhlw.findCovidReportLinks(contents, mhlw.DEFAULT_MHLW_INDEX_URL, first=True)
+        return reports[0][0] if reports else None
+
+    def scanAll(contents):
+        return mhlw.findCovidReportLinks(contents, mhlw.DEFAULT_MHLW_INDEX_URL)
+
+    if not args.pages:
+        print('No index pages given and none found in %s' % FIXTURE_DIR)
+        return 1
+
+    mismatches = 0
+    for path in args.pages:
+        with open(path, 'rb') as f:
+            contents = f.read()
+        print('%s: %d bytes' % (os.path.basename(path), len(contents)))
+        expected, timings = timeRepeated(lambda: fullParse(contents), args.repeat)
+        printTimings('  BeautifulSoup find_all', timings)
+        first, timings = timeRepeated(lambda: scanFirst(contents), args.repeat)
+        printTimings('  scan first link', timings)
+        links, timings = timeRepeated(lambda: scanAll(contents), args.repeat)
+        printTimings('  scan all links (%d)' % len(links), timings)
+        if expected != first:
+            mismatches += 1
+            print('  Results differ: %s %s' % (expected, first))
+
+    return 1 if mismatches else 0
+
+
+def legacyLoadSummaryImage(imageFile):
+    """
+    loadSummaryImage before it worked in grayscale, kept to compare memory use.
+    """
+    from PIL import Image
+    image = Image.open(imageFile).convert(mode='RGBA')
+    white = Image.new('RGBA', image.size, color='#ffffff')
+    mergedImage = Image.alpha_composite(white, image)
+    mergedImage = mergedImage.resize((661, 181))
+    return mergedImage.convert(mode='L')
+
+
+def maxRssKb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measureImageVariant(args):
+    """
+    Runs in a subprocess so that peak RSS only covers one variant.
+    """
+    import io
+    import mhlw
+
+    load = legacyLoadSummaryImage if args.variant == 'legacy' else mhlw.loadSummaryImage
+    with open(args.image, 'rb') as f:
+        imageData = f.read()
+    # Import PIL and load once so that only the per-image memory is counted.
+    image = load(io.BytesIO(imageData))
+    baseline = maxRssKb()
+    image, timings = timeRepeated(lambda: load(io.BytesIO(imageData)), args.repeat)
+    print(json.dumps({'timings': timings, 'peakRssKb': maxRssKb() - baseline,
+                      'pixels': list(image.getdata())}))
+    return 0
+
+
+def benchmarkImage(args):
+    """
+    Compares time and peak memory of the legacy and current summary image
+    preprocessing, each in a fresh process.
+    """
+    for imagePath in args.images:
+        print(os.path.basename(imagePath))
+        pixels = {}
+        for variant in ('legacy', 'current'):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'image-variant', variant, imagePath,
+                 '--repeat', str(args.repeat)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            printTimings('  %s (peak +%d KB)' % (variant, result['peakRssKb']), result['timings'])
+            pixels[variant] = result['pixels']
+        difference = max([abs(a - b) for a, b in zip(pixels['legacy'], pixels['current'])])
+        print('  max pixel difference: %d' % difference)
+    return 0
+
+
+def benchmarkImportTime(args):
+    """
+    Measures the cold import of a module with python -X importtime and fails if
+    it takes longer than the budget. Only the import of the module (and what it
+    imports) counts, not the modules loaded by interpreter startup.
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % args.module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+    # import time: self [us] | cumulative | imported package
+    imports = []
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3))))
+    if not imports:
+        print(output)
+        return 1
+
+    # Top level imports are the ones with the least indentation.
+    topLevel = min([i[3] for i in imports])
+    print('%-40s %10s %10s' % ('module', 'self ms', 'total ms'))
+    for name, selfTime, cumulative, depth in sorted(imports, key=lambda i: -i[2])[:args.top]:
+        print('%-40s %10.1f %10.1f' % (name, selfTime / 1000, cumulative / 1000))
+
+    modules = [i for i in imports if i[3] == topLevel and i[0] == args.module]
+    if not modules:
+        print('No import of %s in:\n%s' % (args.module, output))
+        return 1
+    total = modules[0][2] / 1000
+    startup = sum([i[2] for i in imports if i[3] == topLevel and i[0] != args.module]) / 1000
+    print('Interpreter startup imports: %.1fms (not counted)' % startup)
+    print('Cold import of %s: %.1fms (budget %.1fms)' % (args.module, total, args.budget_ms))
+    return 1 if total > args.budget_ms else 0
+
+
+def suiteDailySummary(args):
+    import mhlw
+    import ocr
+
+    images = []
+    for imagePath in SUMMARY_IMAGES:
+        with open(imagePath, 'rb') as f:
+            images.append(f.read())
+    # Initialises the OCR engine and caches the table layout, as in a running service.
+    mhlw.extractDailySummaryFromData(images[0], False, force=True)
+
+    def run():
+        ocr.clearCache()
+        return [mhlw.extractDailySummaryFromData(data, False, force=True) for data in images]
+    return timeRepeated(run, args.repeat)[1], None
+
+
+def suiteImageAreas(args):
+    import mhlw
+
+    images = []
+    for imagePath in SUMMARY_IMAGES:
+        with open(imagePath, 'rb') as f:
+            images.append(mhlw.loadSummaryImage(f))
+    # As in readDailySummary: line detection on every call, cells cached per layout.
+    return timeRepeated(lambda: [mhlw.locateImageAreas(image) for image in images],
+                        args.repeat * 20)[1], None
+
+
+def suitePdf(args):
+    import mhlw
+
+    if not args.pdfs:
+        return None
+    return timeRepeated(lambda: [mhlw.extractCasesRecoveryNumbers(pdfPath, force=True)
+                                 for pdfPath in args.pdfs], args.repeat)[1], None
+
+
+def suiteLinks(args):
+    import mhlw
+
+    if not args.pages:
+        return None
+    urls = ['file://' + os.path.abspath(path) for path in args.pages]
+    return timeRepeated(lambda: [mhlw.getLatestCovidReport(url) for url in urls],
+                        args.repeat * 10)[1], None
+
+
+def timeFakeSheets(args, write):
+    """
+    Calls write() against a freshly seeded fake spreadsheet per repeat.
+
+    @returns (timings, API calls per method of the last repeat)
+    """
+    import fake_sheets
+
+    timings = []
+    calls = {}
+    for i in range(args.repeat):
+        fake = fake_sheets.FakeSpreadsheet(latency=args.latency)
+        fake_sheets.install(fake)
+        start = time.perf_counter()
+        write()
+        timings.append(time.perf_counter() - start)
+        calls = dict(fake.callCounts)
+    return timings, calls
+
+
+def suiteWritePatients(args):
+    import sync_patients
+
+    prefectures = ['Tokyo', 'Osaka', 'Gifu', 'Okinawa', 'Hokkaido']
+
+    def write():
+        # Appends a count row per prefecture and day, then updates each of them.
+        for cases in (3, 5):
+            for day in range(1, 5):
+                for prefecture in prefectures:
+                    sync_patients.writePatients(prefecture, '2020-05-%02d' % day, cases + day, 0, 'benchmark')
+    return timeFakeSheets(args, write)
+
+
+def suiteWriteValues(args):
+    import mhlw
+    import sync_patients
+
+    prefectures = [p for p in sorted(sync_patients.PREFECTURE_PREFIX) if p != 'Port Quarantine']
+    values = {
+        'pcr': 1000, 'critical': 20, 'recoveries': 300, 'deaths': 40, 'portRecoveries': 50,
+        'prefectureCasesRecoveries': [(p, str(10 + i), str(20 + i)) for i, p in enumerate(prefectures)],
+    }
+    return timeFakeSheets(args, lambda: mhlw.writeValues('2020-05-01', values))
+
+
+SUITE_CASES = collections.OrderedDict([
+    ('daily-summary', suiteDailySummary),
+    ('image-areas', suiteImageAreas),
+    ('pdf', suitePdf),
+    ('links', suiteLinks),
+    ('write-patients', suiteWritePatients),
+    ('write-values', suiteWriteValues),
+])
+
+
+def measureSuiteCase(args):
+    """
+    Runs in a subprocess so that peak RSS only covers one case.
+    """
+    result = SUITE_CASES[args.case](args)
+    if result is None:
+        print(json.dumps(None))
+        return 0
+    timings, calls = result
+    timings = sorted(timings)
+    print(json.dumps({
+        'wallSeconds': timings[len(timings) // 2],
+        'peakRssKb': maxRssKb(),
+        'apiCalls': sum(calls.values()) if calls is not None else None,
+        'calls': calls,
+    }))
+    return 0
+
+
+def compareToBaseline(name, result, baseline, args):
+    """
+    @returns list of the regressions of result against baseline.
+    """
+    regressions = []
+    # Differences of a few milliseconds are noise, whatever the fraction.
+    allowed = max(baseline['wallSeconds'] * args.threshold, args.min_delta_ms / 1000.0)
+    if result['wallSeconds'] > baseline['wallSeconds'] + allowed:
+        regressions.append('%s wall time %.1fms > %.1fms' % (
+            name, result['wallSeconds'] * 1000, baseline['wallSeconds'] * 1000))
+    if result['peakRssKb'] > baseline['peakRssKb'] * (1 + args.rss_threshold):
+        regressions.append('%s peak RSS %dKB > %dKB' % (name, result['peakRssKb'], baseline['peakRssKb']))
+    if baseline.get('apiCalls') is not None and result['apiCalls'] > baseline['apiCalls']:
+        regressions.append('%s API calls %d > %d' % (name, result['apiCalls'], baseline['apiCalls']))
+    return regressions
+
+
+def benchmarkSuite(args):
+    """
+    Runs every case in its own process, compares wall time, peak RSS and API
+    calls to the baseline and fails on regressions past the thresholds.
+    """
+    unknown = [name for name in args.cases if name not in SUITE_CASES]
+    if unknown:
+        print('Unknown cases %s, choose from %s' % (', '.join(unknown), ', '.join(SUITE_CASES)))
+        return 2
+
+    env = dict(os.environ)
+    # Measure the extraction itself, not the disk caches.
+    env['EXTRACTION_CACHE_DIR'] = ''
+    env['FETCH_CACHE_DIR'] = ''
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('cases', {})
+
+    results = collections.OrderedDict()
+    regressions = []
+    print('%-16s %12s %12s %10s %12s' % ('case', 'median ms', 'baseline ms', 'peak MB', 'API calls'))
+    for name in args.cases or SUITE_CASES:
+        command = [sys.executable, os.path.abspath(__file__), 'suite-case', name,
+                   '--repeat', str(args.repeat), '--latency', str(args.latency),
+                   '--pdfs'] + args.pdfs + ['--pages'] + args.pages
+        output = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if result is None:
+            print('%-16s skipped, no inputs' % name)
+            continue
+        results[name] = result
+
+        previous = baseline.get(name)
+        print('%-16s %12.1f %12s %10.1f %12s' % (
+            name, result['wallSeconds'] * 1000,
+            '%.1f' % (previous['wallSeconds'] * 1000) if previous else '-',
+            result['peakRssKb'] / 1024.0,
+            result['apiCalls'] if result['apiCalls'] is not None else '-'))
+        if previous:
+            regressions.extend(compareToBaseline(name, result, previous, args))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'recorded': datetime.datetime.now().isoformat(timespec='seconds'),
+                'machine': '%s %s' % (platform.node(), platform.machine()),
+                'python': platform.python_version(),
+                'cases': results,
+            }, f, indent=2, sort_keys=True)
+        print('Wrote baseline to %s' % args.baseline)
+        return 0
+
+    for regression in regressions:
+        print('Regression: %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ocrParser = subparsers.add_parser('ocr', help='Compare OCR backends on the summary table crops')
+    ocrParser.add_argument('images', nargs='*', default=SUMMARY_IMAGES)
+    ocrParser.add_argument('--backends', nargs='+', default=['pytesseract', 'tesserocr'])
+    ocrParser.add_argument('--repeat', type=int, default=5)
+    ocrParser.set_defaults(run=benchmarkOcr)
+
+    pdfParser = subparsers.add_parser('pdf', help='Compare the text layer and camelot PDF extractors')
+    pdfParser.add_argument('pdfs', nargs='*', default=PREFECTURE_PDFS)
+    pdfParser.add_argument('--repeat', type=int, default=3)
+    pdfParser.set_defaults(run=benchmarkPdf)
+
+    indexParser = subparsers.add_parser('index', help='Compare report link discovery on saved index pages')
+    indexParser.add_argument('pages', nargs='*', default=INDEX_PAGES)
+    indexParser.add_argument('--repeat', type=int, default=10)
+    indexParser.set_defaults(run=benchmarkIndex)
+
+    imageParser = subparsers.add_parser('image', help='Compare time and memory of the summary image preprocessing')
+    imageParser.add_argument('images', nargs='*', default=SUMMARY_IMAGES)
+    imageParser.add_argument('--repeat', type=int, default=5)
+    imageParser.set_defaults(run=benchmarkImage)
+
+    variantParser = subparsers.add_parser('image-variant')
+    variantParser.add_argument('variant', choices=['legacy', 'current'])
+    variantParser.add_argument('image')
+    variantParser.add_argument('--repeat', type=int, default=5)
+    variantParser.set_defaults(run=measureImageVariant)
+
+    importParser = subparsers.add_parser('importtime', help='Check the cold import time of the service')
+    importParser.add_argument('--module', default='main')
+    importParser.add_argument('--budget-ms', type=float,
+                              default=float(os.environ.get('IMPORT_BUDGET_MS', 1000)))
+    importParser.add_argument('--top', type=int, default=20)
+    importParser.set_defaults(run=benchmarkImportTime)
+
+    suiteParser = subparsers.add_parser('suite', help='Run every benchmark case and compare to the baseline')
+    suiteParser.add_argument('cases', nargs='*', help='Cases to run (default all): %s' % ', '.join(SUITE_CASES))
+    suiteParser.add_argument('--baseline', default=BASELINE_PATH)
+    suiteParser.add_argument('--update-baseline', action='store_true',
+                             help='Record the results as the new baseline instead of comparing')
+    suiteParser.add_argument('--threshold', type=float, default=0.25,
+                             help='Allowed wall time increase over the baseline, as a fraction')
+    suiteParser.add_argument('--min-delta-ms', type=float, default=5.0,
+                             help='Wall time increases smaller than this are never regressions')
+    suiteParser.add_argument('--rss-threshold', type=float, default=0.10,
+                             help='Allowed peak RSS increase over the baseline, as a fraction')
+    suiteParser.add_argument('--repeat', type=int, default=3)
+    suiteParser.add_argument('--latency', type=float, default=0.0,
+                             help='Seconds added to every fake Sheets call')
+    suiteParser.add_argument('--pdfs', nargs='*', default=PREFECTURE_PDFS)
+    suiteParser.add_argument('--pages', nargs='*', default=INDEX_PAGES)
+    suiteParser.set_defaults(run=benchmarkSuite)
+
+    caseParser = subparsers.add_parser('suite-case')
+    caseParser.add_argument('case', choices=list(SUITE_CASES))
+    caseParser.add_argument('--repeat', type=int, default=3)
+    caseParser.add_argument('--latency', type=float, default=0.0)
+    caseParser.add_argument('--pdfs', nargs='*', default=[])
+    caseParser.add_argument('--pages', nargs='*', default=[])
+    caseParser.set_defaults(run=measureSuiteCase)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Disk cache of extraction results keyed by the SHA-256 of the source files.
+
+If MHLW hasn't published a new report, the PDF and summary image are byte
+identical and there is no need to run camelot or tesseract again. Results are
+stored as JSON under EXTRACTION_CACHE_DIR so they survive restarts. Bump the
+extractor version passed to cacheKey() whenever the extraction logic changes.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+EXTRACTION_CACHE_DIR = os.environ.get(
+    'EXTRACTION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid19japan-extraction-cache'))
+
+
+def cacheKey(extractor, version, *sources):
+    digest = hashlib.sha256()
+    digest.update(('%s:%s' % (extractor, version)).encode('utf-8'))
+    for source in sources:
+        digest.update(hashlib.sha256(source).digest())
+    return digest.hexdigest()
+
+
+def cachePath(key):
+    return os.path.join(EXTRACTION_CACHE_DIR, '%s.json' % key)
+
+
+def get(key):
+    """
+    Returns the cached result for key or None.
+    """
+    if not EXTRACTION_CACHE_DIR:
+        return None
+    try:
+        with open(cachePath(key)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def put(key, value):
+    if not EXTRACTION_CACHE_DIR:
+        return
+    os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(dir=EXTRACTION_CACHE_DIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(tempPath, cachePath(key))
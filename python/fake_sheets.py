@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+In-memory stand-in for the parts of the Sheets v4 API used by sync_patients
+and mhlw, for running and benchmarking the write paths without the live
+spreadsheet.
+
+FakeSpreadsheet has the same shape as the spreadsheets() resource:
+get/batchUpdate and values().get/update/append/batchGet/batchUpdate, each
+returning a request whose execute() does the work. Tabs are seeded with the
+layout of the real spreadsheet: the patient tabs (columns A-N), 'Sum By Day',
+'Recoveries' and 'Prefecture Data'.
+
+Every execute() sleeps for the configured latency (FAKE_SHEETS_LATENCY
+seconds by default) outside the lock, like a round trip, and is counted per
+method in callCounts.
+
+Use it with SHEETS_BACKEND=fake, or from code:
+
+  fake = fake_sheets.FakeSpreadsheet(latency=0.05)
+  fake_sheets.install(fake)
+  sync_patients.writePatients('Tokyo', '2020-05-01', 10, 0, 'source')
+  print(fake.callCounts)
+"""
+
+import os
+import re
+import copy
+import time
+import datetime
+import threading
+import collections
+
+FAKE_SHEETS_LATENCY = float(os.environ.get('FAKE_SHEETS_LATENCY', 0))
+
+PATIENT_TABS = ['Patient Data', 'Aichi', 'Chiba', 'Fukuoka', 'Hokkaido',
+                'Kanagawa', 'Osaka', 'Saitama', 'Tokyo']
+PATIENT_HEADER = ['Patient Number', 'Prefecture Patient Number', 'City Patient Number',
+                  'Date Announced', 'Date Added', 'Age', 'Gender', 'Residence City',
+                  'Detected City', 'Detected Prefecture', 'Status', 'Patient Count',
+                  'Notes', 'Source']
+SUM_BY_DAY_HEADER = ['Date', 'Confirmed', 'Recovered', 'Deceased', 'Critical', 'Tested', 'Active']
+
+rangePattern = re.compile(r"^(?:'((?:[^']|'')+)'|([^!']+))(?:!([A-Z]*)([0-9]*)(?::([A-Z]*)([0-9]*))?)?$")
+
+
+class FakeSheetsError(Exception):
+    pass
+
+
+def columnIndex(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def columnLetters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def quoteTitle(title):
+    if re.match(r'^[A-Za-z0-9_]+$', title):
+        return title
+    return "'%s'" % title.replace("'", "''")
+
+
+def a1Range(title, top, left, bottom, right):
+    """
+    Formats 0-based inclusive cell bounds the way the API reports ranges.
+    """
+    start = '%s%d' % (columnLetters(left), top + 1)
+    end = '%s%d' % (columnLetters(right), bottom + 1)
+    return '%s!%s' % (quoteTitle(title), start if start == end else '%s:%s' % (start, end))
+
+
+class Tab(object):
+    def __init__(self, sheetId, index, title, rows, rowCount=None, columnCount=None):
+        self.sheetId = sheetId
+        self.index = index
+        self.title = title
+        self.cells = [[formatValue(v) for v in row] for row in rows]
+        self.rowCount = rowCount or max(len(rows), 1)
+        self.columnCount = columnCount or max([len(row) for row in rows] + [1])
+
+    def properties(self):
+        return {
+            'sheetId': self.sheetId,
+            'title': self.title,
+            'index': self.index,
+            'sheetType': 'GRID',
+            'gridProperties': {'rowCount': self.rowCount, 'columnCount': self.columnCount},
+        }
+
+    def cell(self, row, column):
+        if row < len(self.cells) and column < len(self.cells[row]):
+            return self.cells[row][column]
+        return ''
+
+    def setCell(self, row, column, value):
+        while len(self.cells) <= row:
+            self.cells.append([])
+        cells = self.cells[row]
+        while len(cells) <= column:
+            cells.append('')
+        cells[column] = value
+
+    def lastRowWithData(self, left, right):
+        for row in range(len(self.cells) - 1, -1, -1):
+            if any([self.cell(row, c) != '' for c in range(left, right + 1)]):
+                return row
+        return -1
+
+
+def formatValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    return str(value)
+
+
+class FakeRequest(object):
+    def __init__(self, spreadsheet, method, fn):
+        self.spreadsheet = spreadsheet
+        self.method = method
+        self.fn = fn
+
+    def execute(self):
+        return self.spreadsheet.call(self.method, self.fn)
+
+
+class FakeValues(object):
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return FakeRequest(self.spreadsheet, 'values.get',
+                           lambda: self.spreadsheet.readRange(range))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return FakeRequest(self.spreadsheet, 'values.batchGet', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'valueRanges': [self.spreadsheet.readRange(r) for r in ranges],
+        })
+
+    def update(self, spreadsheetId, range, body, valueInputOption=None, **kwargs):
+        return FakeRequest(self.spreadsheet, 'values.update',
+                           lambda: self.spreadsheet.writeRange(range, body['values']))
+
+    def batchUpdate(self, spreadsheetId, body):
+        def run():
+            responses = [self.spreadsheet.writeRange(d['range'], d['values']) for d in body['data']]
+            return {
+                'spreadsheetId': spreadsheetId,
+                'totalUpdatedCells': sum([r['updatedCells'] for r in responses]),
+                'responses': responses,
+            }
+        return FakeRequest(self.spreadsheet, 'values.batchUpdate', run)
+
+    def append(self, spreadsheetId, range, body, valueInputOption=None,
+               insertDataOption='OVERWRITE', includeValuesInResponse=False, **kwargs):
+        return FakeRequest(self.spreadsheet, 'values.append', lambda: self.spreadsheet.appendRows(
+            range, body['values'], insertDataOption, includeValuesInResponse))
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, latency=FAKE_SHEETS_LATENCY, patientRows=200, days=60, seed=True):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tabs = collections.OrderedDict()
+        self.callCounts = collections.Counter()
+        if seed:
+            self.seed(patientRows, days)
+
+    # spreadsheets() resource
+
+    def values(self):
+        return FakeValues(self)
+
+    def get(self, spreadsheetId, fields=None, **kwargs):
+        return FakeRequest(self, 'get', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'sheets': [{'properties': tab.properties()} for tab in self.tabs.values()],
+        })
+
+    def batchUpdate(self, spreadsheetId, body):
+        return FakeRequest(self, 'batchUpdate', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'replies': [self.applyRequest(r) for r in body['requests']],
+        })
+
+    # Accounting
+
+    def call(self, method, fn):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.callCounts[method] += 1
+            return copy.deepcopy(fn())
+
+    def resetCallCounts(self):
+        with self.lock:
+            self.callCounts.clear()
+
+    def totalCalls(self):
+        with self.lock:
+            return sum(self.callCounts.values())
+
+    # Tabs
+
+    def addTab(self, title, rows, rowCount=None, columnCount=None):
+        sheetId = len(self.tabs) * 1000 + 1
+        self.tabs[title] = Tab(sheetId, len(self.tabs), title, rows, rowCount, columnCount)
+        return self.tabs[title]
+
+    def tabById(self, sheetId):
+        for tab in self.tabs.values():
+            if tab.sheetId == sheetId:
+                return tab
+        raise FakeSheetsError('No tab with sheetId %s' % sheetId)
+
+    def resolve(self, rangeString):
+        """
+        @returns (tab, top, left, bottom, right) with 0-based inclusive bounds,
+            open ends clamped to the grid.
+        """
+        match = rangePattern.match(rangeString)
+        if not match:
+            raise FakeSheetsError('Unable to parse range: %s' % rangeString)
+        title = match.group(1).replace("''", "'") if match.group(1) else match.group(2)
+        if title not in self.tabs:
+            raise FakeSheetsError('Unable to parse range: %s' % rangeString)
+        tab = self.tabs[title]
+
+        startColumn, startRow, endColumn, endRow = match.group(3, 4, 5, 6)
+        left = columnIndex(startColumn) if startColumn else 0
+        top = int(startRow) - 1 if startRow else 0
+        if match.group(5) is None and match.group(6) is None and (startColumn or startRow):
+            # A single cell such as A1.
+            right = left if startColumn else tab.columnCount - 1
+            bottom = top if startRow else tab.rowCount - 1
+        else:
+            right = columnIndex(endColumn) if endColumn else tab.columnCount - 1
+            bottom = int(endRow) - 1 if endRow else tab.rowCount - 1
+        if top >= tab.rowCount or left >= tab.columnCount:
+            raise FakeSheetsError('Range (%s) exceeds grid limits. Max rows: %d, max columns: %d' % (
+                rangeString, tab.rowCount, tab.columnCount))
+        return (tab, top, left, min(bottom, tab.rowCount - 1), min(right, tab.columnCount - 1))
+
+    def readRange(self, rangeString):
+        tab, top, left, bottom, right = self.resolve(rangeString)
+        values = []
+        for row in range(top, bottom + 1):
+            cells = [tab.cell(row, c) for c in range(left, right + 1)]
+            while cells and cells[-1] == '':
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+
+        result = {'range': a1Range(tab.title, top, left, bottom, right), 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def writeRange(self, rangeString, values, startRow=None):
+        tab, top, left, bottom, right = self.resolve(rangeString)
+        if startRow is not None:
+            top = startRow
+        width = max([len(row) for row in values] + [0])
+        if top + len(values) > tab.rowCount or left + width > tab.columnCount:
+            raise FakeSheetsError('Range (%s) exceeds grid limits. Max rows: %d, max columns: %d' % (
+                rangeString, tab.rowCount, tab.columnCount))
+        formatted = []
+        for i in range(len(values)):
+            formatted.append([formatValue(v) for v in values[i]])
+            for j in range(len(values[i])):
+                tab.setCell(top + i, left + j, formatted[i][j])
+        updatedRange = a1Range(tab.title, top, left, top + max(len(values), 1) - 1,
+                               left + max(width, 1) - 1)
+        return {
+            'updatedRange': updatedRange,
+            'updatedRows': len(values),
+            'updatedColumns': width,
+            'updatedCells': sum([len(row) for row in values]),
+            'updatedData': {'range': updatedRange, 'majorDimension': 'ROWS', 'values': formatted},
+        }
+
+    def appendRows(self, rangeString, values, insertDataOption, includeValuesInResponse):
+        tab, top, left, bottom, right = self.resolve(rangeString)
+        # Appends after the last row with data in the columns of the range.
+        lastRow = tab.lastRowWithData(left, right)
+        startRow = max(lastRow + 1, top)
+        if insertDataOption == 'INSERT_ROWS':
+            tab.cells[startRow:startRow] = [[] for row in values]
+            tab.rowCount += len(values)
+        elif startRow + len(values) > tab.rowCount:
+            tab.rowCount = startRow + len(values)
+
+        update = self.writeRange(rangeString, values, startRow)
+        if not includeValuesInResponse:
+            del update['updatedData']
+        return {
+            'tableRange': a1Range(tab.title, top, left, max(lastRow, top), right),
+            'updates': update,
+        }
+
+    def applyRequest(self, request):
+        if 'appendDimension' in request:
+            append = request['appendDimension']
+            tab = self.tabById(append['sheetId'])
+            if append['dimension'] == 'ROWS':
+                tab.rowCount += append['length']
+            else:
+                tab.columnCount += append['length']
+            return {}
+
+        if 'insertDimension' in request:
+            dimensionRange = request['insertDimension']['range']
+            tab = self.tabById(dimensionRange['sheetId'])
+            start, end = dimensionRange['startIndex'], dimensionRange['endIndex']
+            if dimensionRange['dimension'] == 'ROWS':
+                tab.cells[start:start] = [[] for i in range(end - start)]
+                tab.rowCount += end - start
+            else:
+                for cells in tab.cells:
+                    if len(cells) > start:
+                        cells[start:start] = [''] * (end - start)
+                tab.columnCount += end - start
+            return {}
+
+        raise FakeSheetsError('Unsupported request: %s' % ', '.join(request.keys()))
+
+    def seed(self, patientRows, days):
+        """
+        Creates the tabs with the real column layout, patientRows rows in each
+        patient tab and days of history in the summary tabs.
+        """
+        # Imported here, sync_patients imports sheets which imports this lazily.
+        from sync_patients import PREFECTURE_PREFIX, getTabForPrefecture
+
+        prefectures = [p for p in sorted(PREFECTURE_PREFIX) if p != 'Port Quarantine']
+        today = datetime.date(2020, 5, 1)
+        dates = [(today - datetime.timedelta(days=days - i)).isoformat() for i in range(days)]
+
+        for title in PATIENT_TABS:
+            tabPrefectures = [p for p in prefectures if getTabForPrefecture(p) == title]
+            rows = [PATIENT_HEADER]
+            for i in range(patientRows):
+                prefecture = tabPrefectures[i % len(tabPrefectures)]
+                date = dates[i * len(dates) // patientRows] if dates else today.isoformat()
+                # Older rows are one per patient, newer ones use the count column.
+                count = '' if i < patientRows // 2 else (i % 7) + 1
+                rows.append(['%s%d' % (PREFECTURE_PREFIX[prefecture], i + 1), '', '', date, date,
+                             '', '', '', '', prefecture, '', count, '', 'https://example.com'])
+            self.addTab(title, rows, columnCount=len(PATIENT_HEADER))
+
+        # Full grid, so that writing a new day needs an appendDimension.
+        self.addTab('Sum By Day', [SUM_BY_DAY_HEADER] + [
+            [date, 10 + i, 100 + i, 5 + i // 10, 20, 1000 + 10 * i, ''] for i, date in enumerate(dates)],
+            columnCount=len(SUM_BY_DAY_HEADER))
+
+        recoveryDates = list(reversed(dates))
+        rows = [['Prefecture', 'Total'] + recoveryDates]
+        for name in prefectures + ['Port Quarantine', 'Unspecified']:
+            rows.append([name, ''] + [10] * len(recoveryDates))
+        self.addTab('Recoveries', rows, columnCount=len(recoveryDates) + 2)
+
+        rows = [['Prefecture Data'], ['Prefecture', '', '', '', 'Recovered', '', '', '', 'Cases']]
+        for name in prefectures + ['Port Quarantine']:
+            rows.append([name, '', '', '', 10, '', '', '', 20])
+        self.addTab('Prefecture Data', rows, columnCount=12)
+
+
+_fake = None
+_fakeLock = threading.Lock()
+
+
+def getFakeSpreadsheet():
+    """
+    Returns the shared fake used when SHEETS_BACKEND=fake.
+    """
+    global _fake
+    with _fakeLock:
+        if _fake is None:
+            _fake = FakeSpreadsheet()
+        return _fake
+
+
+def install(fake):
+    """
+    Makes sheets.getSpreadsheet() return fake in every thread and drops the
+    state cached from the previous spreadsheet.
+    """
+    import sheets
+    import sync_patients
+
+    sheets.setSpreadsheet(fake)
+    sync_patients.clearCaches()
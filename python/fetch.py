@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+HTTP fetching with a conditional-GET disk cache, shared by the MHLW scrapers.
+
+Responses are stored content-addressed (by SHA-256 of the body) under
+FETCH_CACHE_DIR, indexed in SQLite together with their ETag and Last-Modified
+headers so that all processes share one index. A cached
+URL is revalidated with If-None-Match / If-Modified-Since, so an unchanged page
+costs a 304 instead of a full download. The cache is bounded to
+FETCH_CACHE_MAX_BYTES, evicting the least recently used URLs first. Set
+FETCH_CACHE_DIR to an empty string to disable the cache.
+
+Connections are kept alive with one requests.Session per thread.
+
+To try it without hitting MHLW, serve the fixtures locally, which answers
+If-Modified-Since with 304:
+
+python3 -m http.server --directory test 8000
+
+startRecording() saves every body fetched until stopRecording() to a directory
+with an inputs.json index. Pointing FETCH_REPLAY_DIR at such a directory serves
+fetch() from it instead of the network, to rerun a recorded run offline.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import contextlib
+import threading
+import urllib.request
+
+FETCH_CACHE_DIR = os.environ.get(
+    'FETCH_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid19japan-fetch-cache'))
+FETCH_CACHE_MAX_BYTES = int(os.environ.get('FETCH_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+FETCH_TIMEOUT = 60
+FETCH_REPLAY_DIR = os.environ.get('FETCH_REPLAY_DIR', '')
+# Index of URL to saved body in a recording.
+INPUTS_INDEX = 'inputs.json'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+  url TEXT PRIMARY KEY,
+  sha256 TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  etag TEXT,
+  lastModified TEXT,
+  accessed REAL NOT NULL
+)
+'''
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def getSession():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        import requests
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+class FetchCache(object):
+    """
+    URL index in index.sqlite3 and bodies in objects/<sha256>.
+
+    The index is shared by every process using cacheDir (the extraction and
+    backfill pools, gunicorn workers). Writes and eviction run in one
+    transaction, so processes see each other's entries and an object is only
+    deleted when no entry in the shared index refers to it.
+    """
+
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.indexPath = os.path.join(cacheDir, 'index.sqlite3')
+        self.objectsDir = os.path.join(cacheDir, 'objects')
+        self.created = False
+
+    def connect(self):
+        if not self.created:
+            os.makedirs(self.objectsDir, exist_ok=True)
+        # Transactions are started explicitly with BEGIN IMMEDIATE.
+        db = sqlite3.connect(self.indexPath, timeout=30, isolation_level=None)
+        if not self.created:
+            db.execute(SCHEMA)
+            self.created = True
+        return db
+
+    def objectPath(self, digest):
+        return os.path.join(self.objectsDir, digest)
+
+    def get(self, url):
+        """
+        Returns (entry, body) for url, or (None, None) if it is not cached.
+        """
+        with contextlib.closing(self.connect()) as db:
+            row = db.execute(
+                'SELECT sha256, size, etag, lastModified, accessed FROM entries WHERE url = ?',
+                (url,)).fetchone()
+            if not row:
+                return None, None
+            entry = dict(zip(('sha256', 'size', 'etag', 'lastModified', 'accessed'), row))
+            try:
+                with open(self.objectPath(entry['sha256']), 'rb') as f:
+                    return entry, f.read()
+            except IOError:
+                db.execute('DELETE FROM entries WHERE url = ? AND sha256 = ?', (url, entry['sha256']))
+                return None, None
+
+    def touch(self, url):
+        with contextlib.closing(self.connect()) as db:
+            db.execute('UPDATE entries SET accessed = ? WHERE url = ?', (time.time(), url))
+
+    def put(self, url, body, etag, lastModified):
+        digest = hashlib.sha256(body).hexdigest()
+        with contextlib.closing(self.connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # Written inside the transaction so eviction in another process
+                # can't remove the object between writing it and indexing it.
+                path = self.objectPath(digest)
+                if not os.path.exists(path):
+                    fd, tempPath = tempfile.mkstemp(dir=self.objectsDir)
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(body)
+                    os.replace(tempPath, path)
+                db.execute('''
+                    INSERT OR REPLACE INTO entries (url, sha256, size, etag, lastModified, accessed)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (url, digest, len(body), etag, lastModified, time.time()))
+                removed = self.evict(db)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        for digest in removed:
+            try:
+                os.remove(self.objectPath(digest))
+            except OSError:
+                pass
+
+    def evict(self, db):
+        """
+        Drops the least recently used URLs until the bodies fit in maxBytes.
+        Runs inside the caller's transaction.
+
+        @returns the digests that no entry refers to any more.
+        """
+        totalSize = db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM entries)').fetchone()[0]
+        removed = []
+        for url, digest, size in db.execute(
+                'SELECT url, sha256, size FROM entries ORDER BY accessed').fetchall():
+            if totalSize <= self.maxBytes:
+                break
+            db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            if not db.execute('SELECT 1 FROM entries WHERE sha256 = ?', (digest,)).fetchone():
+                totalSize -= size
+                removed.append(digest)
+        return removed
+
+
+_cache = FetchCache(FETCH_CACHE_DIR, FETCH_CACHE_MAX_BYTES) if FETCH_CACHE_DIR else None
+
+
+class FetchRecorder(object):
+    """
+    Saves fetched bodies under directory by SHA-256. The index of URL to body
+    is written to INPUTS_INDEX by close().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.inputs = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, url, body):
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            path = os.path.join(self.directory, digest)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(body)
+            self.inputs[url] = {'file': digest, 'bytes': len(body)}
+
+    def close(self):
+        with self.lock:
+            with open(os.path.join(self.directory, INPUTS_INDEX), 'w') as f:
+                json.dump(self.inputs, f, indent=2, sort_keys=True)
+
+
+_recorders = []
+_replayIndex = None
+
+
+def startRecording(directory):
+    """
+    Saves everything fetched from now on (by any thread) to directory.
+
+    @returns the FetchRecorder to pass to stopRecording().
+    """
+    recorder = FetchRecorder(directory)
+    with _lock:
+        _recorders.append(recorder)
+    return recorder
+
+
+def stopRecording(recorder):
+    """
+    Stops recording and writes the recorder's INPUTS_INDEX.
+    """
+    with _lock:
+        _recorders.remove(recorder)
+    recorder.close()
+
+
+def replay(url):
+    """
+    Returns the body recorded for url in FETCH_REPLAY_DIR.
+
+    @raises KeyError if url was not recorded.
+    """
+    global _replayIndex
+    with _lock:
+        if _replayIndex is None:
+            with open(os.path.join(FETCH_REPLAY_DIR, INPUTS_INDEX)) as f:
+                _replayIndex = json.load(f)
+        entry = _replayIndex.get(url)
+    if entry is None:
+        raise KeyError('%s was not recorded in %s' % (url, FETCH_REPLAY_DIR))
+    with open(os.path.join(FETCH_REPLAY_DIR, entry['file']), 'rb') as f:
+        return f.read()
+
+
+def fetch(url):
+    """
+    Returns the body of url as bytes.
+
+    @raises requests.HTTPError on an error response.
+    """
+    if FETCH_REPLAY_DIR:
+        return replay(url)
+
+    body = download(url)
+    with _lock:
+        recorders = list(_recorders)
+    for recorder in recorders:
+        recorder.save(url, body)
+    return body
+
+
+def download(url):
+    if not url.startswith('http'):
+        # data: and file: URLs are not worth caching.
+        return urllib.request.urlopen(url).read()
+
+    headers = {}
+    entry, body = None, None
+    if _cache:
+        entry, body = _cache.get(url)
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+
+    response = getSession().get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    if response.status_code == 304 and entry:
+        _cache.touch(url)
+        return body
+
+    response.raise_for_status()
+    if _cache and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+        _cache.put(url, response.content,
+                   response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return response.content
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Background jobs for long running requests such as /mhlw/today.
+
+Jobs run on a bounded thread pool and are kept in memory. Jobs are submitted
+with a key, and submitting a key that already has a pending or running job
+returns that job instead of starting another one, so that the scheduler and a
+person hitting the same endpoint don't run the pipeline twice.
+
+Each job runs under its own trace, and the time spent in each traced stage is
+kept in the job's timings.
+"""
+
+import os
+import time
+import uuid
+import threading
+import traceback
+import concurrent.futures
+
+import tracing
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Seconds to keep finished jobs around for polling.
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 24 * 60 * 60))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(object):
+    def __init__(self, key, kwargs=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        # Keyword arguments the job was submitted with, to tell how a job that
+        # is already in flight was started.
+        self.kwargs = kwargs or {}
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.timings = {}
+        self.finishedEvent = threading.Event()
+
+    def isFinished(self):
+        return self.status in (DONE, FAILED)
+
+    def toDict(self):
+        return {
+            'jobId': self.id,
+            'key': self.key,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'jobTimings': self.timings,
+        }
+
+
+class JobManager(object):
+    def __init__(self, workers=JOB_WORKERS, retention=JOB_RETENTION):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.activeJobs = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Starts fn(*args, **kwargs) as a job unless a job with the same key is
+        still pending or running.
+
+        @returns (job, created) where created is False if the job was already
+            in flight.
+        """
+        with self.lock:
+            self.expire()
+            job = self.activeJobs.get(key)
+            if job and not job.isFinished():
+                return (job, False)
+
+            job = Job(key, kwargs)
+            self.jobs[job.id] = job
+            self.activeJobs[key] = job
+        self.executor.submit(self.run, job, fn, args, kwargs)
+        return (job, True)
+
+    def run(self, job, fn, args, kwargs):
+        job.status = RUNNING
+        job.started = time.time()
+        trace = tracing.Trace()
+        previous = tracing.activate(trace)
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = DONE
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            tracing.activate(previous)
+        job.timings = trace.breakdown()
+        job.finished = time.time()
+        with self.lock:
+            if self.activeJobs.get(job.key) is job:
+                del self.activeJobs[job.key]
+        job.finishedEvent.set()
+
+    def get(self, jobId):
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    def wait(self, job, timeout=None):
+        job.finishedEvent.wait(timeout)
+        return job
+
+    def expire(self):
+        # Callers must hold lock.
+        cutoff = time.time() - self.retention
+        for jobId in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            del self.jobs[jobId]
+
+
+_manager = None
+_managerLock = threading.Lock()
+
+
+def getJobManager():
+    global _manager
+    with _managerLock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -1,14 +1,88 @@
 import os
+import time
+import functools
+import concurrent.futures
 
 from flask import Flask
+from flask import Response
+from flask import g
 from flask import request
 from flask import render_template
 import json
+import jobs
 import mhlw
+import ocr
+import profiling
 import sync_patients
+import tracing
+import write_queue
 
 app = Flask(__name__)
 
+# Queue patient updates and write them in the background instead of waiting for Sheets.
+PATIENT_WRITE_BEHIND = os.environ.get('PATIENT_WRITE_BEHIND') == '1'
+
+
+def warmup():
+  """
+  Loads the dependencies that are otherwise imported on the first request that
+  needs them. Enabled with WARMUP=1, use together with gunicorn --preload so
+  that the workers are forked with everything already imported.
+
+  The extraction processes are started too, so that they have done their own
+  imports before the first report. With --preload each worker starts its own
+  right after the fork.
+  """
+  mhlw.warmup()
+  mhlw.warmupExtractionPool()
+
+if os.environ.get('WARMUP') == '1':
+  warmup()
+
+if PATIENT_WRITE_BEHIND:
+  # Starts the flusher, which also writes whatever an earlier instance left in the journal.
+  write_queue.getWriteQueue()
+
+
+@app.before_request
+def start_trace():
+  g.trace = tracing.Trace()
+  g.previousTrace = tracing.activate(g.trace)
+  g.requestStart = time.perf_counter()
+
+@app.teardown_request
+def finish_trace(error):
+  if 'trace' not in g:
+    return
+  if request.endpoint:
+    tracing.finish('route.%s' % request.endpoint, time.perf_counter() - g.requestStart, error is not None)
+  tracing.activate(g.previousTrace)
+
+def traced_json(result):
+  """
+  Returns result as JSON with the time spent in each traced stage of this request.
+  """
+  result['timings'] = g.trace.breakdown()
+  if 'profile' in g:
+    result['profile'] = g.profile.directory
+  return json.dumps(result)
+
+def profiled(route):
+  """
+  Runs the route under profiling.ProfiledRun when PROFILE_DIR is set and the
+  request has ?profile=1.
+  """
+  @functools.wraps(route)
+  def run(*args, **kwargs):
+    if not profiling.isEnabled(request.args.get('profile') == '1'):
+      return route(*args, **kwargs)
+    # Start without cached rows, so that the recording has every read the route depends on.
+    sync_patients.clearCaches()
+    with profiling.ProfiledRun(request.endpoint, request.args.to_dict()) as profile:
+      g.profile = profile
+      return route(*args, **kwargs)
+  return run
+
 
 @app.route("/")
 def hello_world():
@@ -16,6 +90,7 @@ def hello_world():
     return "Hello {}!".format(name)
 
 @app.route('/patients/update')
+@profiled
 def patient_update():
   prefecture = request.args.get('prefecture')
   cases = request.args.get('cases')
@@ -23,32 +98,114 @@ def patient_update():
   source = request.args.get('source')
   deceased = request.args.get('deceased')
   if not prefecture or not date:
-    return json.dumps({'error': 'Required parameters prefecture= and date= not found.'})
+    return traced_json({'error': 'Required parameters prefecture= and date= not found.'})
 
   if not cases and not deceased:
     # Need to prompt for the number.
     return render_template('patient_update.html', prefecture=prefecture, date=date, source=source, cases=cases, deceased=deceased)
 
   print(locals())
-  if cases:
-    cases = int(cases)
-  if deceased:
-    deceased = int(deceased)
+  entry = {'prefecture': prefecture, 'date': date, 'cases': cases, 'deceased': deceased, 'source': source}
+  error = sync_patients.validateEntry(entry)
+  if error:
+    return traced_json({'error': error})
+  cases, deceased = entry['cases'], entry['deceased']
+
+  if PATIENT_WRITE_BEHIND or request.args.get('async') == '1':
+    write_queue.getWriteQueue().enqueue(prefecture, date, cases, deceased, source)
+    return traced_json({'queued': True})
 
   updatedRows = sync_patients.writePatients(prefecture, date, cases, deceased, source)
-  return json.dumps({'updateRows': updatedRows})
+  return traced_json({'updateRows': updatedRows})
+
+@app.route('/patients/batch', methods=['POST'])
+def patient_batch():
+  entries = request.get_json(silent=True)
+  if not isinstance(entries, list):
+    return traced_json({'error': 'Expected a JSON list of {prefecture, date, cases, deceased, source}.'})
+
+  for entry in entries:
+    if not isinstance(entry, dict):
+      return traced_json({'error': 'Expected a JSON list of {prefecture, date, cases, deceased, source}.'})
+
+  if PATIENT_WRITE_BEHIND or request.args.get('async') == '1':
+    queue = write_queue.getWriteQueue()
+    queued = 0
+    invalid = []
+    for i, entry in enumerate(entries):
+      error = sync_patients.validateEntry(entry)
+      if error:
+        invalid.append({'index': i, 'error': error})
+        continue
+      queue.enqueue(entry['prefecture'], entry['date'], entry.get('cases'), entry.get('deceased'), entry.get('source'))
+      queued += 1
+    return traced_json({'queued': queued, 'invalid': invalid})
+
+  results = sync_patients.writePatientsBatch(entries)
+  return traced_json({'results': results})
+
+@app.route('/patients/queue')
+def patient_queue():
+  queue = write_queue.getWriteQueue()
+  if request.args.get('flush') == '1':
+    queue.flush(force=True)
+  return traced_json(queue.status())
 
 @app.route('/mhlw/reporturl')
+@profiled
 def report_url():
   url = mhlw.getLatestCovidReport(mhlw.DEFAULT_MHLW_INDEX_URL)
-  return json.dumps({'result': {
+  return traced_json({'result': {
     'url': url
   }})
 
-@app.route('/mhlw/today')
+def start_report_today(force, pool=None):
+  """
+  Starts a job that finds, extracts and writes the latest report, or returns
+  the job that is already doing that.
+  """
+  return jobs.getJobManager().submit('mhlw/today', mhlw.reportToday, True, force=force, pool=pool)
+
+@app.route('/mhlw/today', methods=['GET', 'POST'])
+@profiled
 def report_today():
-  result = mhlw.reportToday(True)
-  return json.dumps({'result': result})
+  force = request.args.get('force') == '1'
+  if 'profile' in g and request.method == 'GET':
+    # Extract on threads of this process instead of the process pool, so that the profiler sees it.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+      return run_report_today(force, pool)
+  return run_report_today(force)
+
+def run_report_today(force, pool=None):
+  job, created = start_report_today(force, pool)
+  if force and not created and not job.kwargs.get('force'):
+    # The running job may reuse cached results, so it can't stand in for a forced run.
+    return traced_json({'error': 'A report job without force=1 is already running, retry when it is done.',
+                        'jobId': job.id, 'status': job.status, 'forceIgnored': True}), 409
+
+  if request.method == 'POST':
+    return traced_json({'jobId': job.id, 'status': job.status, 'coalesced': not created}), 202
+
+  # GET waits for the result, sharing the job with any concurrent request.
+  jobs.getJobManager().wait(job)
+  if job.error:
+    return traced_json({'error': job.error, 'jobTimings': job.timings, 'coalesced': not created})
+  return traced_json({'result': job.result, 'jobTimings': job.timings, 'coalesced': not created})
+
+@app.route('/mhlw/ocrcache')
+def ocr_cache():
+  return traced_json(ocr.getCacheStats())
+
+@app.route('/mhlw/jobs/<jobId>')
+def report_job(jobId):
+  job = jobs.getJobManager().get(jobId)
+  if not job:
+    return traced_json({'error': 'Unknown job %s' % jobId}), 404
+  return traced_json(job.toDict())
+
+@app.route('/metrics')
+def metrics():
+  return Response(tracing.renderMetrics(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
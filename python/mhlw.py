@@ -26,29 +26,65 @@ Credentials use a service account credentials that are created using
 these instructions and places in credentials.json:
 
 https://theoephraim.github.io/node-google-spreadsheet/#/getting-started/authentication?id=service-account
+
+Heavy dependencies (camelot, pandas, BeautifulSoup, PIL, tesseract and the
+Google API client) are imported when first used, call warmup() to load them
+ahead of time.
 """
 
 import sys
+import io
 import re
-import urllib.request
+import html.parser
 import urllib.parse
 import tempfile
 import argparse
 import pprint
+import os
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+
+import extraction_cache
+import fetch
+import ocr
+import pdf_text
+import table_layout
+import tracing
+
+import sheets
+from sheets import SCOPES, SPREADSHEET_ID
+
+# Number of crops of the summary table that are OCR'd in parallel.
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 4))
+
+# Processes used to run camelot and OCR in parallel, 0 to use threads instead.
+EXTRACTION_PROCESSES = int(os.environ.get('EXTRACTION_PROCESSES', 2))
+_extractionPool = None
+_extractionPoolLock = threading.Lock()
+# Set by warmupExtractionPool(), so that a forked child warms up its own pool.
+_extractionPoolWarm = False
+
+# 'camelot' uses camelot, 'text' reads the PDF table from the text layer
+# (falling back to camelot). test/test_pdf_extractors.py checks that both agree
+# on the PDFs in test/; switch the default once it covers saved MHLW PDFs.
+PDF_EXTRACTOR = os.environ.get('PDF_EXTRACTOR', 'camelot')
+
+# Size of the summary table image that extractImageAreas expects.
+NORMALIZED_SIZE = (661, 181)
+# White pixels added around a detected text line before OCR.
+OCR_CROP_BORDER = 4
+# Where --outputImages writes the original and cropped summary table images.
+DEBUG_IMAGE_DIR = os.environ.get('DEBUG_IMAGE_DIR', '.')
+
+# Bump these when the extraction changes so cached results are not reused.
+CASES_RECOVERY_EXTRACTOR_VERSION = 3
+DAILY_SUMMARY_EXTRACTOR_VERSION = 5
+
+# Values read from the summary table image.
+SUMMARY_KEYS = ('pcr', 'critical', 'recoveries', 'deaths', 'portRecoveries')
 
-import camelot
-import pandas as pd
-from bs4 import BeautifulSoup
-
-from PIL import Image
-import pytesseract
-
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-SPREADSHEET_ID = '1vkw_Lku7F_F3F_iNmFFrDq9j7-tQ6EmZPOLpLt-s3TY'
 DEFAULT_MHLW_INDEX_URL = 'https://www.mhlw.go.jp/stf/seisakunitsuite/bunya/topics_shingata_09444.html'
 # 'https://www.mhlw.go.jp/stf/seisakunitsuite/bunya/0000121431_00204.html'
 
@@ -62,6 +98,82 @@ def absoluteUrl(referer, path):
     return urllib.parse.urlunparse((baseurl.scheme, baseurl.netloc, path, '', '', ''))
 
 
+covidReportPattern = re.compile('新型コロナウイルス感染症の現在の状況')
+
+
+class AnchorScanner(html.parser.HTMLParser):
+    """
+    Collects (href, text) of the <a> elements whose text matches pattern,
+    ignoring everything else on the page.
+    """
+
+    def __init__(self, pattern):
+        html.parser.HTMLParser.__init__(self)
+        self.pattern = pattern
+        self.links = []
+        self.href = None
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.href = dict(attrs).get('href')
+            self.text = []
+
+    def handle_data(self, data):
+        if self.href is not None:
+            self.text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.href is not None:
+            text = ''.join(self.text)
+            if self.href and self.pattern.search(text):
+                self.links.append((self.href, text))
+            self.href = None
+
+
+def decodeHtml(contents):
+    try:
+        return contents.decode('utf-8')
+    except UnicodeDecodeError:
+        from bs4 import UnicodeDammit
+        return UnicodeDammit(contents).unicode_markup
+
+
+def scanLinks(contents, pattern, first=False, chunkSize=64 * 1024):
+    """
+    Returns the (href, text) of links whose text matches pattern. With first,
+    stops parsing once a chunk of the page has produced a match.
+    """
+    scanner = AnchorScanner(pattern)
+    text = decodeHtml(contents)
+    for start in range(0, len(text), chunkSize):
+        scanner.feed(text[start:start + chunkSize])
+        if first and scanner.links:
+            return scanner.links[:1]
+    scanner.close()
+    return scanner.links
+
+
+def findCovidReportLinks(contents, indexUrl, first=False):
+    reports = []
+    for href, text in scanLinks(contents, covidReportPattern, first):
+        if href.startswith('http'):
+            reports.append((href, text))
+        else:
+            reports.append((absoluteUrl(indexUrl, href), text))
+    return reports
+
+
+def getCovidReportLinks(indexUrl):
+    """
+    Returns the (URL, link text) of every COVID report on the index page, newest
+    first.
+
+    @param indexUrl: URL of the index page of all reports.
+    """
+    return findCovidReportLinks(fetch.fetch(indexUrl), indexUrl)
+
+
 def getLatestCovidReport(indexUrl):
     """ 
     Returns the URL for the latest COVID report on MHLW.
@@ -69,17 +181,10 @@ def getLatestCovidReport(indexUrl):
     @param indexUrl: URL of the index page of all reports.
     @returns None if no report found, URL of the first report if found.
     """
-    covidReportName = '新型コロナウイルス感染症の現在の状況'
-    covidReportPattern = re.compile(covidReportName)
-    contents = urllib.request.urlopen(indexUrl).read()
-    soup = BeautifulSoup(contents, features="html.parser")
-    links = soup.find_all('a')
-    for link in links:
-        if link and link.text and covidReportPattern.search(link.text):
-            if link['href'].startswith('http'):
-                return link['href']
-            else:
-                return absoluteUrl(indexUrl, link['href'])
+    with tracing.span('report.index'):
+        reports = findCovidReportLinks(fetch.fetch(indexUrl), indexUrl, first=True)
+    if reports:
+        return reports[0][0]
     return None
 
 
@@ -93,8 +198,20 @@ def getSummaryTable(soup):
 
 
 def getReportFromUrl(reportUrl):
-    contents = urllib.request.urlopen(reportUrl).read()
-    return BeautifulSoup(contents, features="html.parser")
+    """
+    Returns the parsed report page. Parse it once and pass the result to
+    getReportDate, getSummaryTable and getPdfUrl.
+    """
+    contents = fetch.fetch(reportUrl)
+    return parseHtml(contents)
+
+
+def parseHtml(contents):
+    from bs4 import BeautifulSoup, FeatureNotFound
+    try:
+        return BeautifulSoup(contents, features='lxml')
+    except FeatureNotFound:
+        return BeautifulSoup(contents, features='html.parser')
 
 
 def getReportDate(soup):
@@ -104,10 +221,9 @@ def getReportDate(soup):
     return None
 
 
-def getPdfData(soup):
+def getPdfUrl(soup):
     prefectureRecoveryName1 = '別紙１'
     prefectureRecoveryName2 = '各都道府県の検査陽性者の状況'
-    images = soup.find_all('img')
     links = soup.find_all('a')
     pdfLink = None
     for link in links:
@@ -115,15 +231,84 @@ def getPdfData(soup):
             pdfLink = link['href']
             if not pdfLink.startswith('https://'):
                 pdfLink = 'https://www.mhlw.go.jp' + pdfLink
+    return pdfLink
+
 
+def getPdfData(soup):
+    pdfLink = getPdfUrl(soup)
     if pdfLink:
-        pdfData = urllib.request.urlopen(pdfLink).read()
+        pdfData = fetch.fetch(pdfLink)
         return pdfData
 
     return None
 
 
-def extractCasesRecoveryNumbers(pdfPath, verbose=False):
+def extractCasesRecoveryNumbers(pdfPath, verbose=False, force=False):
+    """
+    Reads the per-prefecture PDF. Results are cached by the content of the PDF
+    unless force is set.
+
+    @returns (frame, prefectureValues) where frame has the columns prefecture,
+        recovery and cases (nullable integers) and prefectureValues is the list
+        of (prefecture, recovery, cases) strings.
+    """
+    with open(pdfPath, 'rb') as f:
+        cacheKey = extraction_cache.cacheKey(
+            'casesRecoveryNumbers', '%d-%s' % (CASES_RECOVERY_EXTRACTOR_VERSION, PDF_EXTRACTOR), f.read())
+    if not force:
+        cached = extraction_cache.get(cacheKey)
+        if cached is not None:
+            print('Using cached cases and recoveries for %s' % cacheKey)
+            prefectureValues = [tuple(v) for v in cached]
+            return (casesRecoveryFrame(prefectureValues), prefectureValues)
+
+    with tracing.span('pdf.extractCasesRecoveryNumbers'):
+        frame, prefectureValues = readCasesRecoveryNumbers(pdfPath, verbose)
+    # Don't let a partial extraction stand in for the PDF on the next run.
+    if len(prefectureValues or []) == PREFECTURE_COUNT:
+        extraction_cache.put(cacheKey, prefectureValues)
+    else:
+        print('Not caching %d prefectures for %s' % (len(prefectureValues or []), cacheKey))
+    return (frame, prefectureValues)
+
+
+def extractCasesRecoveryNumbersFromData(pdfData, verbose=False, force=False):
+    """
+    Same as extractCasesRecoveryNumbers, for the PDF contents.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as temp:
+        temp.write(pdfData)
+        temp.flush()
+        return extractCasesRecoveryNumbers(temp.name, verbose, force)
+
+
+def readCasesRecoveryNumbers(pdfPath, verbose=False, extractor=None):
+    """
+    Reads the PDF with extractor (default PDF_EXTRACTOR). The text layer
+    extractor falls back to camelot if it does not recognise the layout.
+
+    @returns (frame, prefectureValues) as extractCasesRecoveryNumbers.
+    """
+    extractor = extractor or PDF_EXTRACTOR
+    if extractor == 'text':
+        with tracing.span('pdf.text') as textSpan:
+            prefectureValues = pdf_text.extractCasesRecoveryNumbers(pdfPath, verbose)
+        print('Text layer extraction: %.2fs' % textSpan.seconds)
+        if prefectureValues:
+            return (casesRecoveryFrame(prefectureValues), prefectureValues)
+        print('Falling back to camelot')
+    with tracing.span('pdf.camelot'):
+        return readCasesRecoveryNumbersWithCamelot(pdfPath, verbose)
+
+
+def readCasesRecoveryNumbersWithCamelot(pdfPath, verbose=False):
+    """
+    @returns (frame, prefectureValues) where frame is the typed result of
+        cleanCasesRecoveryTable and prefectureValues the legacy list of
+        (prefecture, recovery, cases) strings. Both are empty if the table
+        layout is not recognised.
+    """
+    import camelot
     tables = camelot.read_pdf(
         pdfPath, flavor='stream', pages='1')
 
@@ -143,39 +328,71 @@ def extractCasesRecoveryNumbers(pdfPath, verbose=False):
         if tables[0].df.loc[first_row][0] != '北海道':
             print('Unable to find first row.')
             print(tables[0].df.to_string())
-            return []
-
-    summary = tables[0].df.loc[first_row:, [0, 2, recovery_col]]
+            return (casesRecoveryFrame([]), [])
 
     if verbose:
         print(tables[0].df.to_string())
 
-    prefectureValues = []
-    for index, row in summary.iterrows():
+    frame, prefectureValues = cleanCasesRecoveryTable(
+        tables[0].df.loc[first_row:], recovery_col)
 
-        prefecture = row[0]
-        prefecture = re.sub('※[0-9]', '', prefecture)
-        prefecture = re.sub('\s', '', prefecture)
+    if verbose:
+        for prefecture, recovery, cases in prefectureValues:
+            print('%s: Recovery: %s Cases: %s' % (prefecture, recovery, cases))
 
-        cases = row[2]
-        cases = re.sub('※[0-9] ', '', cases)
-        cases = re.sub('[^0-9]+', '', cases)
+    return (frame, prefectureValues)
 
-        recovery = row[recovery_col]
-        recovery = re.sub('※[0-9] ', '', recovery)
-        recovery = re.sub('[^0-9]+', '', recovery)
 
-        if verbose:
-            print('%s: Recovery: %s Cases: %s' % (prefecture, recovery, cases))
-        prefectureValues.append((prefecture, recovery, cases))
+footnotePattern = re.compile('※[0-9]')
+footnoteSpacePattern = re.compile('※[0-9] ')
+whitespacePattern = re.compile(r'\s')
+nonDigitPattern = re.compile('[^0-9]+')
+
 
-    # Strip last two rows
-    prefectureValues = prefectureValues[:-2]
+def cleanCasesRecoveryTable(table, recovery_col):
+    """
+    Cleans up the prefecture (column 0), cases (column 2) and recovery columns
+    of a camelot table starting at the Hokkaido row. Works on whole columns at a
+    time, so several tables can be concatenated and cleaned at once.
 
-    return prefectureValues
+    @returns (frame, prefectureValues) where frame has the columns prefecture,
+        recovery and cases (nullable integers) and prefectureValues is the list
+        of (prefecture, recovery, cases) strings. The last two rows are dropped.
+    """
+    import pandas as pd
+    table = table.iloc[:-2]
+    prefectures = (table[0].str.replace(footnotePattern, '', regex=True)
+                   .str.replace(whitespacePattern, '', regex=True))
+    cases = (table[2].str.replace(footnoteSpacePattern, '', regex=True)
+             .str.replace(nonDigitPattern, '', regex=True))
+    recoveries = (table[recovery_col].str.replace(footnoteSpacePattern, '', regex=True)
+                  .str.replace(nonDigitPattern, '', regex=True))
+
+    frame = pd.DataFrame({
+        'prefecture': prefectures,
+        'recovery': pd.to_numeric(recoveries, errors='coerce').astype('Int64'),
+        'cases': pd.to_numeric(cases, errors='coerce').astype('Int64'),
+    }).reset_index(drop=True)
+    prefectureValues = list(zip(prefectures.tolist(), recoveries.tolist(), cases.tolist()))
+    return (frame, prefectureValues)
+
+
+def casesRecoveryFrame(prefectureValues):
+    """
+    Converts a list of (prefecture, recovery, cases) strings into a DataFrame
+    with integer recovery and cases columns. Empty numbers become <NA>.
+    """
+    import pandas as pd
+    frame = pd.DataFrame(prefectureValues, columns=['prefecture', 'recovery', 'cases'])
+    for column in ('recovery', 'cases'):
+        frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('Int64')
+    return frame
 
 
-def extractImageAreas(image, normalizedSize):
+def imageAreaRects():
+    """
+    Returns the rectangles to try for each value, relative to NORMALIZED_SIZE.
+    """
     # All values are relative to normalizedSize (661, 181)
     rowHeight = 18
     doubleRowHeight = 36
@@ -227,140 +444,348 @@ def extractImageAreas(image, normalizedSize):
         lastRowY + rowHeight)
 
     return {
-        'pcr': [image.crop(pcrRect)],
-        'critical': [image.crop(criticalRect), image.crop(criticalRectTall)],
-        'recoveries': [image.crop(recoveriesRect)],
-        'portRecoveries': [image.crop(portRecoveriesRect), image.crop(portRecoveriesRect2)],
-        'deaths': [image.crop(deathsRect)]
+        'pcr': [pcrRect],
+        'critical': [criticalRect, criticalRectTall],
+        'recoveries': [recoveriesRect],
+        'portRecoveries': [portRecoveriesRect, portRecoveriesRect2],
+        'deaths': [deathsRect]
     }
 
 
-def extractDailySummary(imageUrl, outputImages):
-    imageData = urllib.request.urlopen(imageUrl)
-    image = Image.open(imageData).convert(mode='RGBA')
-    image.save('original.png')
-    white = Image.new('RGBA', image.size, color='#ffffff')
-    # white.save('white.png')
-    mergedImage = Image.alpha_composite(white, image)
-    # mergedImage.save('merged.png')
-    normalizedSize = (661, 181)
-    mergedImage = mergedImage.resize(normalizedSize)
-    mergedImage = mergedImage.convert(mode='L')
-    subImages = extractImageAreas(mergedImage, normalizedSize)
+def extractImageAreas(image, normalizedSize):
+    rects = imageAreaRects()
+    return dict([(key, [image.crop(rect) for rect in rects[key]]) for key in rects])
+
+
+def locateImageAreas(image):
+    """
+    Crops each value from the first text line of the cell found by
+    table_layout, with one crop per value. Values whose cell isn't found use the fixed rectangles of
+    extractImageAreas.
+    """
+    rects = imageAreaRects()
+    # The first rectangle of each value is a single row, so its centre is
+    # inside the value's cell whether or not the cell spans two rows.
+    seeds = dict([(key, ((rects[key][0][0] + rects[key][0][2]) // 2,
+                         (rects[key][0][1] + rects[key][0][3]) // 2)) for key in rects])
+    boxes = table_layout.locateCells(image, seeds) or {}
+    subImages = {}
+    for key in rects:
+        if key in boxes:
+            # The box is tight around the text, tesseract wants some white around it.
+            from PIL import ImageOps
+            subImages[key] = [ImageOps.expand(image.crop(boxes[key]), border=OCR_CROP_BORDER, fill=255)]
+        else:
+            subImages[key] = [image.crop(rect) for rect in rects[key]]
+    return subImages
+
+
+def ocrNumber(key, i, subImage, engine=None):
+    """
+    Runs OCR on a crop of the summary table.
+
+    @returns (number or None, seconds taken)
+    """
+    engine = engine or ocr.getEngine()
+    with tracing.span('ocr.%s' % key) as ocrSpan:
+        text = ocr.recognizeCached(subImage, engine)
+    elapsed = ocrSpan.seconds
+    print('Text for %s %d: %s' % (key, i, text.strip()))
+    try:
+        numberMatch = re.search('([0-9,\$]+)', text)
+        if numberMatch:
+            # sanitize the numbers by removing , and replace $ with 5.
+            return (int(numberMatch.group(1).replace(',', '').replace('$', '5')), elapsed)
+        else:
+            print('Could not find number in %s %d: %s' % (key, i, text))
+    except ValueError as e:
+        print(e)
+    return (None, elapsed)
+
+
+def debugImageDir(outputImages):
+    """
+    outputImages is False, True (write to DEBUG_IMAGE_DIR) or a directory.
+    """
+    if not outputImages:
+        return None
+    directory = outputImages if isinstance(outputImages, str) else DEBUG_IMAGE_DIR
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def loadSummaryImage(imageFile, outputImages=False):
+    """
+    Returns the summary table image flattened onto white, resized to the size
+    extractImageAreas expects and converted to grayscale.
+
+    The image is reduced to grayscale (plus alpha) before resizing and only
+    flattened at the normalized size, so no full size RGBA copies are made.
+    """
+    from PIL import Image
+    image = Image.open(imageFile)
+    # Lets JPEGs decode at a reduced size, no-op for other formats.
+    image.draft('RGB', NORMALIZED_SIZE)
+
+    directory = debugImageDir(outputImages)
+    if directory:
+        image.save(os.path.join(directory, 'original.png'))
+
+    hasAlpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert(mode='LA' if hasAlpha else 'L')
+    image = image.resize(NORMALIZED_SIZE, reducing_gap=3.0)
+    if not hasAlpha:
+        return image
+
+    # Same as alpha compositing onto white.
+    mergedImage = Image.new('L', NORMALIZED_SIZE, color=255)
+    mergedImage.paste(image.getchannel('L'), mask=image.getchannel('A'))
+    return mergedImage
+
+
+def extractDailySummary(imageUrl, outputImages, workers=OCR_WORKERS, force=False):
+    """
+    Returns the numbers read from the summary table image at imageUrl.
+    Results are cached by the content of the image unless force or outputImages
+    is set.
+    """
+    imageData = fetch.fetch(imageUrl)
+    return extractDailySummaryFromData(imageData, outputImages, workers, force)
+
+
+def extractDailySummaryFromData(imageData, outputImages, workers=OCR_WORKERS, force=False):
+    engine = ocr.getEngine()
+    cacheKey = extraction_cache.cacheKey(
+        'dailySummary', '%d-%s' % (DAILY_SUMMARY_EXTRACTOR_VERSION, engine.name), imageData)
+    if not force and not outputImages:
+        cached = extraction_cache.get(cacheKey)
+        if cached is not None:
+            print('Using cached daily summary for %s' % cacheKey)
+            return cached
+
+    values = readDailySummary(imageData, outputImages, workers, engine)
+    missing = missingSummaryKeys(values)
+    if not missing:
+        extraction_cache.put(cacheKey, values)
+    else:
+        print('Not caching daily summary for %s, missing %s' % (cacheKey, ', '.join(missing)))
+    return values
+
+
+def missingSummaryKeys(values):
+    """
+    @returns the keys of SUMMARY_KEYS that were not read from the summary image.
+    """
+    return [key for key in SUMMARY_KEYS if values.get(key) is None]
+
+
+def readDailySummary(imageData, outputImages, workers=OCR_WORKERS, engine=None):
+    with tracing.span('image.load'):
+        mergedImage = loadSummaryImage(io.BytesIO(imageData), outputImages)
+    with tracing.span('image.locate'):
+        subImages = locateImageAreas(mergedImage)
+    directory = debugImageDir(outputImages)
+
+    # OCR all the crops at once on a pool of workers.
+    # The first crop of each key that has a number still wins.
+    start = time.time()
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for key in subImages:
+            futures[key] = []
+            for i in range(len(subImages[key])):
+                subImage = subImages[key][i]
+                if directory:
+                    subImage.save(os.path.join(directory, '%s%d.png' % (key, i)))
+                futures[key].append(executor.submit(tracing.wrap(ocrNumber), key, i, subImage, engine))
+
     values = {}
-    for key in subImages:
-        for i in range(len(subImages[key])):
-            subImage = subImages[key][i]
-            if outputImages:
-                subImage.save('%s%d.png' % (key, i))
-
-            # tesseract has trouble with 5 and $, so let it recognize both.
-            text = pytesseract.image_to_string(
-                subImage, config='--psm 6 -c tessedit_char_whitelist=$0123456789,')
-            print('Text for %s %d: %s' % (key, i, text.strip()))
-            try:
-                numberMatch = re.search('([0-9,\$]+)', text)
-                if numberMatch:
-                    # sanitize the numbers by removing , and replace $ with 5.
-                    num = int(numberMatch.group(1).replace(
-                        ',', '').replace('$', '5'))
-                    values[key] = num
-                    break
-                else:
-                    print('Could not find number in %s %d: %s' %
-                          (key, i, text))
-            except ValueError as e:
-                print(e)
-
-        # print('%s %d' % (key, num))
+    for key in futures:
+        results = [future.result() for future in futures[key]]
+        for num, elapsed in results:
+            if num is not None:
+                values[key] = num
+                break
+        print('OCR %s: %.2fs (%s)' % (key, sum([r[1] for r in results]),
+                                      ', '.join(['%.2fs' % r[1] for r in results])))
+    print('OCR total: %.2fs with %d workers, cache %s' % (
+        time.time() - start, workers, ocr.getCacheStats()))
     return values
 
 
-def writeSumByDay(sheet, valueDate, values):
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                range="'Sum By Day'!A2:G").execute()
-    if not result:
+SUM_BY_DAY_RANGE = "'Sum By Day'!A2:G"
+RECOVERIES_DATE_RANGE = "'Recoveries'!C1:C1"
+PREFECTURE_RECOVERIES_RANGE = "'Prefecture Data'!E3:E50"
+PREFECTURE_CASES_RANGE = "'Prefecture Data'!I3:I50"
+# Rows of prefectureCasesRecoveries, which the ranges above hold followed by port quarantine.
+PREFECTURE_COUNT = 47
+
+columnRangePattern = re.compile(r'^(.*)!([A-Z]+)([0-9]+):([A-Z]+)([0-9]+)$')
+
+
+def normalizeCellValue(value):
+    # Values are read back formatted, e.g. 1,234.
+    return str(value).replace(',', '').strip()
+
+
+class SheetWritePlan(object):
+    """
+    Collects the reads, structural changes and cell writes of an update to the
+    spreadsheet, so that they are sent as one values().batchGet, one
+    spreadsheets().batchUpdate and one values().batchUpdate.
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.requests = []
+        self.data = []
+        self.snapshot = {}
+        self.changes = {}
+        self.apiCalls = 0
+
+    def read(self, ranges):
+        """
+        Reads ranges into the snapshot that updateChanged() compares against.
+
+        @returns dict of range to the list of rows in that range.
+        """
+        result = self.sheet.values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=ranges).execute()
+        self.apiCalls += 1
+        valueRanges = result.get('valueRanges', [])
+        for i in range(len(valueRanges)):
+            self.snapshot[ranges[i]] = valueRanges[i].get('values', [])
+        return self.snapshot
+
+    def requireTabProperties(self, title):
+        """
+        Returns the properties of the tab named title. They are cached by sheets,
+        so this is not usually an API call, but counts one when it is.
+        """
+        tabProperties, apiCalls = sheets.loadTabProperties(self.sheet)
+        self.apiCalls += apiCalls
+        properties = tabProperties.get(title)
+        if not properties:
+            raise ValueError('Unable to find sheetId for %s tab' % title)
+        return properties
+
+    def addRequest(self, request):
+        self.requests.append(request)
+
+    def update(self, rangeString, values):
+        self.data.append({'range': rangeString, 'values': values})
+        self.changes[rangeString] = sum([len(row) for row in values])
+
+    def updateChanged(self, rangeString, values):
+        """
+        Writes only the cells of the single column rangeString that differ from
+        the snapshot, as one range per run of consecutive changed cells.
+        """
+        tab, column, startRow, endRow = columnRangePattern.match(rangeString).group(1, 2, 3, 5)
+        startRow = int(startRow)
+        if len(values) != int(endRow) - startRow + 1:
+            raise ValueError('%d values do not fit %s' % (len(values), rangeString))
+        current = self.snapshot.get(rangeString, [])
+
+        changed = []
+        for i in range(len(values)):
+            currentValue = current[i][0] if i < len(current) and current[i] else ''
+            changed.append(normalizeCellValue(currentValue) != normalizeCellValue(values[i][0]))
+
+        i = 0
+        while i < len(values):
+            if not changed[i]:
+                i += 1
+                continue
+            j = i
+            while j + 1 < len(values) and changed[j + 1]:
+                j += 1
+            self.update('%s!%s%d:%s%d' % (tab, column, startRow + i, column, startRow + j),
+                        values[i:j + 1])
+            i = j + 1
+
+        if not any(changed):
+            print('%s is unchanged' % rangeString)
+
+    def execute(self):
+        result = {'replies': [], 'updatedRanges': [], 'changes': self.changes}
+        if self.requests:
+            response = self.sheet.batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={'requests': self.requests}).execute()
+            self.apiCalls += 1
+            # Keep the cached row and column counts in step instead of fetching them again.
+            sheets.applyDimensionChanges(self.requests)
+            result['replies'] = response.get('replies', [])
+        if self.data:
+            response = self.sheet.values().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={'valueInputOption': 'USER_ENTERED', 'data': self.data}).execute()
+            self.apiCalls += 1
+            result['updatedRanges'] = [r['updatedRange'] for r in response.get('responses', [])]
+        result['apiCalls'] = self.apiCalls
+        return result
+
+
+def checkPrefectureValues(values):
+    count = len(values['prefectureCasesRecoveries'])
+    if count != PREFECTURE_COUNT:
+        raise ValueError('Expected %d prefectureCasesRecoveries, got %d' % (PREFECTURE_COUNT, count))
+    if 'portRecoveries' not in values or values['portRecoveries'] < 1:
+        raise ValueError('portRecoveries are unavailable')
+
+
+def writeSumByDay(plan, valueDate, values, currentValues):
+    if not currentValues:
         print('Error: No results')
         return False
 
-    currentValues = result.get('values', [])
     lastRow = currentValues[-1].copy()
     if lastRow[0] == valueDate:
         print('Value for today %s already exists.' % valueDate)
         return False
 
-    for v in (values['recoveries'], values['deaths'], values['critical'], values['pcr']):
+    for v in (values.get('recoveries'), values.get('deaths'), values.get('critical'), values.get('pcr')):
         if not v or v == 0:
             raise ValueError('Not all values for Sum By Day exists')
 
     todaysRow = [valueDate, '', values['recoveries'],
                  values['deaths'], values['critical'], values['pcr']]
-    rowBody = {
-        'values': [todaysRow]
-    }
-
-    return sheet.values().append(
-        spreadsheetId=SPREADSHEET_ID,
-        range="'Sum By Day'",
-        valueInputOption='USER_ENTERED',
-        body=rowBody).execute()
-
-
-def writePrefectureData(sheet, values, verbose=False):
-    # Check the values
-    if 'prefectureCasesRecoveries' not in values:
-        raise ValueError('prefectureCasesRecoveries values are unavailable')
-    if len(values['prefectureCasesRecoveries']) < 47:
-        raise ValueError('prefectureCasesRecoveries are incomplete')
-    if 'portRecoveries' not in values or values['portRecoveries'] < 1:
-        raise ValueError('portRecoveries are unavailable')
-
-    if verbose:
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                    range="'Prefecture Data'!E3:E50").execute()
-        print(result)
-
-    results = []
 
+    # The next row after the data, which starts at row 2.
+    rowNumber = len(currentValues) + 2
+    properties = plan.requireTabProperties('Sum By Day')
+    if rowNumber > properties['gridProperties']['rowCount']:
+        plan.addRequest({
+            'appendDimension': {
+                'sheetId': properties['sheetId'],
+                'dimension': 'ROWS',
+                'length': 1
+            }
+        })
+    plan.update("'Sum By Day'!A%d:F%d" % (rowNumber, rowNumber), [todaysRow])
+    return True
+
+
+def writePrefectureData(plan, values):
     todaysRecoveries = []
     for v in values['prefectureCasesRecoveries']:
         todaysRecoveries.append([v[1]])
     todaysRecoveries.append([values['portRecoveries']])
-    result = sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range="'Prefecture Data'!E3:E50",
-        valueInputOption='USER_ENTERED',
-        body={'values': todaysRecoveries}).execute()
-    results.append(result)
+    plan.updateChanged(PREFECTURE_RECOVERIES_RANGE, todaysRecoveries)
 
     # Write cases
     todaysCases = []
     for v in values['prefectureCasesRecoveries']:
         todaysCases.append([v[2]])
     todaysCases.append([values['portRecoveries']])
-    result = sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range="'Prefecture Data'!I3:I50",
-        valueInputOption='USER_ENTERED',
-        body={'values': todaysCases}).execute()
-    results.append(result)
-    return results
-
-
-def writeRecoveries(sheet, valueDate, values):
-    # Check the values
-    if 'prefectureCasesRecoveries' not in values:
-        raise ValueError('prefectureCasesRecoveries values are unavailable')
-    if len(values['prefectureCasesRecoveries']) < 47:
-        raise ValueError('prefectureCasesRecoveries are incomplete')
-    if 'portRecoveries' not in values or values['portRecoveries'] < 1:
-        raise ValueError('portRecoveries are unavailable')
+    plan.updateChanged(PREFECTURE_CASES_RANGE, todaysCases)
+    return True
 
+
+def writeRecoveries(plan, valueDate, values, currentValues):
     # check if the values have already been written.
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                range="'Recoveries'!C1:C1").execute()
-    currentValues = result.get('values', [])
-    if currentValues[0][0] == valueDate:
+    if currentValues and currentValues[0][0] == valueDate:
         print('Todays values already written in to Recoveries')
         return False
 
@@ -372,24 +797,11 @@ def writeRecoveries(sheet, valueDate, values):
     # last value is always 8 recoveries for "Unspecified"
     todaysRecoveryValues.append([8])
 
-    # Get the Sheet ID for the recoveries
-    sheetsResult = sheet.get(spreadsheetId=SPREADSHEET_ID,
-                             fields='sheets.properties').execute()
-    recoveriesSheetId = 0
-    for sheetProperty in sheetsResult['sheets']:
-        if sheetProperty['properties']['title'] == 'Recoveries':
-            recoveriesSheetId = sheetProperty['properties']['sheetId']
-            break
-
-    if not recoveriesSheetId:
-        raise ValueError('Unable to find sheetId for Recoveries tab')
-
     # Insert column into the Recoveries Sheet.
-    requests = []
-    requests.append({
+    plan.addRequest({
         'insertDimension': {
             'range': {
-                'sheetId': recoveriesSheetId,
+                'sheetId': plan.requireTabProperties('Recoveries')['sheetId'],
                 'dimension': 'COLUMNS',
                 'startIndex': 2,
                 'endIndex': 3
@@ -397,67 +809,211 @@ def writeRecoveries(sheet, valueDate, values):
             'inheritFromBefore': True
         }
     })
-    result = sheet.batchUpdate(
-        spreadsheetId=SPREADSHEET_ID,
-        body={'requests': requests}).execute()
-    print(result)
-
-    # Append values into the sheet.
-    return sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range="'Recoveries'!C1:C50",
-        valueInputOption='USER_ENTERED',
-        body={'values': todaysRecoveryValues}).execute()
+    plan.update("'Recoveries'!C1:C50", todaysRecoveryValues)
+    return True
 
 
 def writeValues(valueDate, values):
-    creds = service_account.Credentials.from_service_account_file(
-        './credentials.json', scopes=SCOPES
-    )
-    service = build('sheets', 'v4', credentials=creds)
-    sheet = service.spreadsheets()
+    """
+    Writes the values to the Sum By Day, Prefecture Data and Recoveries tabs
+    with one batched read, one structural batchUpdate (if a row or column needs
+    to be added) and one batched write of only the cells that changed.
+
+    @returns dict with the number of cells written per range in changes, the
+        number of apiCalls made and the tabs skipped because the prefecture
+        values are incomplete.
+    """
+    sheet = sheets.getSpreadsheet()
+    plan = SheetWritePlan(sheet)
+
+    # Sum By Day is still written if the prefecture PDF could not be read.
+    skipped = []
+    hasPrefectureData = 'prefectureCasesRecoveries' in values
+    if hasPrefectureData:
+        try:
+            checkPrefectureValues(values)
+        except ValueError as e:
+            print('Not writing Prefecture Data and Recoveries: %s' % e)
+            skipped = ['Prefecture Data', 'Recoveries']
+            hasPrefectureData = False
+
+    ranges = [SUM_BY_DAY_RANGE]
+    if hasPrefectureData:
+        ranges.extend([RECOVERIES_DATE_RANGE, PREFECTURE_RECOVERIES_RANGE, PREFECTURE_CASES_RANGE])
+    currentValues = plan.read(ranges)
 
     print('Writing to Sum By Day Sheet')
-    result = writeSumByDay(sheet, valueDate, values)
-    print(result)
+    writeSumByDay(plan, valueDate, values, currentValues.get(SUM_BY_DAY_RANGE))
 
-    if 'prefectureCasesRecoveries' in values:
+    if hasPrefectureData:
         print('Writing to Prefecture Data Sheet')
-        result = writePrefectureData(sheet, values)
-        print(result)
+        writePrefectureData(plan, values)
 
         print('Writing to Recoveries Sheet')
-        result = writeRecoveries(sheet, valueDate, values)
+        writeRecoveries(plan, valueDate, values, currentValues.get(RECOVERIES_DATE_RANGE))
 
+    result = plan.execute()
+    result['skipped'] = skipped
+    print('Wrote %s with %d API calls' % (', '.join(result['updatedRanges']), plan.apiCalls))
     return result
 
 
-def reportToday(writeToSpreadsheet=False):
-    reportUrl = getLatestCovidReport(DEFAULT_MHLW_INDEX_URL)
-    if not reportUrl:
-        return 'Failed to get report URL'
+def warmup():
+    """
+    Imports the dependencies of the PDF, OCR and Sheets code paths, which are
+    otherwise imported on first use.
+    """
+    import camelot
+    import pandas
+    import bs4
+    import PIL.Image
+    import pdfminer.high_level
+    import requests
+    import googleapiclient.discovery
+    import google.oauth2.service_account
+    ocr.importBackend()
+    sheets.getDiscoveryDocument()
+
+
+def initExtractionWorker(hits, misses, size):
+    """
+    Runs in each new extraction process, which starts without any of our imports.
+    """
+    # Workers count OCR cache hits and entries into the same counters as the parent.
+    ocr.shareCounters(hits, misses, size)
+    try:
+        warmup()
+    except ImportError as e:
+        print('Extraction worker warmup failed: %s' % e)
 
-    summaryValues = {}
-    print(reportUrl)
-    reportSoup = getReportFromUrl(reportUrl)
-    reportDate = getReportDate(reportSoup)
-    summaryTableUrl = absoluteUrl(reportUrl, getSummaryTable(reportSoup))
-    reportPdfData = getPdfData(reportSoup)
-    print(reportDate)
 
-    if reportPdfData:
-        with tempfile.NamedTemporaryFile(suffix='.pdf') as temp:
-            temp.write(reportPdfData)
-            casesRecoveries = extractCasesRecoveryNumbers(temp.name)
-            summaryValues['prefectureCasesRecoveries'] = casesRecoveries
+def warmupExtractionPool(wait=False):
+    """
+    Starts the extraction processes ahead of the first report, with one no-op
+    task per process so that each of them runs initExtractionWorker() now.
+    """
+    global _extractionPoolWarm
+    _extractionPoolWarm = True
+    pool = getExtractionPool()
+    futures = [pool.submit(int) for i in range(max(EXTRACTION_PROCESSES, 1))]
+    if wait:
+        concurrent.futures.wait(futures)
+
+
+def extractionPoolAfterFork(child):
+    """
+    The pool's management thread doesn't survive a fork (gunicorn --preload), so
+    a forked child starts its own pool and the parent, which only forks workers,
+    drops its copy.
+    """
+    global _extractionPool, _extractionPoolLock
+    pool, _extractionPool = _extractionPool, None
+    if child:
+        _extractionPoolLock = threading.Lock()
+        if _extractionPoolWarm:
+            threading.Thread(target=warmupExtractionPool, name='extraction-warmup', daemon=True).start()
+    elif pool is not None:
+        pool.shutdown(wait=False)
+
+
+os.register_at_fork(after_in_child=lambda: extractionPoolAfterFork(True),
+                    after_in_parent=lambda: extractionPoolAfterFork(False))
+
+
+def getExtractionPool():
+    """
+    Returns the shared pool that runs camelot and OCR. camelot is CPU-bound so
+    this is a process pool unless EXTRACTION_PROCESSES is 0.
+    """
+    global _extractionPool
+    with _extractionPoolLock:
+        if _extractionPool is None:
+            if EXTRACTION_PROCESSES > 0:
+                # Don't fork a process that is running gunicorn threads.
+                context = multiprocessing.get_context('spawn')
+                counters = (context.Value('q', 0), context.Value('q', 0), context.Value('q', 0))
+                ocr.shareCounters(*counters)
+                _extractionPool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=EXTRACTION_PROCESSES,
+                    mp_context=context,
+                    initializer=initExtractionWorker,
+                    initargs=counters)
+            else:
+                _extractionPool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        return _extractionPool
+
 
+def runReportPipeline(reportUrl, extractRecoveries=True, extractSummary=True,
+                      outputImages=False, ocrWorkers=OCR_WORKERS, force=False, verbose=False,
+                      pool=None):
+    """
+    Fetches the report at reportUrl, then downloads the prefecture PDF and the
+    summary table image and extracts them in parallel on pool (defaults to
+    getExtractionPool()).
+
+    @returns (reportDate, summaryValues, timings) where timings holds the wall
+        clock seconds of each stage.
+    """
+    timings = {}
+    start = time.time()
+    with tracing.span('report.page') as reportSpan:
+        reportSoup = getReportFromUrl(reportUrl)
+        reportDate = getReportDate(reportSoup)
+        pdfUrl = getPdfUrl(reportSoup) if extractRecoveries else None
+        summaryTableUrl = getSummaryTable(reportSoup) if extractSummary else None
     if summaryTableUrl:
-        values = extractDailySummary(summaryTableUrl, False)
+        summaryTableUrl = absoluteUrl(reportUrl, summaryTableUrl)
+    timings['report'] = reportSpan.seconds
+    print(reportDate)
+
+    summaryValues = {}
+    pool = pool or getExtractionPool()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as downloads:
+        timedFetch = tracing.wrap(tracing.timed)
+        pdfDownload = downloads.submit(timedFetch, 'report.pdfDownload', fetch.fetch, pdfUrl) if pdfUrl else None
+        imageDownload = downloads.submit(
+            timedFetch, 'report.imageDownload', fetch.fetch, summaryTableUrl) if summaryTableUrl else None
+
+        # Start each extraction as soon as its download is done.
+        pdfExtraction, imageExtraction = None, None
+        for download in concurrent.futures.as_completed([d for d in (pdfDownload, imageDownload) if d]):
+            data, elapsed = download.result()
+            if download is pdfDownload:
+                timings['pdfDownload'] = elapsed
+                pdfExtraction = pool.submit(tracing.runTraced, 'report.pdfExtraction',
+                                            extractCasesRecoveryNumbersFromData, data, verbose, force)
+            else:
+                timings['imageDownload'] = elapsed
+                imageExtraction = pool.submit(tracing.runTraced, 'report.imageExtraction',
+                                              extractDailySummaryFromData, data, outputImages, ocrWorkers, force)
+
+    # Spans from the extraction pool are recorded here, where the metrics are.
+    if pdfExtraction:
+        (frame, casesRecoveries), timings['pdfExtraction'], spans = pdfExtraction.result()
+        tracing.record(spans)
+        summaryValues['prefectureCasesRecoveries'] = casesRecoveries
+    if imageExtraction:
+        values, timings['imageExtraction'], spans = imageExtraction.result()
+        tracing.record(spans)
         summaryValues.update(values)
 
+    timings['total'] = time.time() - start
+    print('Timings: %s' % ', '.join(['%s %.2fs' % (k, v) for k, v in timings.items()]))
+    return (reportDate, summaryValues, timings)
+
+
+def reportToday(writeToSpreadsheet=False, force=False, reportUrl=None, pool=None):
+    reportUrl = reportUrl or getLatestCovidReport(DEFAULT_MHLW_INDEX_URL)
+    if not reportUrl:
+        return 'Failed to get report URL'
+
+    print(reportUrl)
+    reportDate, summaryValues, timings = runReportPipeline(reportUrl, force=force, pool=pool)
+
     writeStatus = 'Not written'
     if writeToSpreadsheet:
-        writeStatus = writeValues(reportDate, summaryValues)
+        with tracing.span('report.write'):
+            writeStatus = writeValues(reportDate, summaryValues)
 
     return 'Date: {}\nURL: {}\nWriteStatus: {}\n{}'.format(reportDate, reportUrl, writeStatus, summaryValues)
 
@@ -470,10 +1026,31 @@ if __name__ == '__main__':
     parser.add_argument('--extractSummary', action='store_true')
     parser.add_argument('--outputText', action="store_true")
     parser.add_argument('--outputImages', action="store_true")
+    parser.add_argument('--outputImagesDir',
+                        help='Directory for --outputImages (default $DEBUG_IMAGE_DIR or .)')
+    parser.add_argument('--ocrWorkers', type=int, default=OCR_WORKERS)
     parser.add_argument('--writeResults', action='store_true')
     parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--force', action='store_true',
+                        help='Ignore cached extraction results and the backfill checkpoint')
+    parser.add_argument('--backfill', metavar='FROM..TO',
+                        help='Extract every report between two dates (YYYY-MM-DD..YYYY-MM-DD)')
+    parser.add_argument('--backfillOutput', default='backfill.csv',
+                        help='CSV or .parquet file for the backfilled time series')
+    parser.add_argument('--backfillCheckpoint', default='backfill_checkpoint.jsonl')
+    parser.add_argument('--backfillWorkers', type=int, default=EXTRACTION_PROCESSES or 1)
     args = parser.parse_args()
 
+    if args.backfill:
+        import backfill
+        backfill.backfill(args.indexUrl, args.backfill,
+                          output=args.backfillOutput,
+                          checkpoint=args.backfillCheckpoint,
+                          workers=args.backfillWorkers,
+                          writeResults=args.writeResults,
+                          force=args.force)
+        sys.exit(0)
+
     reportUrl = None
     if args.reportUrl:
         reportUrl = args.reportUrl
@@ -481,29 +1058,18 @@ if __name__ == '__main__':
         reportUrl = getLatestCovidReport(args.indexUrl)
 
     reportDate = None
-    reportPdfData = None
-    summaryTableUrl = None
     summaryValues = {}
 
     if reportUrl:
         print(reportUrl)
-        reportSoup = getReportFromUrl(reportUrl)
-        reportDate = getReportDate(reportSoup)
-        summaryTableUrl = absoluteUrl(reportUrl, getSummaryTable(reportSoup))
-        reportPdfData = getPdfData(reportSoup)
-        print(reportDate)
-
-    if not args.disableExtractRecoveries:
-        if reportPdfData:
-            with tempfile.NamedTemporaryFile(suffix='.pdf') as temp:
-                temp.write(reportPdfData)
-                casesRecoveries = extractCasesRecoveryNumbers(
-                    temp.name, args.verbose)
-                summaryValues['prefectureCasesRecoveries'] = casesRecoveries
-
-    if args.extractSummary and summaryTableUrl:
-        values = extractDailySummary(summaryTableUrl, args.outputImages)
-        summaryValues.update(values)
+        reportDate, summaryValues, timings = runReportPipeline(
+            reportUrl,
+            extractRecoveries=not args.disableExtractRecoveries,
+            extractSummary=args.extractSummary,
+            outputImages=(args.outputImages and args.outputImagesDir) or args.outputImages,
+            ocrWorkers=args.ocrWorkers,
+            force=args.force,
+            verbose=args.verbose)
 
     if args.outputText and summaryValues:
         if 'prefectureCasesRecoveries' in summaryValues:
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+OCR backends for reading numbers from the MHLW summary table.
+
+- tesserocr: keeps tesseract loaded in-process and recognises PIL images
+  straight from memory. Each API instance is initialised once with PSM 6 and the
+  number whitelist and then reused.
+- pytesseract: runs the tesseract binary for every image. Used when tesserocr
+  is not installed.
+
+OCR_BACKEND selects the backend: 'tesserocr', 'pytesseract' or 'auto' (default,
+tesserocr if available).
+
+recognizeCached() skips OCR for crops that have been seen before, keyed by the
+hash of the grayscale pixels and the tesseract config. The cache keeps the
+OCR_CACHE_SIZE most recently used results per process; the hit and miss
+counters and the number of cached entries can be shared between processes with
+shareCounters().
+"""
+
+import os
+import queue
+import hashlib
+import threading
+import collections
+
+OCR_BACKEND = os.environ.get('OCR_BACKEND', 'auto')
+OCR_CACHE_SIZE = int(os.environ.get('OCR_CACHE_SIZE', 256))
+
+# tesseract has trouble with 5 and $, so let it recognize both.
+CHAR_WHITELIST = '$0123456789,'
+PAGE_SEGMENTATION_MODE = 6
+OCR_CONFIG = '--psm %d -c tessedit_char_whitelist=%s' % (
+    PAGE_SEGMENTATION_MODE, CHAR_WHITELIST)
+
+
+class PytesseractEngine(object):
+    name = 'pytesseract'
+
+    def __init__(self):
+        import pytesseract
+        self.pytesseract = pytesseract
+
+    def recognize(self, image):
+        return self.pytesseract.image_to_string(image, config=OCR_CONFIG)
+
+
+class TesserocrEngine(object):
+    """
+    Keeps a pool of initialised tesseract APIs, one per concurrent caller.
+    """
+    name = 'tesserocr'
+
+    def __init__(self):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.apis = queue.LifoQueue()
+
+    def createApi(self):
+        kwargs = {'psm': self.tesserocr.PSM(PAGE_SEGMENTATION_MODE)}
+        if os.environ.get('TESSDATA_PREFIX'):
+            kwargs['path'] = os.environ['TESSDATA_PREFIX']
+        api = self.tesserocr.PyTessBaseAPI(**kwargs)
+        api.SetVariable('tessedit_char_whitelist', CHAR_WHITELIST)
+        return api
+
+    def recognize(self, image):
+        try:
+            api = self.apis.get_nowait()
+        except queue.Empty:
+            api = self.createApi()
+        try:
+            api.SetImage(image)
+            return api.GetUTF8Text()
+        finally:
+            self.apis.put(api)
+
+
+_lock = threading.Lock()
+_engines = {}
+
+
+def importBackend(backend=None):
+    """
+    Imports the OCR library for backend without initialising tesseract.
+    """
+    backend = backend or OCR_BACKEND
+    if backend in ('tesserocr', 'auto'):
+        try:
+            import tesserocr
+            return
+        except ImportError:
+            if backend == 'tesserocr':
+                raise
+    import pytesseract
+
+
+def getEngine(backend=None):
+    """
+    Returns the shared OCR engine for backend (defaults to OCR_BACKEND).
+    """
+    backend = backend or OCR_BACKEND
+    with _lock:
+        if backend not in _engines:
+            if backend == 'tesserocr':
+                _engines[backend] = TesserocrEngine()
+            elif backend == 'pytesseract':
+                _engines[backend] = PytesseractEngine()
+            elif backend == 'auto':
+                try:
+                    _engines[backend] = TesserocrEngine()
+                except ImportError:
+                    _engines[backend] = PytesseractEngine()
+            else:
+                raise ValueError('Unknown OCR backend: %s' % backend)
+            print('Using OCR backend %s' % _engines[backend].name)
+        return _engines[backend]
+
+
+class Counter(object):
+    """
+    Same interface as multiprocessing.Value for counters used in one process.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def get_lock(self):
+        return self.lock
+
+
+_cacheLock = threading.Lock()
+_cache = collections.OrderedDict()
+_hits = Counter()
+_misses = Counter()
+# Entries in the caches of all processes sharing the counters.
+_size = Counter()
+
+
+def shareCounters(hits, misses, size):
+    """
+    Uses hits, misses and size (multiprocessing.Value) as the cache counters,
+    so that worker processes count into the same totals as their parent.
+    """
+    global _hits, _misses, _size
+    _hits, _misses, _size = hits, misses, size
+
+
+def increment(counter, amount=1):
+    with counter.get_lock():
+        counter.value += amount
+
+
+def cacheKey(image, engine):
+    if image.mode != 'L':
+        image = image.convert(mode='L')
+    digest = hashlib.sha256(image.tobytes())
+    digest.update(('%dx%d %s %s' % (image.size[0], image.size[1], engine.name, OCR_CONFIG)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def recognizeCached(image, engine=None):
+    """
+    Returns the OCR text for image, from the cache if the same pixels have been
+    recognized before with the same config.
+    """
+    engine = engine or getEngine()
+    key = cacheKey(image, engine)
+    with _cacheLock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            increment(_hits)
+            return _cache[key]
+    increment(_misses)
+
+    text = engine.recognize(image)
+    with _cacheLock:
+        added = key not in _cache
+        _cache[key] = text
+        while len(_cache) > OCR_CACHE_SIZE:
+            _cache.popitem(last=False)
+            added -= 1
+    if added:
+        increment(_size, added)
+    return text
+
+
+def clearCache():
+    with _cacheLock:
+        removed = len(_cache)
+        _cache.clear()
+    increment(_size, -removed)
+
+
+def getCacheStats():
+    """
+    @returns the hits, misses and size (number of entries) of the caches of
+        all processes sharing the counters. Each process keeps up to maxSize
+        entries.
+    """
+    return {
+        'hits': _hits.value,
+        'misses': _misses.value,
+        'size': _size.value,
+        'maxSize': OCR_CACHE_SIZE,
+    }
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Reads the per-prefecture table of the MHLW PDF from the PDF text layer.
+
+This is a lightweight alternative to running camelot in stream mode. It reads
+the position of every character on the first page with pdfminer, groups them
+into rows, and then:
+
+- finds the row starting with 北海道 and takes it and the 46 rows below it as
+  the prefecture rows.
+- finds the 退院 (recoveries) and 陽性者 (cases) headers above it and uses their
+  horizontal position to pick the number in each row.
+
+Returns the same (prefecture, recovery, cases) tuples as
+mhlw.readCasesRecoveryNumbers, or an empty list if the layout is not recognised.
+"""
+
+import re
+
+PREFECTURE_COUNT = 47
+FIRST_PREFECTURE = '北海道'
+RECOVERY_HEADER = '退院'
+CASES_HEADER = '陽性者'
+
+footnotePattern = re.compile(r'※[0-9]')
+nonDigitPattern = re.compile(r'[^0-9]+')
+
+
+class Char(object):
+    def __init__(self, text, x0, y0, x1, y1):
+        self.text = text
+        self.x0 = x0
+        self.y0 = y0
+        self.x1 = x1
+        self.y1 = y1
+
+    @property
+    def xCenter(self):
+        return (self.x0 + self.x1) / 2
+
+    @property
+    def yCenter(self):
+        return (self.y0 + self.y1) / 2
+
+    @property
+    def height(self):
+        return self.y1 - self.y0
+
+    @property
+    def width(self):
+        return self.x1 - self.x0
+
+
+def readChars(pdfPath, pageNumber=0):
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTChar, LAParams
+
+    chars = []
+
+    def collect(item):
+        if isinstance(item, LTChar):
+            if item.get_text().strip():
+                chars.append(Char(item.get_text(), item.x0, item.y0, item.x1, item.y1))
+        elif hasattr(item, '__iter__'):
+            for child in item:
+                collect(child)
+
+    for page in extract_pages(pdfPath, page_numbers=[pageNumber], laparams=LAParams()):
+        collect(page)
+    return chars
+
+
+def groupRows(chars):
+    """
+    Groups chars into rows from the top of the page down. Each row is a list of
+    chars sorted left to right.
+    """
+    rows = []
+    for char in sorted(chars, key=lambda c: -c.yCenter):
+        if rows and abs(rows[-1][0].yCenter - char.yCenter) < max(char.height, 1) * 0.4:
+            rows[-1].append(char)
+        else:
+            rows.append([char])
+    return [sorted(row, key=lambda c: c.x0) for row in rows]
+
+
+def rowText(row):
+    return ''.join([c.text for c in row])
+
+
+def findText(row, text):
+    """
+    Returns the chars of row that spell out text, or None.
+    """
+    joined = rowText(row)
+    index = joined.find(text)
+    if index < 0:
+        return None
+    return row[index:index + len(text)]
+
+
+def splitTokens(chars):
+    """
+    Splits a run of chars into tokens wherever there is a gap wider than half a
+    character.
+    """
+    tokens = []
+    for char in chars:
+        if tokens and char.x0 - tokens[-1][-1].x1 < char.width * 0.5:
+            tokens[-1].append(char)
+        else:
+            tokens.append([char])
+    return tokens
+
+
+def pickNumber(tokens, column):
+    """
+    Returns the digits of the numeric token that lines up with the column
+    header, preferring the most horizontal overlap and then the closest center.
+    """
+    columnLeft, columnRight = column[0].x0, column[-1].x1
+    columnCenter = (columnLeft + columnRight) / 2
+
+    def score(token):
+        overlap = min(token[-1].x1, columnRight) - max(token[0].x0, columnLeft)
+        center = (token[0].x0 + token[-1].x1) / 2
+        return (max(overlap, 0), -abs(center - columnCenter))
+
+    numbers = [t for t in tokens if re.search('[0-9]', nonFootnoteText(t))]
+    if not numbers:
+        return ''
+    best = max(numbers, key=score)
+    return nonDigitPattern.sub('', nonFootnoteText(best))
+
+
+def nonFootnoteText(token):
+    return footnotePattern.sub('', rowText(token))
+
+
+def extractCasesRecoveryNumbers(pdfPath, verbose=False):
+    rows = groupRows(readChars(pdfPath))
+
+    firstRow = None
+    for i in range(len(rows)):
+        if footnotePattern.sub('', rowText(rows[i])).startswith(FIRST_PREFECTURE):
+            firstRow = i
+            break
+    if firstRow is None:
+        print('Unable to find first row.')
+        return []
+
+    recoveryColumn, casesColumn = None, None
+    for row in rows[:firstRow]:
+        recoveryColumn = recoveryColumn or findText(row, RECOVERY_HEADER)
+        casesColumn = casesColumn or findText(row, CASES_HEADER)
+    if not recoveryColumn or not casesColumn:
+        print('Unable to find the recovery or cases header.')
+        return []
+
+    # Prefecture names are at most three characters, as wide as 北海道.
+    hokkaido = findText(rows[firstRow], FIRST_PREFECTURE)
+    prefectureRight = hokkaido[-1].x1 + hokkaido[-1].width * 0.5
+
+    prefectureValues = []
+    for row in rows[firstRow:]:
+        prefectureChars = [c for c in row if c.x1 <= prefectureRight]
+        rest = [c for c in row if c.x1 > prefectureRight]
+        # A footnote marker (宮城※1) sticks out past 北海道 but belongs to the name.
+        while prefectureChars and rest and rest[0].x0 - prefectureChars[-1].x1 < rest[0].width * 0.5:
+            prefectureChars.append(rest.pop(0))
+        prefecture = re.sub(r'\s', '', nonFootnoteText(prefectureChars))
+        if not prefecture:
+            continue
+        tokens = splitTokens(rest)
+        recovery = pickNumber(tokens, recoveryColumn)
+        cases = pickNumber(tokens, casesColumn)
+        if verbose:
+            print('%s: Recovery: %s Cases: %s' % (prefecture, recovery, cases))
+        prefectureValues.append((prefecture, recovery, cases))
+        if len(prefectureValues) == PREFECTURE_COUNT:
+            break
+
+    if len(prefectureValues) < PREFECTURE_COUNT:
+        print('Only found %d prefecture rows.' % len(prefectureValues))
+        return []
+    return prefectureValues
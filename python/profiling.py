@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of single requests.
+
+When PROFILE_DIR is set, the routes that support it accept ?profile=1. The
+request is run under a sampling profiler and everything it fetches or reads
+from the spreadsheet is recorded, in a new directory under PROFILE_DIR:
+
+  profile.speedscope.json  samples of every thread, open with speedscope.app
+  inputs/                  the fetched pages, PDFs and images (see fetch.py)
+                           and the Sheets requests in sheets.json (see sheets.py)
+  manifest.json            route, arguments, duration, inputs and top frames
+
+The profiler samples the stacks of all threads every PROFILE_INTERVAL seconds,
+so it also sees the download and OCR threads, but not other processes. Other
+requests running at the same time show up in the samples and the recording.
+
+To replay a run offline, with the arguments from its manifest:
+FETCH_REPLAY_DIR=profiles/<run>/inputs python3 mhlw.py --extractSummary --force
+SHEETS_REPLAY_DIR=profiles/<run>/inputs python3 sync_patients.py Tokyo --cases 3 --date 2020-05-01
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import datetime
+import threading
+import collections
+
+import fetch
+import sheets
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+# Frames listed in the manifest, by the number of samples they were on top of.
+MANIFEST_TOP_FRAMES = 20
+
+
+class SamplingProfiler(object):
+    """
+    Samples the Python stacks of all threads from a background thread.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.frames = []
+        self.frameIndexes = {}
+        # Thread id to [(stack of frame indexes, seconds)].
+        self.samples = collections.defaultdict(list)
+        self.threadNames = {}
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+        self.started = None
+        self.seconds = None
+
+    def frameIndex(self, frame):
+        code = frame.f_code
+        key = (code.co_filename, code.co_firstlineno, code.co_name)
+        index = self.frameIndexes.get(key)
+        if index is None:
+            index = self.frameIndexes[key] = len(self.frames)
+            self.frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+        return index
+
+    def sample(self, elapsed):
+        ownId = threading.get_ident()
+        for threadId, frame in sys._current_frames().items():
+            if threadId == ownId:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frameIndex(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples[threadId].append((stack, elapsed))
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopEvent.wait(self.interval):
+            now = time.perf_counter()
+            self.sample(now - last)
+            last = now
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+        self.seconds = time.perf_counter() - self.started
+        for thread in threading.enumerate():
+            self.threadNames[thread.ident] = thread.name
+
+    def toSpeedscope(self, name):
+        profiles = []
+        for threadId in sorted(self.samples):
+            samples = self.samples[threadId]
+            profiles.append({
+                'type': 'sampled',
+                'name': self.threadNames.get(threadId, 'thread %d' % threadId),
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum([s[1] for s in samples]),
+                'samples': [s[0] for s in samples],
+                'weights': [s[1] for s in samples],
+            })
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'covid19japan profiling',
+            'shared': {'frames': self.frames},
+            'profiles': profiles,
+        }
+
+    def topFrames(self, count=MANIFEST_TOP_FRAMES):
+        seconds = collections.Counter()
+        for threadId in self.samples:
+            for stack, elapsed in self.samples[threadId]:
+                if stack:
+                    seconds[stack[-1]] += elapsed
+        return [{'frame': '%(name)s %(file)s:%(line)d' % self.frames[index], 'seconds': round(s, 4)}
+                for index, s in seconds.most_common(count)]
+
+
+def isEnabled(requested):
+    return bool(PROFILE_DIR) and requested
+
+
+class ProfiledRun(object):
+    """
+    Profiles and records the inputs of the code run inside the with block.
+    """
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+        self.startedAt = datetime.datetime.now()
+        runId = '%s-%s-%s' % (self.startedAt.strftime('%Y%m%d-%H%M%S'),
+                              name.replace('/', '_'), uuid.uuid4().hex[:6])
+        self.directory = os.path.join(PROFILE_DIR, runId)
+        self.profiler = SamplingProfiler()
+        self.recorder = None
+        self.sheetsRecorder = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.recorder = fetch.startRecording(os.path.join(self.directory, 'inputs'))
+        self.sheetsRecorder = sheets.startRecording(os.path.join(self.directory, 'inputs'))
+        self.profiler.start()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.profiler.stop()
+        fetch.stopRecording(self.recorder)
+        sheets.stopRecording(self.sheetsRecorder)
+
+        with open(os.path.join(self.directory, 'profile.speedscope.json'), 'w') as f:
+            json.dump(self.profiler.toSpeedscope(self.name), f)
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump({
+                'name': self.name,
+                'arguments': self.arguments,
+                'started': self.startedAt.isoformat(timespec='seconds'),
+                'seconds': round(self.profiler.seconds, 4),
+                'interval': self.profiler.interval,
+                'error': repr(excValue) if excValue else None,
+                'inputs': self.recorder.inputs,
+                'sheetsRequests': len(self.sheetsRecorder.calls),
+                'topFrames': self.profiler.topFrames(),
+            }, f, indent=2, sort_keys=True)
+        print('Wrote profile of %s to %s' % (self.name, self.directory))
+        return False
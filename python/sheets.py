@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Shared Google Sheets client for the COVID19Japan spreadsheet.
+
+Credentials and the Sheets v4 discovery document are loaded once per process.
+The discovery document is read from SHEETS_DISCOVERY_DOCUMENT if it exists on
+disk, otherwise the copy bundled with google-api-python-client is used, so
+building a client never has to fetch it over the network.
+
+httplib2 (used underneath googleapiclient) is not thread-safe, so each thread
+gets its own service object built from the shared credentials and document.
+
+Tab properties (title, sheetId, gridProperties) are cached for
+SHEETS_TAB_PROPERTIES_TTL seconds. Call applyDimensionChanges() with the
+requests of a batchUpdate that added rows or columns, or
+invalidateTabProperties() after any other change to the structure of the
+spreadsheet.
+
+Every request made through getSpreadsheet() is timed and counted by tracing.
+
+SHEETS_BACKEND=fake uses the in-memory fake_sheets stand-in instead of the
+live spreadsheet.
+
+startRecording() saves every request and its response to SHEETS_INPUTS, for
+profiled runs (see profiling.py). Pointing SHEETS_REPLAY_DIR at such a
+directory answers the same requests, in the same order, from the recording
+instead of the live spreadsheet, so nothing is written.
+"""
+
+import os
+import copy
+import json
+import threading
+import time
+
+import tracing
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+SPREADSHEET_ID = '1vkw_Lku7F_F3F_iNmFFrDq9j7-tQ6EmZPOLpLt-s3TY'
+
+CREDENTIALS_PATH = os.environ.get('SHEETS_CREDENTIALS', './credentials.json')
+DISCOVERY_DOCUMENT_PATH = os.environ.get(
+    'SHEETS_DISCOVERY_DOCUMENT', './sheets_discovery.json')
+TAB_PROPERTIES_TTL = float(os.environ.get('SHEETS_TAB_PROPERTIES_TTL', 300))
+SHEETS_BACKEND = os.environ.get('SHEETS_BACKEND', 'google')
+SHEETS_REPLAY_DIR = os.environ.get('SHEETS_REPLAY_DIR', '')
+SHEETS_INPUTS = 'sheets.json'
+
+_lock = threading.Lock()
+_local = threading.local()
+_credentials = None
+_discoveryDocument = None
+# Spreadsheet resource shared by all threads, set by setSpreadsheet().
+_spreadsheet = None
+
+_tabPropertiesLock = threading.Lock()
+_tabProperties = {}
+_tabPropertiesFetchedAt = 0
+
+
+def getCredentials():
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            from google.oauth2 import service_account
+            _credentials = service_account.Credentials.from_service_account_file(
+                CREDENTIALS_PATH, scopes=SCOPES)
+        return _credentials
+
+
+def getDiscoveryDocument():
+    """
+    Returns the Sheets v4 discovery document as a string, or None if neither
+    an on-disk nor a bundled copy is available.
+    """
+    global _discoveryDocument
+    with _lock:
+        if _discoveryDocument is None:
+            if os.path.exists(DISCOVERY_DOCUMENT_PATH):
+                with open(DISCOVERY_DOCUMENT_PATH, encoding='utf-8') as f:
+                    _discoveryDocument = f.read()
+            else:
+                from googleapiclient.discovery_cache import get_static_doc
+                _discoveryDocument = get_static_doc('sheets', 'v4')
+        return _discoveryDocument
+
+
+def buildService():
+    from googleapiclient.discovery import build, build_from_document
+
+    creds = getCredentials()
+    document = getDiscoveryDocument()
+    if document:
+        return build_from_document(document, credentials=creds)
+    return build('sheets', 'v4', credentials=creds, cache_discovery=False)
+
+
+def getSpreadsheet():
+    """
+    Returns the spreadsheets() resource for the calling thread.
+    """
+    if _spreadsheet is None and SHEETS_REPLAY_DIR:
+        setSpreadsheet(ReplaySpreadsheet.load(SHEETS_REPLAY_DIR))
+    elif _spreadsheet is None and SHEETS_BACKEND == 'fake':
+        import fake_sheets
+        setSpreadsheet(fake_sheets.getFakeSpreadsheet())
+    if _spreadsheet is not None:
+        return _spreadsheet
+
+    sheet = getattr(_local, 'sheet', None)
+    if sheet is None:
+        sheet = tracing.traceSpreadsheet(buildService().spreadsheets())
+        _local.sheet = sheet
+    return sheet
+
+
+def setSpreadsheet(sheet):
+    """
+    Uses sheet (an object with the spreadsheets() interface, such as a
+    fake_sheets.FakeSpreadsheet) for every thread, or the live spreadsheet
+    again if sheet is None.
+    """
+    global _spreadsheet
+    _spreadsheet = tracing.traceSpreadsheet(sheet) if sheet is not None else None
+    invalidateTabProperties()
+
+
+def loadTabProperties(sheet=None, refresh=False):
+    """
+    @returns (dict of tab title to tab properties, number of API calls made),
+        fetching the properties from the spreadsheet if the cached copy is
+        missing or older than the TTL.
+    """
+    global _tabProperties, _tabPropertiesFetchedAt
+    with _tabPropertiesLock:
+        age = time.time() - _tabPropertiesFetchedAt
+        if not refresh and _tabProperties and age <= TAB_PROPERTIES_TTL:
+            return (_tabProperties, 0)
+        if sheet is None:
+            sheet = getSpreadsheet()
+        sheetsResult = sheet.get(spreadsheetId=SPREADSHEET_ID,
+                                 fields='sheets.properties').execute()
+        _tabProperties = {}
+        for sheetProperty in sheetsResult['sheets']:
+            properties = sheetProperty['properties']
+            _tabProperties[properties['title']] = properties
+        _tabPropertiesFetchedAt = time.time()
+        return (_tabProperties, 1)
+
+
+def getAllTabProperties(sheet=None, refresh=False):
+    """
+    Returns a dict of tab title to tab properties, see loadTabProperties().
+    """
+    return loadTabProperties(sheet, refresh)[0]
+
+
+def getTabProperties(title, sheet=None, refresh=False):
+    """
+    Returns the properties of the tab named title or None if it does not exist.
+    """
+    return getAllTabProperties(sheet, refresh).get(title)
+
+
+def applyDimensionChanges(requests):
+    """
+    Updates the cached gridProperties for the appendDimension and
+    insertDimension requests of a batchUpdate that was sent, so the next
+    lookup doesn't have to fetch the tab properties again. Any other request
+    drops the cache.
+    """
+    with _tabPropertiesLock:
+        bySheetId = dict([(p['sheetId'], p) for p in _tabProperties.values()])
+        for request in requests:
+            if 'appendDimension' in request:
+                change = request['appendDimension']
+                sheetId, dimension, length = change['sheetId'], change['dimension'], change['length']
+            elif 'insertDimension' in request:
+                change = request['insertDimension']['range']
+                sheetId, dimension = change['sheetId'], change['dimension']
+                length = change['endIndex'] - change['startIndex']
+            else:
+                bySheetId = None
+                break
+            properties = bySheetId.get(sheetId)
+            if properties:
+                key = 'rowCount' if dimension == 'ROWS' else 'columnCount'
+                gridProperties = properties.setdefault('gridProperties', {})
+                gridProperties[key] = gridProperties.get(key, 0) + length
+    if bySheetId is None:
+        invalidateTabProperties()
+
+
+def invalidateTabProperties():
+    global _tabProperties, _tabPropertiesFetchedAt
+    with _tabPropertiesLock:
+        _tabProperties = {}
+        _tabPropertiesFetchedAt = 0
+
+
+def requestParams(params):
+    """
+    Returns the parameters of a request as they are recorded, without the
+    spreadsheetId and with tuples as lists.
+    """
+    return json.loads(json.dumps(dict([(k, v) for k, v in params.items() if k != 'spreadsheetId']),
+                                 sort_keys=True))
+
+
+class SheetsRecorder(object):
+    """
+    Saves the requests made through getSpreadsheet() and their responses. The
+    list is written to SHEETS_INPUTS in directory by close().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.calls = []
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, method, params, response):
+        with self.lock:
+            self.calls.append({'method': method, 'params': requestParams(params), 'response': response})
+
+    def close(self):
+        with self.lock:
+            with open(os.path.join(self.directory, SHEETS_INPUTS), 'w') as f:
+                json.dump(self.calls, f, indent=2)
+
+
+def startRecording(directory):
+    """
+    Records every request from now on (by any thread) to directory. The tab
+    properties are dropped so that the recording includes fetching them.
+
+    @returns the SheetsRecorder to pass to stopRecording().
+    """
+    recorder = SheetsRecorder(directory)
+    invalidateTabProperties()
+    tracing.addSheetsListener(recorder.save)
+    return recorder
+
+
+def stopRecording(recorder):
+    """
+    Stops recording and writes the recorder's SHEETS_INPUTS.
+    """
+    tracing.removeSheetsListener(recorder.save)
+    recorder.close()
+
+
+class ReplayRequest(object):
+    def __init__(self, spreadsheet, method, params):
+        self.spreadsheet = spreadsheet
+        self.method = method
+        self.params = requestParams(params)
+
+    def execute(self):
+        return self.spreadsheet.answer(self.method, self.params)
+
+
+class ReplayResource(object):
+    def __init__(self, spreadsheet, prefix):
+        self.spreadsheet = spreadsheet
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        # Resources have no execute(), tracing tells them from requests by it.
+        if name == 'execute' or name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            # Requests always name the spreadsheet, values() doesn't.
+            if kwargs:
+                return ReplayRequest(self.spreadsheet, self.prefix + name, kwargs)
+            return ReplayResource(self.spreadsheet, '%s%s.' % (self.prefix, name))
+        return call
+
+
+class ReplaySpreadsheet(ReplayResource):
+    """
+    Answers each request with the response of the first unused recorded call
+    with the same method and parameters.
+    """
+
+    def __init__(self, calls, directory=''):
+        ReplayResource.__init__(self, self, '')
+        self.calls = calls
+        self.used = [False] * len(calls)
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, SHEETS_INPUTS)) as f:
+            return cls(json.load(f), directory)
+
+    def answer(self, method, params):
+        with self.lock:
+            for i in range(len(self.calls)):
+                call = self.calls[i]
+                if not self.used[i] and call['method'] == method and call['params'] == params:
+                    self.used[i] = True
+                    return copy.deepcopy(call['response'])
+        raise KeyError('%s %s was not recorded in %s' % (method, json.dumps(params), self.directory))
@@ -15,13 +15,11 @@ import argparse
 import pprint
 import datetime
 import urllib.parse
+import threading
+import time
 
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-SPREADSHEET_ID = '1vkw_Lku7F_F3F_iNmFFrDq9j7-tQ6EmZPOLpLt-s3TY'
+import sheets
+from sheets import SCOPES, SPREADSHEET_ID
 
 PREFECTURE_PREFIX = {
   "Aichi": "AC",
@@ -74,16 +72,122 @@ PREFECTURE_PREFIX = {
   "Port Quarantine": "PRT"
 }
 
-def getRecentPatientRows(sheet, tabProperties):
-  rowsToFetch = 100
-  totalRows = tabProperties['gridProperties']['rowCount']
+# Columns of the patient tabs.
+PATIENT_ID_COL = 0
+DATE_COL = 3
+PREFECTURE_COL = 9
+STATUS_COL = 10
+COUNT_COL = 11
+COUNT_COL_A1 = 'L'
+
+# Seconds before a PatientRowIndex is rebuilt from scratch, to pick up edits by hand.
+PATIENT_ROW_INDEX_TTL = 60 * 60
 
-  getFromRow = totalRows - rowsToFetch
+def indexKey(prefecture, date, deceased):
+  return (date, prefecture, 'Deceased' if deceased else '')
+
+def parseCountRow(row):
+  """
+  Returns ((date, prefecture, status), count) for a count row of a patient tab,
+  or None if the row has no count.
+  """
+  if len(row) > COUNT_COL and row[DATE_COL] and row[PREFECTURE_COL]:
+    try:
+      count = int(str(row[COUNT_COL]).replace(',', ''))
+    except ValueError:
+      return None
+    return (row[DATE_COL], row[PREFECTURE_COL], row[STATUS_COL]), count
+  return None
+
+class PatientRowIndex(object):
+  """
+  Index of the count rows of a patient tab, keyed by (date, prefecture, status)
+  where status is 'Deceased' or ''.
 
-  rows = sheet.values().get(spreadsheetId=SPREADSHEET_ID, 
-      range="'%s'!A%d:L" % (tabProperties['title'], getFromRow)).execute()
+  The index is built by reading the whole tab once. After that, refresh() only
+  reads the rows added since the last row we saw, and our own writes update the
+  index in place. Hold lock while doing a read-modify-write on the tab.
+  """
 
-  return {'startRow': getFromRow, 'rows': rows['values']}
+  def __init__(self, title):
+    self.title = title
+    self.lock = threading.RLock()
+    self.rows = {}
+    self.lastRow = 0
+    self.builtAt = 0
+
+  def addRows(self, startRow, rows):
+    for i in range(len(rows)):
+      parsed = parseCountRow(rows[i])
+      if parsed and parsed[0] not in self.rows:
+        self.rows[parsed[0]] = [startRow + i, parsed[1]]
+    self.lastRow = max(self.lastRow, startRow + len(rows) - 1)
+
+  def build(self, sheet):
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
+        range="'%s'!A1:L" % self.title).execute()
+    self.rows = {}
+    self.lastRow = 0
+    self.addRows(1, result.get('values', []))
+    self.builtAt = time.time()
+
+  def refresh(self, sheet, keys=()):
+    """
+    Brings the index up to date with the tab. Only reads from the last row we know
+    about, so the request stays valid even if nobody added any rows.
+
+    keys are the (date, prefecture, status) of rows that are about to be updated in
+    place. Their rows are read in the same request, and if one no longer holds its
+    key, because rows were inserted, removed or sorted above the last row, the index
+    is rebuilt.
+    """
+    if not self.builtAt or self.lastRow < 1 or time.time() - self.builtAt > PATIENT_ROW_INDEX_TTL:
+      return self.build(sheet)
+
+    checks = [(key, self.rows[key][0]) for key in keys if key in self.rows]
+    ranges = ["'%s'!A%d:L" % (self.title, self.lastRow)]
+    ranges.extend(["'%s'!A%d:L%d" % (self.title, rowNumber, rowNumber) for key, rowNumber in checks])
+    result = sheet.values().batchGet(spreadsheetId=SPREADSHEET_ID, ranges=ranges).execute()
+    valueRanges = result.get('valueRanges', [])
+    rows = valueRanges[0].get('values', []) if valueRanges else []
+    if not rows:
+      # Rows were removed from the end of the tab, start over.
+      return self.build(sheet)
+
+    for (key, rowNumber), valueRange in zip(checks, valueRanges[1:]):
+      parsed = parseCountRow((valueRange.get('values') or [[]])[0])
+      if not parsed or parsed[0] != key:
+        print('Row %d of %s no longer holds %s, rebuilding the index' % (rowNumber, self.title, key))
+        return self.build(sheet)
+      # Pick up counts edited by hand.
+      self.rows[key][1] = parsed[1]
+    self.addRows(self.lastRow + 1, rows[1:])
+
+  def find(self, prefecture, date, deceased):
+    """
+    Returns [rowNumber, count] for the count row or None if there is no such row.
+    """
+    return self.rows.get(indexKey(prefecture, date, deceased))
+
+  def addAppendResult(self, result):
+    updatedRange = result.get('updates', {}).get('updatedRange', '')
+    rangeMatch = re.search(r'![A-Z]+([0-9]+)', updatedRange)
+    updatedData = result.get('updates', {}).get('updatedData', {})
+    if rangeMatch and 'values' in updatedData:
+      self.addRows(int(rangeMatch.group(1)), updatedData['values'])
+
+
+_patientRowIndexesLock = threading.Lock()
+_patientRowIndexes = {}
+
+def getPatientRowIndex(title):
+  with _patientRowIndexesLock:
+    if title not in _patientRowIndexes:
+      _patientRowIndexes[title] = PatientRowIndex(title)
+    return _patientRowIndexes[title]
+
+def countRange(tabProperties, rowNumber):
+  return "'%s'!%s%d:%s%d" % (tabProperties['title'], COUNT_COL_A1, rowNumber, COUNT_COL_A1, rowNumber)
 
 def updatePatientCountForDate(sheet, tabProperties, prefecture, date, cases, deceased, source):
   """
@@ -94,69 +198,124 @@ def updatePatientCountForDate(sheet, tabProperties, prefecture, date, cases, dec
 
   This assumes the row is using the countFormat.
   """
-  result = getRecentPatientRows(sheet, tabProperties)
-
-  # Find existing row that we already added.
-  PATIENT_ID_COL = 0
-  DATE_COL = 3
-  PREFECTURE_COL = 9
-  STATUS_COL = 10
-  COUNT_COL = 11
-  COUNT_COL_A1 = 'L'
-  foundRow = False
-  for i in range(0, len(result['rows'])):
-    rowNumber = result['startRow'] + i
-    row = result['rows'][i]
-
-    if len(row) > PREFECTURE_COL and row[DATE_COL] == date and row[PREFECTURE_COL] == prefecture:
-      isDeceased = row[STATUS_COL] == 'Deceased'
-      if deceased and isDeceased:
-        foundRow = True
-      if not deceased and row[STATUS_COL] == '':
-        foundRow = True
-      
-    if foundRow:
+  index = getPatientRowIndex(tabProperties['title'])
+  with index.lock:
+    index.refresh(sheet, [indexKey(prefecture, date, deceased)])
+
+    # Find existing row that we already added.
+    existing = index.find(prefecture, date, deceased)
+    if existing:
+      rowNumber, existingCount = existing
       count = deceased if deceased else cases
-      if int(row[COUNT_COL]) == count:
-        print('Found row but the count was identical: %s %s' % (prefecture, row[COUNT_COL]))
+      if existingCount == count:
+        print('Found row but the count was identical: %s %s' % (prefecture, existingCount))
         return
       else:
         # update the count with the new number
-        rangeString= "'%s'!%s%d:%s%d" % (tabProperties['title'], COUNT_COL_A1, rowNumber, COUNT_COL_A1, rowNumber)
+        rangeString = countRange(tabProperties, rowNumber)
         print(rangeString)
         result = sheet.values().update(
           spreadsheetId=SPREADSHEET_ID, 
           range=rangeString,
           valueInputOption='USER_ENTERED',
           body = {'values': [[count]]}).execute()
+        existing[1] = count
         return result
 
-  # if we get here, we didn't find the row, so we'll have to append a row.
-  patientNumberPrefix, lastPatientNumber = PREFECTURE_PREFIX[prefecture], int(date.replace('-', ''))
-  return appendRows(sheet, tabProperties, prefecture, date, 
-      cases = cases,
-      deceased = deceased, 
-      source = source, 
-      patientNumberPrefix = patientNumberPrefix, 
-      lastPatientNumber = lastPatientNumber,
-      useCountColumn = True)
+    # if we get here, we didn't find the row, so we'll have to append a row.
+    patientNumberPrefix, lastPatientNumber = PREFECTURE_PREFIX[prefecture], int(date.replace('-', ''))
+    return appendRows(sheet, tabProperties, prefecture, date, 
+        cases = cases,
+        deceased = deceased, 
+        source = source, 
+        patientNumberPrefix = patientNumberPrefix, 
+        lastPatientNumber = lastPatientNumber,
+        useCountColumn = True)
 
-def getPatientNumberColumn(sheet, tabProperties):
-  patientNumbers = sheet.values().get(spreadsheetId=SPREADSHEET_ID, 
-      range="'%s'!A:A" % (tabProperties['title'])).execute()
+# Rows read from the end of the tab when looking for the last patient number.
+PATIENT_NUMBER_TAIL_ROWS = 50
+
+_lastPatientNumbersLock = threading.Lock()
+# Tab title to (row number, patient number) of the last patient number we saw.
+_lastPatientNumbers = {}
 
-  patientNumbers = [row[0] for row in patientNumbers['values'] if row[0] != 'Existing']
-  lastPatientNumber = patientNumbers[-1]
+def clearCaches():
+  """
+  Forgets the row indexes and last patient numbers, e.g. after switching spreadsheets.
+  """
+  with _patientRowIndexesLock:
+    _patientRowIndexes.clear()
+  with _lastPatientNumbersLock:
+    _lastPatientNumbers.clear()
 
-  isAlphaNumericPattern = re.match('([^\d]+)([0-9]+)', lastPatientNumber)
+def parsePatientNumber(patientNumber):
+  isAlphaNumericPattern = re.match('([^\d]+)([0-9]+)', patientNumber)
   if isAlphaNumericPattern:
     return (isAlphaNumericPattern.group(1), int(isAlphaNumericPattern.group(2)))
-  return ('', int(lastPatientNumber))
+  return ('', int(patientNumber))
 
-def appendRows(sheet, tabProperties, prefecture, date, cases=0, deceased=0, source='', patientNumberPrefix='', lastPatientNumber=0, useCountColumn=False):
+def rememberPatientNumber(title, startRow, column):
+  """
+  Caches the last patient number in column, a list of rows of column A that
+  starts at startRow.
+
+  Returns (prefix, number) or None if column has no patient numbers.
+  """
+  for i in range(len(column) - 1, -1, -1):
+    if column[i] and column[i][0] and column[i][0] != 'Existing':
+      try:
+        lastPatientNumber = parsePatientNumber(column[i][0])
+      except ValueError:
+        continue
+      with _lastPatientNumbersLock:
+        _lastPatientNumbers[title] = (startRow + i, column[i][0])
+      return lastPatientNumber
+  with _lastPatientNumbersLock:
+    _lastPatientNumbers.pop(title, None)
+  return None
+
+def getPatientNumberColumn(sheet, tabProperties):
+  """
+  Returns (prefix, number) of the last patient number in the tab.
+
+  Only the last PATIENT_NUMBER_TAIL_ROWS rows of column A are read, widening
+  backwards if they are all 'Existing'. The row of the result is cached per tab
+  and advanced by appendPatientRows. Later calls only read column A from that
+  row down, which picks up rows added by hand or by other instances, and fall
+  back to the full search if the cached row no longer holds the same number.
+  """
+  title = tabProperties['title']
+  with _lastPatientNumbersLock:
+    cached = _lastPatientNumbers.get(title)
+  if cached:
+    rowNumber, patientNumber = cached
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
+        range="'%s'!A%d:A" % (title, rowNumber)).execute()
+    column = result.get('values', [])
+    if column and column[0] and column[0][0] == patientNumber:
+      return rememberPatientNumber(title, rowNumber, column)
+    print('Last patient number of %s changed, searching again' % title)
+
+  # The cached rowCount may be out of date, so fetch it again.
+  tabProperties = sheets.getTabProperties(title, sheet, refresh=True)
+  totalRows = tabProperties['gridProperties']['rowCount']
+  rowsToFetch = PATIENT_NUMBER_TAIL_ROWS
+  toRow = totalRows
+  while toRow >= 1:
+    fromRow = max(1, toRow - rowsToFetch + 1)
+    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, 
+        range="'%s'!A%d:A%d" % (title, fromRow, toRow)).execute()
+    lastPatientNumber = rememberPatientNumber(title, fromRow, result.get('values', []))
+    if lastPatientNumber:
+      return lastPatientNumber
+    toRow = fromRow - 1
+    rowsToFetch *= 4
+
+  raise ValueError('Unable to find a patient number in %s' % title)
+
+def makePatientRows(prefecture, date, cases=0, deceased=0, source='', patientNumberPrefix='', lastPatientNumber=0, useCountColumn=False):
   patientNumber = lastPatientNumber
   rows = []
-  deceasedValue =  'Deceased' if deceased else ''
 
   if useCountColumn:
     rows.append([
@@ -196,8 +355,10 @@ def appendRows(sheet, tabProperties, prefecture, date, cases=0, deceased=0, sour
         source
       ])
     pprint.pprint(rows)
+  return rows
 
-  return sheet.values().append(
+def appendPatientRows(sheet, tabProperties, rows):
+  result = sheet.values().append(
     spreadsheetId=SPREADSHEET_ID, 
     range="'%s'!A:E" % (tabProperties['title']),
     valueInputOption='USER_ENTERED',
@@ -206,6 +367,27 @@ def appendRows(sheet, tabProperties, prefecture, date, cases=0, deceased=0, sour
     responseValueRenderOption='FORMATTED_VALUE',
     body={'majorDimension': 'ROWS', 'values': rows}).execute()
 
+  rangeMatch = re.search(r'![A-Z]+([0-9]+)', result.get('updates', {}).get('updatedRange', ''))
+  if rangeMatch and [row for row in rows if row[PATIENT_ID_COL] != 'Existing']:
+    rememberPatientNumber(tabProperties['title'], int(rangeMatch.group(1)),
+        [[row[PATIENT_ID_COL]] for row in rows])
+
+  index = _patientRowIndexes.get(tabProperties['title'])
+  if index and index.builtAt:
+    with index.lock:
+      index.addAppendResult(result)
+  return result
+
+def appendRows(sheet, tabProperties, prefecture, date, cases=0, deceased=0, source='', patientNumberPrefix='', lastPatientNumber=0, useCountColumn=False):
+  rows = makePatientRows(prefecture, date,
+      cases = cases,
+      deceased = deceased,
+      source = source,
+      patientNumberPrefix = patientNumberPrefix,
+      lastPatientNumber = lastPatientNumber,
+      useCountColumn = useCountColumn)
+  return appendPatientRows(sheet, tabProperties, rows)
+
 def getTabForPrefecture(prefecture):
   """
   Returns the correct tab name given the prefecture.
@@ -220,20 +402,8 @@ def writePatients(prefecture, date, cases, deceased, source, useCountColumn=True
   """
   tabName = getTabForPrefecture(prefecture)
 
-
-  creds = service_account.Credentials.from_service_account_file(
-    './credentials.json', scopes=SCOPES
-  )
-  service = build('sheets', 'v4', credentials=creds)
-  sheet = service.spreadsheets()
-
-  sheetsResult = sheet.get(spreadsheetId=SPREADSHEET_ID, fields='sheets.properties').execute()
-  tabProperties = {}
-  for sheetProperty in sheetsResult['sheets']:
-    if sheetProperty['properties']['title'] == tabName:
-      tabProperties = sheetProperty['properties']
-      break
-
+  sheet = sheets.getSpreadsheet()
+  tabProperties = sheets.getTabProperties(tabName, sheet)
   if not tabProperties:
     print('Unable to find tab: %s' % tabName)
     return 0
@@ -246,22 +416,147 @@ def writePatients(prefecture, date, cases, deceased, source, useCountColumn=True
       return result['updatedRows']
     return 0
   else:
-    if useCountColumn:
-      patientNumberPrefix, lastPatientNumber = PREFECTURE_PREFIX[prefecture], int(date.replace('-', ''))
-    else:
-      patientNumberPrefix, lastPatientNumber = getPatientNumberColumn(sheet, tabProperties)
-
-    result = appendRows(sheet, tabProperties, prefecture, date, 
-      cases = cases,
-      deceased = deceased, 
-      source = source, 
-      patientNumberPrefix = patientNumberPrefix, 
-      lastPatientNumber = lastPatientNumber,
-      useCountColumn = useCountColumn)
+    # Hold the tab so that concurrent appends don't reuse the same patient numbers.
+    with getPatientRowIndex(tabName).lock:
+      if useCountColumn:
+        patientNumberPrefix, lastPatientNumber = PREFECTURE_PREFIX[prefecture], int(date.replace('-', ''))
+      else:
+        patientNumberPrefix, lastPatientNumber = getPatientNumberColumn(sheet, tabProperties)
+
+      result = appendRows(sheet, tabProperties, prefecture, date, 
+        cases = cases,
+        deceased = deceased, 
+        source = source, 
+        patientNumberPrefix = patientNumberPrefix, 
+        lastPatientNumber = lastPatientNumber,
+        useCountColumn = useCountColumn)
     if result:
       return result['updates']['updatedRows']
     return 0
 
+def validateEntry(entry):
+  """
+  Checks a batch entry and converts its cases and deceased counts to int in place.
+
+  Returns an error message or None if the entry is valid.
+  """
+  if not entry.get('prefecture') or not entry.get('date'):
+    return 'Required parameters prefecture and date not found.'
+  if entry['prefecture'] not in PREFECTURE_PREFIX:
+    return 'Unknown prefecture: %s' % entry['prefecture']
+  for key in ('cases', 'deceased'):
+    if entry.get(key):
+      try:
+        entry[key] = int(entry[key])
+      except (TypeError, ValueError):
+        return 'Invalid %s: %s' % (key, entry[key])
+  if not entry.get('cases') and not entry.get('deceased'):
+    return 'Required parameters cases or deceased not found.'
+  return None
+
+def writePatientsBatch(entries):
+  """
+  Writes the patient counts for many prefectures at once.
+
+  entries is a list of dicts with prefecture, date, cases, deceased and source.
+  Entries are grouped by tab so that each tab's index is refreshed once. All
+  count changes are sent in a single values().batchUpdate and all new rows in one
+  append per tab. When several entries are for the same date, prefecture and
+  status the last one is written and the others are reported as superseded.
+
+  Returns a list of results in the same order as entries.
+  """
+  results = [None] * len(entries)
+  entriesForTab = {}
+  for i, entry in enumerate(entries):
+    error = validateEntry(entry)
+    if error:
+      results[i] = {'error': error}
+    else:
+      entriesForTab.setdefault(getTabForPrefecture(entry['prefecture']), []).append(i)
+
+  sheet = sheets.getSpreadsheet()
+  countUpdates = []
+  countUpdateIndexes = []
+  lockedIndexes = []
+  try:
+    # Tabs are visited in sorted order so concurrent batches lock them in the same order.
+    for tabName, indexes in sorted(entriesForTab.items()):
+      tabProperties = sheets.getTabProperties(tabName, sheet)
+      if not tabProperties:
+        for i in indexes:
+          results[i] = {'error': 'Unable to find tab: %s' % tabName}
+        continue
+
+      # Keep the tab locked until the count updates below have been written.
+      rowIndex = getPatientRowIndex(tabName)
+      rowIndex.lock.acquire()
+      lockedIndexes.append(rowIndex)
+
+      # Diff only the last entry for each row, not ones already superseded.
+      lastForKey = {}
+      for i in indexes:
+        entry = entries[i]
+        lastForKey[indexKey(entry['prefecture'], entry['date'], entry.get('deceased'))] = i
+
+      try:
+        rowIndex.refresh(sheet, list(lastForKey))
+      except Exception as e:
+        for i in indexes:
+          results[i] = {'error': str(e)}
+        continue
+
+      newRows = []
+      for i in indexes:
+        entry = entries[i]
+        prefecture, date = entry['prefecture'], entry['date']
+        cases, deceased = entry.get('cases'), entry.get('deceased')
+        count = deceased if deceased else cases
+        results[i] = {'prefecture': prefecture, 'date': date}
+        if lastForKey[indexKey(prefecture, date, deceased)] != i:
+          results[i].update({'status': 'superseded', 'updatedRows': 0})
+          continue
+
+        existing = rowIndex.find(prefecture, date, deceased)
+        if existing and existing[1] == count:
+          results[i].update({'status': 'unchanged', 'updatedRows': 0})
+        elif existing:
+          countUpdates.append({'range': countRange(tabProperties, existing[0]), 'values': [[count]]})
+          countUpdateIndexes.append((i, existing, count))
+        else:
+          newRows.extend(makePatientRows(prefecture, date,
+              cases = cases,
+              deceased = deceased,
+              source = entry.get('source') or '',
+              patientNumberPrefix = PREFECTURE_PREFIX[prefecture],
+              lastPatientNumber = int(date.replace('-', '')),
+              useCountColumn = True))
+          results[i].update({'status': 'appended', 'updatedRows': 1})
+
+      if newRows:
+        try:
+          appendPatientRows(sheet, tabProperties, newRows)
+        except Exception as e:
+          for i in indexes:
+            if results[i].get('status') == 'appended':
+              results[i] = {'error': str(e)}
+
+    if countUpdates:
+      try:
+        sheet.values().batchUpdate(
+          spreadsheetId=SPREADSHEET_ID,
+          body={'valueInputOption': 'USER_ENTERED', 'data': countUpdates}).execute()
+        for i, existing, count in countUpdateIndexes:
+          existing[1] = count
+          results[i].update({'status': 'updated', 'updatedRows': 1})
+      except Exception as e:
+        for i, existing, count in countUpdateIndexes:
+          results[i] = {'error': str(e)}
+  finally:
+    for rowIndex in lockedIndexes:
+      rowIndex.lock.release()
+
+  return results
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
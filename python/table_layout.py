@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Finds the cells of the MHLW summary table from its ruling lines.
+
+The grayscale table image is thresholded and opened with long horizontal and
+vertical kernels, which leaves only the table lines. The line positions, along
+with the image size, make up the layout fingerprint. For each value the cell
+that encloses a seed point (the centre of the hand measured rectangle in
+mhlw.imageAreaRects) is found by walking out to the nearest lines, so a merged
+cell spanning two rows gives one tall box instead of two guesses. Each cell is
+then shrunk to its first line of text, leaving out the ruling lines and the
+day's change that some cells show on a second line, e.g. "(+9)".
+
+The lines are detected on every image (about a millisecond at the normalized
+size), the cell boxes are cached per fingerprint and the text line is found
+again for each image. Values whose cell can't be found are left out and the
+caller falls back to the fixed rectangles for them.
+
+TABLE_LAYOUT_DETECTION=0 turns detection off.
+"""
+
+import os
+import hashlib
+import threading
+
+TABLE_LAYOUT_DETECTION = os.environ.get('TABLE_LAYOUT_DETECTION', '1') == '1'
+
+# Pixels darker than this are treated as ink.
+INK_THRESHOLD = 160
+# Minimum line length as a fraction of the image width / height.
+HORIZONTAL_LINE_FRACTION = 0.08
+VERTICAL_LINE_FRACTION = 0.12
+# Line positions are rounded to this many pixels for the fingerprint.
+FINGERPRINT_QUANTUM = 2
+# Pixels trimmed from each side of a cell so the ruling lines are not OCR'd.
+CELL_INSET = 2
+# Pixels of white kept around the text line of a cell.
+TEXT_PADDING = 3
+MIN_CELL_WIDTH = 20
+MIN_CELL_HEIGHT = 10
+
+_lock = threading.Lock()
+_layouts = {}
+
+
+def groupPositions(positions):
+    """
+    Collapses runs of adjacent pixel positions into their centres.
+    """
+    lines = []
+    run = []
+    for position in positions:
+        if run and position != run[-1] + 1:
+            lines.append(sum(run) // len(run))
+            run = []
+        run.append(position)
+    if run:
+        lines.append(sum(run) // len(run))
+    return lines
+
+
+def detectLines(image):
+    """
+    @returns (ink mask, horizontal mask, vertical mask, row line positions,
+        column line positions) for a grayscale PIL image.
+    """
+    import cv2
+    import numpy as np
+
+    pixels = np.asarray(image, dtype=np.uint8)
+    height, width = pixels.shape
+    ink = (pixels < INK_THRESHOLD).astype(np.uint8)
+
+    horizontalKernel = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (max(int(width * HORIZONTAL_LINE_FRACTION), 2), 1))
+    verticalKernel = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (1, max(int(height * VERTICAL_LINE_FRACTION), 2)))
+    horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, horizontalKernel)
+    vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, verticalKernel)
+
+    rows = groupPositions(np.flatnonzero(horizontal.any(axis=1)).tolist())
+    columns = groupPositions(np.flatnonzero(vertical.any(axis=0)).tolist())
+    return (ink, horizontal, vertical, rows, columns)
+
+
+def layoutFingerprint(size, rows, columns):
+    quantize = lambda positions: [p // FINGERPRINT_QUANTUM for p in positions]
+    description = '%dx%d r%s c%s' % (size[0], size[1], quantize(rows), quantize(columns))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+
+
+def hasLine(mask, rowSlice, columnSlice):
+    return bool(mask[rowSlice, columnSlice].any())
+
+
+def enclosingCell(x, y, horizontal, vertical, rows, columns):
+    """
+    Returns the (left, top, right, bottom) box of the cell containing (x, y),
+    or None if it is not enclosed by lines.
+    """
+    # Look one pixel either side of a line, it may not be exactly at its centre.
+    band = lambda p: slice(max(p - 1, 0), p + 2)
+
+    lefts = [c for c in columns if c < x and hasLine(vertical, band(y), band(c))]
+    rights = [c for c in columns if c > x and hasLine(vertical, band(y), band(c))]
+    if not lefts or not rights:
+        return None
+    left, right = lefts[-1], rights[0]
+
+    tops = [r for r in rows if r < y and hasLine(horizontal, band(r), band(x))]
+    bottoms = [r for r in rows if r > y and hasLine(horizontal, band(r), band(x))]
+    if not tops or not bottoms:
+        return None
+    top, bottom = tops[-1], bottoms[0]
+
+    box = (left + CELL_INSET, top + CELL_INSET, right - CELL_INSET + 1, bottom - CELL_INSET + 1)
+    if box[2] - box[0] < MIN_CELL_WIDTH or box[3] - box[1] < MIN_CELL_HEIGHT:
+        return None
+    return box
+
+
+def firstTextLine(text, box):
+    """
+    Shrinks box to the first line of text inside it, plus TEXT_PADDING.
+
+    @param text - mask of the ink that is not part of a ruling line
+    @returns the shrunk box, or box itself if it holds no text.
+    """
+    import numpy as np
+
+    left, top, right, bottom = box
+    cell = text[top:bottom, left:right]
+    inkRows = np.flatnonzero(cell.any(axis=1))
+    if not len(inkRows):
+        return box
+    # The first line ends at the first blank row after it starts.
+    start = end = int(inkRows[0])
+    while end + 1 < cell.shape[0] and cell[end + 1].any():
+        end += 1
+    inkColumns = np.flatnonzero(cell[start:end + 1].any(axis=0))
+    return (max(left, left + int(inkColumns[0]) - TEXT_PADDING),
+            max(top, top + start - TEXT_PADDING),
+            min(right, left + int(inkColumns[-1]) + 1 + TEXT_PADDING),
+            min(bottom, top + end + 1 + TEXT_PADDING))
+
+
+def locateCells(image, seeds):
+    """
+    Finds the cell of each value in the summary table image.
+
+    @param image - grayscale PIL image of the table
+    @param seeds - dict of key to an (x, y) point inside that value's cell
+    @returns dict of key to the (left, top, right, bottom) of the first text
+        line in the cells that were found, or None if detection is off or OpenCV
+        is not installed.
+    """
+    if not TABLE_LAYOUT_DETECTION:
+        return None
+    try:
+        ink, horizontal, vertical, rows, columns = detectLines(image)
+    except ImportError as e:
+        print('Table layout detection unavailable: %s' % e)
+        return None
+
+    fingerprint = layoutFingerprint(image.size, rows, columns)
+    with _lock:
+        cells = _layouts.get(fingerprint)
+
+    if cells is None:
+        cells = {}
+        for key in seeds:
+            x, y = seeds[key]
+            box = enclosingCell(x, y, horizontal, vertical, rows, columns)
+            if box:
+                cells[key] = box
+        print('Detected table layout %s (%d rows, %d columns): %s' % (
+            fingerprint, len(rows), len(columns), cells))
+        with _lock:
+            _layouts[fingerprint] = cells
+
+    text = ink & ~(horizontal | vertical)
+    return dict([(key, firstTextLine(text, cells[key])) for key in cells])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under test live in python/, one level up.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Writes test/index_synthetic.html, a stand-in for the MHLW index page of the
+COVID reports (topics_shingata_09444.html) for the link discovery tests and
+benchmarks.
+
+Like the real page it has a long header and navigation with unrelated links
+before the list of reports, newest first, titled
+新型コロナウイルス感染症の現在の状況と厚生労働省の対応について（令和2年5月10日版）
+and linking to /stf/newpage_<number>.html. The dates run back one a day from
+FIRST_DATE.
+
+python3 test/make_index_page.py
+"""
+
+import os
+import datetime
+
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index_synthetic.html')
+FIRST_DATE = datetime.date(2020, 5, 31)
+REPORT_COUNT = 150
+NAVIGATION_LINKS = 400
+FIRST_PAGE_NUMBER = 11700
+
+
+def reportTitle(date):
+    return '新型コロナウイルス感染症の現在の状況と厚生労働省の対応について（令和%d年%d月%d日版）' % (
+        date.year - 2018, date.month, date.day)
+
+
+def reports():
+    """
+    @returns [(href, title, date)] newest first.
+    """
+    return [('/stf/newpage_%d.html' % (FIRST_PAGE_NUMBER - i), reportTitle(FIRST_DATE - datetime.timedelta(days=i)),
+             FIRST_DATE - datetime.timedelta(days=i)) for i in range(REPORT_COUNT)]
+
+
+def writePage(path=OUTPUT_PATH):
+    lines = [
+        '<!DOCTYPE html>',
+        '<html lang="ja">',
+        '<head><meta charset="utf-8"><title>新型コロナウイルス感染症について｜厚生労働省</title></head>',
+        '<body>',
+        '<div class="l-header"><ul class="m-globalNav">',
+    ]
+    for i in range(NAVIGATION_LINKS):
+        lines.append('<li><a href="/stf/seisakunitsuite/bunya/page_%d.html">政策について %d</a></li>' % (i, i))
+    lines.append('</ul></div>')
+    lines.append('<div class="l-contentBody"><h2>国内の発生状況など</h2><ul class="m-listLink">')
+    for href, title, date in reports():
+        lines.append('<li><a href="%s">%s</a></li>' % (href, title))
+    lines.append('</ul></div>')
+    lines.append('<div class="l-footer"><a href="/stf/sitemap.html">サイトマップ</a></div>')
+    lines.append('</body>')
+    lines.append('</html>')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    writePage()
+    print('Wrote %s' % OUTPUT_PATH)
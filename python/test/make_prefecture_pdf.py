@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Writes test/prefectures_synthetic.pdf, a stand-in for the MHLW per-prefecture
+PDF (各都道府県の検査陽性者の状況) for the extractor tests and benchmarks.
+
+It copies the layout both extractors rely on: a title, a block of header rows
+with 陽性者 over the third column and 退院 over the last one in the second
+header row, the 47 prefecture rows starting at 北海道 (with ※ footnote markers
+and thousands separators) and two summary rows below them. The numbers are made
+up. Saved MHLW PDFs can be dropped next to it and are picked up the same way.
+
+Needs reportlab:
+python3 test/make_prefecture_pdf.py
+"""
+
+import os
+import random
+
+PREFECTURES = [
+    '北海道', '青森', '岩手', '宮城', '秋田', '山形', '福島', '茨城', '栃木', '群馬',
+    '埼玉', '千葉', '東京', '神奈川', '新潟', '富山', '石川', '福井', '山梨', '長野',
+    '岐阜', '静岡', '愛知', '三重', '滋賀', '京都', '大阪', '兵庫', '奈良', '和歌山',
+    '鳥取', '島根', '岡山', '広島', '山口', '徳島', '香川', '愛媛', '高知', '福岡',
+    '佐賀', '長崎', '熊本', '大分', '宮崎', '鹿児島', '沖縄',
+]
+FONT = 'HeiseiKakuGo-W5'
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefectures_synthetic.pdf')
+
+# Right edges of the number columns, in points. The prefecture column is left
+# aligned at PREFECTURE_X.
+PREFECTURE_X = 40
+COLUMN_RIGHT = [130, 195, 260, 325, 390, 455, 540]
+HEADERS = [
+    ['', '', '', '', '', '', ''],
+    ['PCR検査', '陽性者数', '入院治療等', 'うち重症', '死亡者数', '確認中', '退院又は療養'],
+    ['実施人数', '', 'を要する者', '', '', '', '解除となった'],
+    ['', '', '', '', '', '', '者の数'],
+    ['(累積)', '(累積)', '', '', '(累積)', '', '(累積)'],
+    ['(人)', '(人)', '(人)', '(人)', '(人)', '(人)', '(人)'],
+]
+
+
+def formatNumber(value):
+    return '{:,}'.format(value)
+
+
+def makeRows(seed):
+    rng = random.Random(seed)
+    rows = []
+    for i, prefecture in enumerate(PREFECTURES):
+        cases = rng.randint(0, 6000)
+        recovery = rng.randint(0, cases)
+        deaths = rng.randint(0, cases - recovery)
+        critical = rng.randint(0, max(0, cases - recovery - deaths) // 10)
+        pending = rng.randint(0, 20)
+        pcr = cases * rng.randint(5, 30)
+        name = prefecture
+        if i % 11 == 3:
+            name += '※1'
+        recoveryText = formatNumber(recovery)
+        if i % 13 == 5:
+            recoveryText = '※2 ' + recoveryText
+        rows.append((name, [formatNumber(pcr), formatNumber(cases),
+                            formatNumber(cases - recovery - deaths), formatNumber(critical),
+                            formatNumber(deaths), formatNumber(pending), recoveryText]))
+    return rows
+
+
+def drawRow(canvas, y, first, cells):
+    canvas.drawString(PREFECTURE_X, y, first)
+    for right, text in zip(COLUMN_RIGHT, cells):
+        canvas.drawRightString(right, y, text)
+
+
+def writePdf(path=OUTPUT_PATH, seed=0):
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas as pdfCanvas
+
+    pdfmetrics.registerFont(UnicodeCIDFont(FONT))
+    canvas = pdfCanvas.Canvas(path, pagesize=A4, invariant=1)
+    width, height = A4
+
+    canvas.setFont(FONT, 12)
+    canvas.drawString(PREFECTURE_X, height - 40, '各都道府県の検査陽性者の状況（空港・海港検疫、チャーター便を除く国内事例）')
+
+    canvas.setFont(FONT, 8)
+    y = height - 80
+    drawRow(canvas, y, '都道府県名', HEADERS[0])
+    for headerRow in HEADERS[1:]:
+        y -= 11
+        drawRow(canvas, y, '', headerRow)
+
+    y -= 15
+    rows = makeRows(seed)
+    for name, cells in rows:
+        drawRow(canvas, y, name, cells)
+        y -= 13
+    drawRow(canvas, y, 'その他', ['0'] * len(COLUMN_RIGHT))
+    y -= 13
+    drawRow(canvas, y, '合計', ['-'] * len(COLUMN_RIGHT))
+    canvas.showPage()
+    canvas.save()
+    return rows
+
+
+if __name__ == '__main__':
+    writePdf()
+    print('Wrote %s' % OUTPUT_PATH)
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import mhlw
+import backfill
+import fake_sheets
+
+
+@pytest.fixture
+def fake():
+    # Sum By Day and Recoveries hold 2020-04-26 to 2020-04-30.
+    fake = fake_sheets.FakeSpreadsheet(patientRows=10, days=5)
+    fake_sheets.install(fake)
+    return fake
+
+
+def makeReport(date, recovery, withPrefectures=True):
+    prefectureValues = [('P%d' % i, str(recovery + i), '1,000') for i in range(47)]
+    report = {
+        'url': 'https://example.com/%s' % date,
+        'date': date,
+        'values': {'recoveries': 500, 'deaths': 50, 'critical': 5, 'pcr': 5000, 'portRecoveries': 7},
+        'prefectures': backfill.frameColumns(mhlw.casesRecoveryFrame(prefectureValues)),
+    }
+    if withPrefectures:
+        report['values']['prefectureCasesRecoveries'] = prefectureValues
+    return report
+
+
+def readValues(fake, rangeString):
+    return fake.readRange(rangeString).get('values', [])
+
+
+def test_write_reports_at_their_dates(fake):
+    prefectureData = readValues(fake, "'Prefecture Data'!A1:L50")
+    reports = [makeReport('2020-05-02', 30), makeReport('2020-04-20', 10),
+               makeReport('2020-04-28', 20), makeReport('2020-04-29', 40, withPrefectures=False)]
+
+    result = backfill.writeReports(reports)
+    assert result['apiCalls'] == fake.totalCalls() == 4
+    assert result['skipped'] == {'Sum By Day': [], 'Recoveries': ['2020-04-29']}
+
+    sumByDay = readValues(fake, "'Sum By Day'!A2:F")
+    assert [row[0] for row in sumByDay] == [
+        '2020-04-20', '2020-04-26', '2020-04-27', '2020-04-28', '2020-04-29', '2020-04-30', '2020-05-02']
+    # Existing rows keep their confirmed count and get the new values.
+    assert sumByDay[3] == ['2020-04-28', '12', '500', '50', '5', '5000']
+    assert sumByDay[1] == ['2020-04-26', '10', '100', '5', '20', '1000']
+    assert sumByDay[0] == ['2020-04-20', '', '500', '50', '5', '5000']
+
+    header = readValues(fake, "'Recoveries'!1:1")[0]
+    assert header[2:] == [
+        '2020-05-02', '2020-04-30', '2020-04-29', '2020-04-28', '2020-04-27', '2020-04-26', '2020-04-20']
+    columns = list(zip(*[row + [''] * (len(header) - len(row)) for row in readValues(fake, "'Recoveries'!A1:I50")]))
+    assert columns[2][1:3] == ('30', '31')
+    assert columns[5][1:3] == ('20', '21')
+    assert columns[8][1:3] == ('10', '11')
+    assert columns[8][48:50] == ('7', '8')
+    # No prefecture numbers for 2020-04-29, so its column is untouched.
+    assert columns[4][1:3] == ('10', '10')
+
+    assert readValues(fake, "'Prefecture Data'!A1:L50") == prefectureData
+
+
+def test_write_reports_rejects_unsorted_sheet(fake):
+    fake.writeRange("'Sum By Day'!A3", [['2020-05-10']])
+    with pytest.raises(ValueError):
+        backfill.writeReports([makeReport('2020-04-28', 20)])
+
+
+def test_checkpoint_only_resumes_complete_reports(tmp_path):
+    complete = makeReport('2020-04-28', 20)
+    noPrefectures = makeReport('2020-04-29', 20, withPrefectures=False)
+    noSummary = makeReport('2020-04-30', 20)
+    del noSummary['values']['critical']
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    with open(checkpoint, 'w') as f:
+        for report in (complete, noPrefectures, noSummary):
+            f.write(json.dumps(report) + '\n')
+
+    assert [backfill.isCompleteReport(r) for r in (complete, noPrefectures, noSummary)] == [True, False, False]
+    assert list(backfill.checkpointedReports(checkpoint)) == [complete['url']]
+    assert backfill.checkpointedReports(checkpoint, force=True) == {}
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import ocr
+import mhlw
+import extraction_cache
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class NamedEngine(object):
+    name = 'test'
+
+
+@pytest.fixture
+def cacheDir(monkeypatch, tmp_path):
+    monkeypatch.setattr(extraction_cache, 'EXTRACTION_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(ocr, 'getEngine', lambda backend=None: NamedEngine())
+    return tmp_path
+
+
+def test_incomplete_daily_summary_is_not_cached(cacheDir, monkeypatch):
+    results = [{'pcr': 5000, 'critical': 5}, dict((key, 10) for key in mhlw.SUMMARY_KEYS)]
+    monkeypatch.setattr(mhlw, 'readDailySummary', lambda *args: results.pop(0))
+
+    assert mhlw.extractDailySummaryFromData(b'image', False) == {'pcr': 5000, 'critical': 5}
+    assert os.listdir(str(cacheDir)) == []
+    assert mhlw.extractDailySummaryFromData(b'image', False)['deaths'] == 10
+    assert mhlw.extractDailySummaryFromData(b'image', False)['deaths'] == 10
+    assert results == []
+
+
+def test_partial_prefecture_values_are_not_cached(cacheDir, monkeypatch):
+    values = [('P%d' % i, '1', '2') for i in range(mhlw.PREFECTURE_COUNT)]
+    results = [(None, values[:3]), (None, []), (None, values)]
+    monkeypatch.setattr(mhlw, 'readCasesRecoveryNumbers', lambda *args: results.pop(0))
+
+    pdfPath = os.path.join(FIXTURE_DIR, 'prefectures_synthetic.pdf')
+    assert mhlw.extractCasesRecoveryNumbers(pdfPath)[1] == values[:3]
+    assert mhlw.extractCasesRecoveryNumbers(pdfPath)[1] == []
+    assert os.listdir(str(cacheDir)) == []
+    assert mhlw.extractCasesRecoveryNumbers(pdfPath)[1] == values
+    assert mhlw.extractCasesRecoveryNumbers(pdfPath)[1] == values
+    assert results == []
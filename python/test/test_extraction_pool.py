@@ -0,0 +1,38 @@
+import sys
+
+import pytest
+
+import ocr
+import mhlw
+
+
+def importedModules(names):
+    return [name for name in names if name in sys.modules]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(mhlw, '_extractionPool', None)
+    monkeypatch.setattr(mhlw, '_extractionPoolWarm', False)
+    monkeypatch.setattr(mhlw, 'EXTRACTION_PROCESSES', 1)
+    for counter in ('_hits', '_misses', '_size'):
+        monkeypatch.setattr(ocr, counter, getattr(ocr, counter))
+    yield
+    if mhlw._extractionPool is not None:
+        mhlw._extractionPool.shutdown()
+
+
+def test_warmup_imports_in_the_extraction_processes(pool):
+    pytest.importorskip('camelot')
+    mhlw.warmupExtractionPool(wait=True)
+    worker = mhlw.getExtractionPool().submit(importedModules, ['camelot', 'pandas', 'PIL.Image'])
+    assert worker.result() == ['camelot', 'pandas', 'PIL.Image']
+
+
+def test_parent_drops_its_pool_after_forking_workers(pool):
+    mhlw.warmupExtractionPool()
+    parentPool = mhlw.getExtractionPool()
+    mhlw.extractionPoolAfterFork(False)
+    assert mhlw._extractionPool is None
+    with pytest.raises(RuntimeError):
+        parentPool.submit(int)
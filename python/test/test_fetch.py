@@ -0,0 +1,110 @@
+import hashlib
+import http.server
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import fetch
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves /<name> with a body and ETag per name, answering If-None-Match with 304.
+    """
+    requests = []
+
+    def do_GET(self):
+        body = ('body of %s' % self.path).encode('utf-8') * 10
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        Handler.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = fetch.FetchCache(str(tmp_path), 10 * 1024 * 1024)
+    monkeypatch.setattr(fetch, '_cache', cache)
+    monkeypatch.setattr(fetch, 'FETCH_REPLAY_DIR', '')
+    return cache
+
+
+def test_revalidates_with_etag(server, cache):
+    first = fetch.fetch(server + '/a')
+    second = fetch.fetch(server + '/a')
+
+    assert first == second
+    assert Handler.requests[0] == ('/a', None)
+    # The second request is conditional and answered with 304.
+    assert Handler.requests[1][1] is not None
+    assert cache.get(server + '/a')[1] == first
+
+
+def test_processes_share_the_index(server, cache, tmp_path):
+    # A second instance on the same directory stands in for another process.
+    other = fetch.FetchCache(str(tmp_path), cache.maxBytes)
+    body = fetch.fetch(server + '/a')
+    other.put(server + '/b', b'from the other process', '"b"', None)
+
+    assert other.get(server + '/a')[1] == body
+    assert cache.get(server + '/b')[1] == b'from the other process'
+
+
+def putFromProcess(cacheDir, maxBytes, index):
+    cache = fetch.FetchCache(cacheDir, maxBytes)
+    for i in range(20):
+        cache.put('http://example.com/%d/%d' % (index, i), b'%d' % index * 100, None, 'now')
+
+
+def test_concurrent_processes_keep_each_others_entries(cache, tmp_path):
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=putFromProcess, args=(str(tmp_path), cache.maxBytes, i))
+                 for i in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    for index in range(3):
+        for i in range(20):
+            entry, body = cache.get('http://example.com/%d/%d' % (index, i))
+            assert body == b'%d' % index * 100
+
+
+def test_eviction_keeps_objects_still_referenced(tmp_path):
+    cache = fetch.FetchCache(str(tmp_path), 250)
+    cache.put('http://example.com/shared1', b'y' * 100, None, 'now')
+    cache.put('http://example.com/old', b'x' * 100, None, 'now')
+    # Same body as shared1, so the object is shared.
+    cache.put('http://example.com/shared2', b'y' * 100, None, 'now')
+    # Over the limit: shared1 and old are the least recently used.
+    cache.put('http://example.com/new', b'z' * 100, None, 'now')
+
+    assert cache.get('http://example.com/old') == (None, None)
+    assert cache.get('http://example.com/shared1')[1] is None
+    assert cache.get('http://example.com/shared2')[1] == b'y' * 100
+    assert cache.get('http://example.com/new')[1] == b'z' * 100
+    assert len(os.listdir(cache.objectsDir)) == 2
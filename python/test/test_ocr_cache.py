@@ -0,0 +1,55 @@
+import multiprocessing
+import concurrent.futures
+
+import pytest
+
+import ocr
+
+
+class EchoEngine(object):
+    """
+    Recognizes an image as its first pixel, instead of running tesseract.
+    """
+    name = 'echo'
+
+    def recognize(self, image):
+        return str(image.getpixel((0, 0)))
+
+
+def recognizeShades(shades):
+    from PIL import Image
+    return [ocr.recognizeCached(Image.new('L', (4, 4), shade), EchoEngine()) for shade in shades]
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    context = multiprocessing.get_context('spawn')
+    counters = (context.Value('q', 0), context.Value('q', 0), context.Value('q', 0))
+    monkeypatch.setattr(ocr, '_hits', counters[0])
+    monkeypatch.setattr(ocr, '_misses', counters[1])
+    monkeypatch.setattr(ocr, '_size', counters[2])
+    return context, counters
+
+
+def test_cache_stats_cover_worker_processes(counters):
+    pytest.importorskip('PIL')
+    context, values = counters
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, mp_context=context, initializer=ocr.shareCounters, initargs=values) as pool:
+        results = list(pool.map(recognizeShades, [[1, 2, 1], [3, 3]]))
+
+    assert results == [['1', '2', '1'], ['3', '3']]
+    stats = ocr.getCacheStats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 3
+    assert stats['size'] == 3
+
+
+def test_eviction_and_clear_update_size(counters, monkeypatch):
+    pytest.importorskip('PIL')
+    monkeypatch.setattr(ocr, 'OCR_CACHE_SIZE', 2)
+    monkeypatch.setattr(ocr, '_cache', type(ocr._cache)())
+    recognizeShades([1, 2, 3, 3])
+    assert ocr.getCacheStats()['size'] == 2
+    ocr.clearCache()
+    assert ocr.getCacheStats()['size'] == 0
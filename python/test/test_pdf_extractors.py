@@ -0,0 +1,30 @@
+import os
+import glob
+
+import pytest
+
+import mhlw
+import pdf_text
+import make_prefecture_pdf
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+PDFS = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.pdf')))
+
+
+@pytest.mark.parametrize('pdfPath', PDFS, ids=os.path.basename)
+def test_text_extractor_matches_camelot(pdfPath):
+    pytest.importorskip('camelot')
+    textValues = pdf_text.extractCasesRecoveryNumbers(pdfPath)
+    frame, camelotValues = mhlw.readCasesRecoveryNumbersWithCamelot(pdfPath)
+    assert len(camelotValues) == 47
+    assert textValues == camelotValues
+    assert frame['prefecture'].tolist() == [v[0] for v in camelotValues]
+    assert str(frame['cases'].dtype) == 'Int64'
+    assert frame['cases'].tolist() == [int(v[2]) for v in camelotValues]
+    assert frame['recovery'].tolist() == [int(v[1]) for v in camelotValues]
+
+
+def test_synthetic_pdf_values():
+    expected = [(name.split('※')[0], cells[6].split(' ')[-1].replace(',', ''), cells[1].replace(',', ''))
+                for name, cells in make_prefecture_pdf.makeRows(0)]
+    assert pdf_text.extractCasesRecoveryNumbers(make_prefecture_pdf.OUTPUT_PATH) == expected
@@ -0,0 +1,118 @@
+import os
+import json
+import threading
+
+import pytest
+
+import jobs
+import main
+import mhlw
+import fetch
+import sheets
+import profiling
+import fake_sheets
+import sync_patients
+
+
+@pytest.fixture
+def report(monkeypatch):
+    """
+    Replaces reportToday with one that blocks until release is set.
+    """
+    release = threading.Event()
+    calls = []
+
+    def reportToday(writeToSpreadsheet=False, force=False, reportUrl=None, pool=None):
+        calls.append(force)
+        release.wait(10)
+        if pool:
+            pool.submit(fetch.fetch, 'data:,report').result()
+        return 'written'
+
+    monkeypatch.setattr(mhlw, 'reportToday', reportToday)
+    monkeypatch.setattr(jobs, '_manager', jobs.JobManager())
+    yield release, calls
+    release.set()
+
+
+def test_post_returns_before_the_report_is_found(report):
+    release, calls = report
+    client = main.app.test_client()
+    response = client.post('/mhlw/today')
+    assert response.status_code == 202
+    jobId = json.loads(response.data)['jobId']
+
+    assert json.loads(client.post('/mhlw/today').data)['coalesced'] is True
+    release.set()
+    job = jobs.getJobManager().wait(jobs.getJobManager().get(jobId), 10)
+    assert job.result == 'written'
+    assert calls == [False]
+
+
+def test_force_does_not_join_an_unforced_job(report):
+    release, calls = report
+    client = main.app.test_client()
+    client.post('/mhlw/today')
+
+    response = client.post('/mhlw/today?force=1')
+    assert response.status_code == 409
+    assert json.loads(response.data)['forceIgnored'] is True
+
+    release.set()
+    jobs.getJobManager().wait(jobs.getJobManager().get(json.loads(response.data)['jobId']), 10)
+    response = client.post('/mhlw/today?force=1')
+    assert response.status_code == 202
+    release.set()
+    jobs.getJobManager().wait(jobs.getJobManager().get(json.loads(response.data)['jobId']), 10)
+    assert calls == [False, True]
+
+
+def test_profiled_get_joins_the_running_job(report, monkeypatch, tmp_path):
+    release, calls = report
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    client = main.app.test_client()
+    client.post('/mhlw/today')
+
+    # Released while the profiled GET waits for the job.
+    timer = threading.Timer(0.5, release.set)
+    timer.start()
+    result = json.loads(client.get('/mhlw/today?profile=1').data)
+    timer.join()
+    assert result['result'] == 'written'
+    assert result['coalesced'] is True
+    assert calls == [False]
+    assert os.path.exists(os.path.join(result['profile'], 'inputs', fetch.INPUTS_INDEX))
+
+
+def test_profiled_get_records_its_inputs(report, monkeypatch, tmp_path):
+    release, calls = report
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    release.set()
+    result = json.loads(main.app.test_client().get('/mhlw/today?profile=1').data)
+    assert result['result'] == 'written'
+    assert result['coalesced'] is False
+    with open(os.path.join(result['profile'], 'inputs', fetch.INPUTS_INDEX)) as f:
+        assert list(json.load(f)) == ['data:,report']
+
+
+def test_profiled_patient_update_records_sheets_requests(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    fake = fake_sheets.FakeSpreadsheet(patientRows=10, days=5)
+    fake_sheets.install(fake)
+    result = json.loads(main.app.test_client().get(
+        '/patients/update?prefecture=Tokyo&date=2020-05-03&cases=4&source=s&profile=1').data)
+    assert result['updateRows'] == 1
+    rows = fake.readRange("'Tokyo'!A1:N")
+
+    # Replay against the recording only, nothing is written.
+    inputs = os.path.join(result['profile'], 'inputs')
+    replay = sheets.ReplaySpreadsheet.load(inputs)
+    assert len(replay.calls) == fake.totalCalls()
+    sheets.setSpreadsheet(replay)
+    sync_patients.clearCaches()
+    try:
+        assert sync_patients.writePatients('Tokyo', '2020-05-03', 4, 0, 's') == 1
+    finally:
+        sheets.setSpreadsheet(None)
+    assert all(replay.used)
+    assert fake.readRange("'Tokyo'!A1:N") == rows
@@ -0,0 +1,25 @@
+import datetime
+
+import mhlw
+import backfill
+import make_index_page
+
+INDEX_URL = 'https://www.mhlw.go.jp/stf/seisakunitsuite/bunya/topics_shingata_09444.html'
+
+
+def readPage():
+    with open(make_index_page.OUTPUT_PATH, 'rb') as f:
+        return f.read()
+
+
+def test_finds_every_report_newest_first():
+    links = mhlw.findCovidReportLinks(readPage(), INDEX_URL)
+    expected = make_index_page.reports()
+    assert [url for url, text in links] == ['https://www.mhlw.go.jp' + href for href, title, date in expected]
+    assert [backfill.parseLinkDate(text) for url, text in links] == [date for href, title, date in expected]
+
+
+def test_first_link_is_the_latest_report():
+    links = mhlw.findCovidReportLinks(readPage(), INDEX_URL, first=True)
+    assert links == [('https://www.mhlw.go.jp/stf/newpage_11700.html',
+                      make_index_page.reportTitle(datetime.date(2020, 5, 31)))]
@@ -0,0 +1,75 @@
+import pytest
+
+import mhlw
+import fake_sheets
+
+
+@pytest.fixture
+def fake():
+    fake = fake_sheets.FakeSpreadsheet(patientRows=10, days=5)
+    fake_sheets.install(fake)
+    return fake
+
+
+def prefectureValues(count):
+    return {
+        'prefectureCasesRecoveries': [('P%d' % i, str(i), str(i * 2)) for i in range(count)],
+        'portRecoveries': 5,
+    }
+
+
+@pytest.mark.parametrize('count', [46, 48])
+def test_check_prefecture_values_requires_47(count):
+    with pytest.raises(ValueError):
+        mhlw.checkPrefectureValues(prefectureValues(count))
+
+
+def test_update_changed_writes_changed_runs(fake):
+    plan = mhlw.SheetWritePlan(fake)
+    plan.read([mhlw.PREFECTURE_RECOVERIES_RANGE])
+    values = [[10]] * 48
+    values[3] = [11]
+    values[4] = [12]
+    plan.updateChanged(mhlw.PREFECTURE_RECOVERIES_RANGE, values)
+    assert [d['range'] for d in plan.data] == ["'Prefecture Data'!E6:E7"]
+
+
+def test_update_changed_rejects_values_outside_range(fake):
+    plan = mhlw.SheetWritePlan(fake)
+    plan.read([mhlw.PREFECTURE_RECOVERIES_RANGE])
+    with pytest.raises(ValueError):
+        plan.updateChanged(mhlw.PREFECTURE_RECOVERIES_RANGE, [[1]] * 49)
+    assert plan.data == []
+
+
+def dailyValues(recoveries):
+    values = prefectureValues(47)
+    values.update({'recoveries': recoveries, 'deaths': 50, 'critical': 5, 'pcr': 5000})
+    return values
+
+
+def test_write_values_counts_every_call_and_keeps_grid_cached(fake):
+    result = mhlw.writeValues('2020-05-01', dailyValues(500))
+    assert result['apiCalls'] == fake.totalCalls() == 4
+
+    # The next day needs another row and column, from the cached grid sizes.
+    fake.resetCallCounts()
+    result = mhlw.writeValues('2020-05-02', dailyValues(600))
+    assert result['apiCalls'] == fake.totalCalls() == 3
+    assert fake.callCounts.get('get', 0) == 0
+    sumByDay = fake.readRange(mhlw.SUM_BY_DAY_RANGE)['values']
+    assert [row[0] for row in sumByDay[-2:]] == ['2020-05-01', '2020-05-02']
+    assert fake.readRange("'Recoveries'!C1:D1")['values'] == [['2020-05-02', '2020-05-01']]
+
+
+@pytest.mark.parametrize('prefectures', [[], [('P1', '1', '2')]])
+def test_write_values_without_prefecture_values_writes_sum_by_day(fake, prefectures):
+    values = dailyValues(500)
+    values['prefectureCasesRecoveries'] = prefectures
+    recoveries = fake.readRange("'Recoveries'!A1:H50")
+
+    result = mhlw.writeValues('2020-05-01', values)
+    assert result['skipped'] == ['Prefecture Data', 'Recoveries']
+    assert fake.readRange(mhlw.SUM_BY_DAY_RANGE)['values'][-1][:6] == [
+        '2020-05-01', '', '500', '50', '5', '5000']
+    assert fake.readRange("'Recoveries'!A1:H50") == recoveries
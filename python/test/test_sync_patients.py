@@ -0,0 +1,93 @@
+import pytest
+
+import sync_patients
+import fake_sheets
+
+
+@pytest.fixture
+def fake():
+    fake = fake_sheets.FakeSpreadsheet(patientRows=10, days=5)
+    fake_sheets.install(fake)
+    return fake
+
+
+def addCountRow(fake, date, count, prefecture='Tokyo'):
+    fake.appendRows("'%s'!A:N" % prefecture, [['TOK1', '', '', date, date, '', '', '', '', prefecture, '', count, '', '']],
+                    'INSERT_ROWS', False)
+
+
+def patientRows(fake, title='Tokyo'):
+    return fake.readRange("'%s'!A1:N" % title).get('values', [])
+
+
+def countRows(fake, prefecture, date, title='Tokyo'):
+    return [row[sync_patients.COUNT_COL] for row in patientRows(fake, title)
+            if row[sync_patients.DATE_COL] == date and row[sync_patients.PREFECTURE_COL] == prefecture
+            and row[sync_patients.STATUS_COL] == '']
+
+
+def test_batch_updates_existing_rows_and_appends_new_ones(fake):
+    date, count = '2020-05-03', 5
+    addCountRow(fake, date, count)
+
+    results = sync_patients.writePatientsBatch([
+        {'prefecture': 'Tokyo', 'date': date, 'cases': count + 3, 'source': 'a'},
+        {'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 4, 'source': 'b'},
+        {'prefecture': 'Osaka', 'date': '2020-05-02', 'deceased': 2, 'source': 'c'},
+    ])
+    assert [result['status'] for result in results] == ['updated', 'appended', 'appended']
+    assert countRows(fake, 'Tokyo', date) == [str(count + 3)]
+    assert countRows(fake, 'Tokyo', '2020-05-02') == ['4']
+    assert patientRows(fake, 'Osaka')[-1][9:12] == ['Osaka', 'Deceased', '2']
+
+    results = sync_patients.writePatientsBatch([{'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 4}])
+    assert results[0]['status'] == 'unchanged'
+
+
+def test_batch_last_repeated_entry_wins(fake):
+    date, count = '2020-05-03', 5
+    addCountRow(fake, date, count)
+
+    results = sync_patients.writePatientsBatch([
+        {'prefecture': 'Tokyo', 'date': date, 'cases': count + 2},
+        {'prefecture': 'Tokyo', 'date': date, 'cases': count},
+        {'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 4},
+        {'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 6},
+    ])
+    assert [result['status'] for result in results] == ['superseded', 'unchanged', 'superseded', 'appended']
+    assert countRows(fake, 'Tokyo', date) == [str(count)]
+    assert countRows(fake, 'Tokyo', '2020-05-02') == ['6']
+
+
+def test_batch_reports_invalid_entries(fake):
+    rows = patientRows(fake)
+    results = sync_patients.writePatientsBatch([
+        {'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 'three'},
+        {'prefecture': 'Nowhere', 'date': '2020-05-02', 'cases': 1},
+        {'prefecture': 'Tokyo', 'date': '2020-05-02'},
+    ])
+    assert all(['error' in result for result in results])
+    assert patientRows(fake) == rows
+
+
+def test_row_index_picks_up_appended_rows(fake):
+    index = sync_patients.getPatientRowIndex('Tokyo')
+    index.refresh(fake)
+    addCountRow(fake, '2020-05-03', 8)
+    index.refresh(fake)
+    assert index.find('Tokyo', '2020-05-03', 0) == [index.lastRow, 8]
+
+
+def test_update_after_rows_were_inserted_above(fake):
+    addCountRow(fake, '2020-05-03', 5)
+    sync_patients.writePatients('Tokyo', '2020-05-03', 6, 0, 'source')
+
+    # Someone inserts a row by hand above the ones the index knows about.
+    sheetId = fake.tabs['Tokyo'].sheetId
+    fake.batchUpdate('id', {'requests': [{'insertDimension': {'range': {
+        'sheetId': sheetId, 'dimension': 'ROWS', 'startIndex': 1, 'endIndex': 2}}}]}).execute()
+    fake.writeRange("'Tokyo'!A2", [['TOK0', '', '', '2020-04-01', '2020-04-01', '', '', '', '', 'Tokyo', '', 1, '', '']])
+
+    sync_patients.writePatients('Tokyo', '2020-05-03', 7, 0, 'source')
+    assert countRows(fake, 'Tokyo', '2020-05-03') == ['7']
+    assert countRows(fake, 'Tokyo', '2020-04-01') == ['1']
@@ -0,0 +1,66 @@
+import os
+import shutil
+
+import pytest
+
+import ocr
+import mhlw
+import table_layout
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The first text line of each value in the summary table fixtures.
+EXPECTED = {
+    'mhlw.png': {
+        'boxes': {'pcr': (81, 145, 148, 161), 'critical': (345, 145, 370, 160),
+                  'recoveries': (428, 145, 478, 161), 'portRecoveries': (435, 88, 470, 104),
+                  'deaths': (522, 145, 564, 161)},
+        'values': {'pcr': 11702186, 'critical': 951, 'recoveries': 515560, 'portRecoveries': 2562,
+                   'deaths': 10107},
+    },
+    '000780658.png': {
+        'boxes': {'pcr': (81, 145, 147, 161), 'critical': (341, 145, 376, 161),
+                  'recoveries': (428, 145, 478, 161), 'portRecoveries': (435, 88, 471, 104),
+                  'deaths': (522, 145, 563, 161)},
+        'values': {'pcr': 13220299, 'critical': 1235, 'recoveries': 602356, 'portRecoveries': 2723,
+                   'deaths': 11591},
+    },
+}
+
+
+def loadImage(name):
+    return mhlw.loadSummaryImage(os.path.join(FIXTURE_DIR, name))
+
+
+def seeds():
+    rects = mhlw.imageAreaRects()
+    return dict([(key, ((rects[key][0][0] + rects[key][0][2]) // 2,
+                        (rects[key][0][1] + rects[key][0][3]) // 2)) for key in rects])
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_cells_are_cropped_to_their_first_text_line(name):
+    pytest.importorskip('cv2')
+    image = loadImage(name)
+    boxes = table_layout.locateCells(image, seeds())
+    assert boxes == EXPECTED[name]['boxes']
+    # Cached cell boxes give the same text lines.
+    assert table_layout.locateCells(image, seeds()) == boxes
+
+    for key, crops in mhlw.locateImageAreas(image).items():
+        assert len(crops) == 1, key
+        crop = crops[0]
+        pixels = list(crop.tobytes())
+        width = crop.size[0]
+        edges = pixels[:width] + pixels[-width:] + pixels[::width] + pixels[width - 1::width]
+        # No ruling lines or neighbouring text at the edges of the crop.
+        assert min(edges) > table_layout.INK_THRESHOLD, key
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_summary_values_are_read(name):
+    if not shutil.which('tesseract'):
+        pytest.skip('tesseract is not installed')
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        values = mhlw.readDailySummary(f.read(), False, engine=ocr.getEngine())
+    assert values == EXPECTED[name]['values']
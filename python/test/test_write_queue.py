@@ -0,0 +1,83 @@
+import json
+import time
+import threading
+import collections
+
+import pytest
+
+import main
+import sync_patients
+import write_queue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    written = collections.Counter()
+
+    def writePatientsBatch(entries):
+        time.sleep(0.2)
+        for entry in entries:
+            written[(entry['prefecture'], entry['date'])] += 1
+        return [{'updateRows': 1} for entry in entries]
+
+    monkeypatch.setattr(sync_patients, 'writePatientsBatch', writePatientsBatch)
+    # A long window, so that only forced flushes write anything.
+    queue = write_queue.PatientWriteQueue(str(tmp_path / 'queue.sqlite3'), window=60)
+    monkeypatch.setattr(write_queue, '_queue', queue)
+    queue.written = written
+    return queue
+
+
+def test_concurrent_flushes_write_each_update_once(queue):
+    for prefecture in ('Tokyo', 'Osaka', 'Aichi'):
+        queue.enqueue(prefecture, '2020-05-01', 3, None, 'source')
+
+    counts = []
+    threads = [threading.Thread(target=lambda: counts.append(queue.flush(force=True))) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(counts) == [0, 3]
+    assert set(queue.written.values()) == {1}
+    assert queue.status()['depth'] == 0
+
+
+def test_async_batch_reports_queued_and_invalid_entries(queue):
+    client = main.app.test_client()
+    response = client.post('/patients/batch?async=1', json=[
+        {'prefecture': 'Tokyo', 'date': '2020-05-01', 'cases': 3},
+        {'prefecture': 'Tokyo', 'date': '2020-05-02', 'cases': 'three'},
+        {'prefecture': 'Nowhere', 'date': '2020-05-01', 'cases': 1},
+    ])
+    result = json.loads(response.data)
+    assert result['queued'] == 1
+    assert [i['index'] for i in result['invalid']] == [1, 2]
+    assert queue.status()['depth'] == 1
+
+
+def test_update_rejects_invalid_entries_before_queueing(queue):
+    client = main.app.test_client()
+    result = json.loads(client.get('/patients/update?prefecture=Nowhere&date=2020-05-01&cases=3&async=1').data)
+    assert result['error'] == 'Unknown prefecture: Nowhere'
+    result = json.loads(client.get('/patients/update?prefecture=Tokyo&date=2020-05-01&cases=x&async=1').data)
+    assert result['error'] == 'Invalid cases: x'
+    assert queue.status()['depth'] == 0
+
+    result = json.loads(client.get('/patients/update?prefecture=Tokyo&date=2020-05-01&cases=3&async=1').data)
+    assert result['queued'] is True
+
+
+def test_flush_does_not_retry_invalid_entries(queue):
+    # Journaled before validation, e.g. by an older version.
+    queue.enqueue('Nowhere', '2020-05-01', 3, None, 'source')
+    queue.enqueue('Tokyo', '2020-05-01', 3, None, 'source')
+    assert queue.flush(force=True) == 1
+    assert queue.flush(force=True) == 0
+
+    status = queue.status()
+    assert status['depth'] == 0
+    assert status['failed'] == [{'key': 'Patient Data|2020-05-01|Nowhere|',
+                                 'attempts': queue.maxAttempts, 'error': 'Unknown prefecture: Nowhere'}]
+    assert list(queue.written) == [('Tokyo', '2020-05-01')]
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Lightweight spans for timing the stages of a request, exported as Prometheus
+metrics.
+
+  with tracing.span('report.page'):
+      reportSoup = getReportFromUrl(reportUrl)
+
+Every finished span is observed into the covid19japan_span_seconds histogram
+(labelled by span name) and added to the trace active on the calling thread,
+if there is one. A trace gives the per-request breakdown that the routes return
+as 'timings'.
+
+Traces are per thread. Use wrap() for work handed to a thread pool, and
+runTraced() for work sent to a process pool: it collects the spans in the
+worker and returns them, and record() adds them to the caller's trace and
+metrics.
+
+traceSpreadsheet() wraps a spreadsheets() resource so that every execute() is
+a 'sheets.<method>' span and counted in covid19japan_sheets_api_calls_total.
+Functions added with addSheetsListener() are called with the method, parameters
+and response of every request.
+"""
+
+import time
+import threading
+import collections
+
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_local = threading.local()
+
+_metricsLock = threading.Lock()
+# Span name to [bucket counts, sum, count].
+_spanHistograms = {}
+_spanErrors = collections.Counter()
+_sheetsCalls = collections.Counter()
+_sheetsListeners = []
+
+
+class Trace(object):
+    """
+    Spans finished while the trace is active. A deferred trace does not
+    observe its spans into the metrics, they are expected to be passed to
+    record() in the process that owns the metrics.
+    """
+
+    def __init__(self, deferred=False):
+        self.deferred = deferred
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, name, seconds, error=False):
+        with self.lock:
+            self.spans.append((name, seconds, error))
+
+    def breakdown(self):
+        """
+        @returns dict of span name to total seconds, in the order the spans
+            first finished.
+        """
+        totals = collections.OrderedDict()
+        with self.lock:
+            for name, seconds, error in self.spans:
+                totals[name] = totals.get(name, 0) + seconds
+        return collections.OrderedDict([(name, round(totals[name], 4)) for name in totals])
+
+
+def currentTrace():
+    return getattr(_local, 'trace', None)
+
+
+def activate(trace):
+    """
+    Makes trace (or None) the active trace of the calling thread.
+
+    @returns the previously active trace, to pass to activate() when done.
+    """
+    previous = currentTrace()
+    _local.trace = trace
+    return previous
+
+
+class span(object):
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.seconds = time.perf_counter() - self.start
+        finish(self.name, self.seconds, excType is not None)
+        return False
+
+
+def finish(name, seconds, error=False):
+    trace = currentTrace()
+    if trace:
+        trace.add(name, seconds, error)
+    if not (trace and trace.deferred):
+        observe(name, seconds, error)
+
+
+def observe(name, seconds, error=False):
+    with _metricsLock:
+        histogram = _spanHistograms.get(name)
+        if histogram is None:
+            histogram = _spanHistograms[name] = [[0] * len(SPAN_BUCKETS), 0.0, 0]
+        for i in range(len(SPAN_BUCKETS)):
+            if seconds <= SPAN_BUCKETS[i]:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+        if error:
+            _spanErrors[name] += 1
+
+
+def record(spans):
+    """
+    Adds spans returned by runTraced() to the current trace and the metrics.
+    """
+    for name, seconds, error in spans:
+        finish(name, seconds, error)
+
+
+def wrap(fn):
+    """
+    Returns fn bound to the calling thread's trace, for running on another thread.
+    """
+    trace = currentTrace()
+
+    def run(*args, **kwargs):
+        previous = activate(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            activate(previous)
+    return run
+
+
+def timed(name, fn, *args):
+    """
+    @returns (fn(*args), seconds) and records the call as a span.
+    """
+    with span(name) as timing:
+        result = fn(*args)
+    return (result, timing.seconds)
+
+
+def runTraced(name, fn, *args):
+    """
+    Runs fn(*args) as a span in a worker, collecting the spans it finishes.
+
+    @returns (result, seconds, spans) where spans are for record().
+    """
+    trace = Trace(deferred=True)
+    previous = activate(trace)
+    try:
+        result, seconds = timed(name, fn, *args)
+    finally:
+        activate(previous)
+    return (result, seconds, trace.spans)
+
+
+def addSheetsListener(listener):
+    """
+    Calls listener(method, params, response) after every traced request.
+    """
+    with _metricsLock:
+        _sheetsListeners.append(listener)
+
+
+def removeSheetsListener(listener):
+    with _metricsLock:
+        _sheetsListeners.remove(listener)
+
+
+class TracedRequest(object):
+    def __init__(self, request, method, params=None):
+        self.request = request
+        self.method = method
+        self.params = params or {}
+
+    def execute(self, *args, **kwargs):
+        with _metricsLock:
+            _sheetsCalls[self.method] += 1
+            listeners = list(_sheetsListeners)
+        with span('sheets.%s' % self.method):
+            response = self.request.execute(*args, **kwargs)
+        for listener in listeners:
+            listener(self.method, self.params, response)
+        return response
+
+
+class TracedResource(object):
+    """
+    Proxies a googleapiclient resource, wrapping the requests it builds.
+    """
+
+    def __init__(self, resource, prefix=''):
+        self.resource = resource
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self.resource, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return TracedRequest(result, self.prefix + name, kwargs)
+            return TracedResource(result, '%s%s.' % (self.prefix, name))
+        return call
+
+
+def traceSpreadsheet(sheet):
+    return TracedResource(sheet)
+
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def renderMetrics():
+    """
+    @returns the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _metricsLock:
+        lines.append('# HELP covid19japan_span_seconds Duration of traced stages.')
+        lines.append('# TYPE covid19japan_span_seconds histogram')
+        for name in sorted(_spanHistograms):
+            buckets, total, count = _spanHistograms[name]
+            label = escapeLabel(name)
+            for i in range(len(SPAN_BUCKETS)):
+                lines.append('covid19japan_span_seconds_bucket{span="%s",le="%s"} %d' % (
+                    label, SPAN_BUCKETS[i], buckets[i]))
+            lines.append('covid19japan_span_seconds_bucket{span="%s",le="+Inf"} %d' % (label, count))
+            lines.append('covid19japan_span_seconds_sum{span="%s"} %f' % (label, total))
+            lines.append('covid19japan_span_seconds_count{span="%s"} %d' % (label, count))
+
+        lines.append('# HELP covid19japan_span_errors_total Traced stages that raised an exception.')
+        lines.append('# TYPE covid19japan_span_errors_total counter')
+        for name in sorted(_spanErrors):
+            lines.append('covid19japan_span_errors_total{span="%s"} %d' % (escapeLabel(name), _spanErrors[name]))
+
+        lines.append('# HELP covid19japan_sheets_api_calls_total Google Sheets API requests by method.')
+        lines.append('# TYPE covid19japan_sheets_api_calls_total counter')
+        for method in sorted(_sheetsCalls):
+            lines.append('covid19japan_sheets_api_calls_total{method="%s"} %d' % (
+                escapeLabel(method), _sheetsCalls[method]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Write-behind queue for patient count updates.
+
+Updates are journaled to a local SQLite file and acknowledged straight away.
+Updates for the same (tab, date, prefecture, status) are merged while they wait,
+the last value wins. A flusher thread writes entries that have waited at least
+PATIENT_QUEUE_WINDOW seconds with sync_patients.writePatientsBatch, retrying
+failures with backoff up to PATIENT_QUEUE_MAX_ATTEMPTS times. Entries that fail
+sync_patients.validateEntry are not retried.
+
+Only one flush runs at a time per queue, so the flusher thread and a forced
+flush from /patients/queue never write the same entries twice.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import contextlib
+import traceback
+
+import sync_patients
+
+PATIENT_QUEUE_PATH = os.environ.get('PATIENT_QUEUE_PATH', './patient_queue.sqlite3')
+PATIENT_QUEUE_WINDOW = float(os.environ.get('PATIENT_QUEUE_WINDOW', 5))
+PATIENT_QUEUE_MAX_ATTEMPTS = int(os.environ.get('PATIENT_QUEUE_MAX_ATTEMPTS', 5))
+PATIENT_QUEUE_BATCH_SIZE = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS updates (
+  key TEXT PRIMARY KEY,
+  prefecture TEXT NOT NULL,
+  date TEXT NOT NULL,
+  cases INTEGER,
+  deceased INTEGER,
+  source TEXT,
+  received REAL NOT NULL,
+  updated REAL NOT NULL,
+  nextAttempt REAL NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  lastError TEXT
+)
+'''
+
+
+def updateKey(prefecture, date, deceased):
+    status = 'Deceased' if deceased else ''
+    return '|'.join([sync_patients.getTabForPrefecture(prefecture), date, prefecture, status])
+
+
+class PatientWriteQueue(object):
+    def __init__(self, path=PATIENT_QUEUE_PATH, window=PATIENT_QUEUE_WINDOW,
+                 maxAttempts=PATIENT_QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.window = window
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        # Held by flush() from reading the due updates until they are deleted.
+        self.flushLock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.lastFlush = None
+        self.lastFlushSeconds = None
+        self.lastFlushCount = 0
+        with self.transaction() as db:
+            db.execute(SCHEMA)
+        self.flusher = threading.Thread(target=self.flushLoop, name='patient-write-queue', daemon=True)
+        self.flusher.start()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Yields a connection that commits (or rolls back) and is closed at the
+        end of the with block.
+        """
+        with contextlib.closing(self.connect()) as db:
+            with db:
+                yield db
+
+    def enqueue(self, prefecture, date, cases, deceased, source):
+        """
+        Journals an update, replacing any waiting update for the same row.
+        """
+        now = time.time()
+        with self.lock, self.transaction() as db:
+            db.execute('''
+                INSERT INTO updates (key, prefecture, date, cases, deceased, source, received, updated, nextAttempt)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                  cases = excluded.cases, deceased = excluded.deceased, source = excluded.source,
+                  updated = excluded.updated, attempts = 0, lastError = NULL,
+                  nextAttempt = MIN(updates.nextAttempt, excluded.nextAttempt)
+                ''', (updateKey(prefecture, date, deceased), prefecture, date, cases, deceased,
+                      source, now, now, now + self.window))
+        self.wakeup.set()
+
+    def flush(self, force=False):
+        """
+        Writes the updates that are due (or all of them if force is set).
+        Waits for a flush that is already running to finish first.
+
+        @returns number of updates written.
+        """
+        with self.flushLock:
+            return self.flushLocked(force)
+
+    def flushLocked(self, force):
+        start = time.time()
+        with self.lock, self.transaction() as db:
+            rows = db.execute('''
+                SELECT key, prefecture, date, cases, deceased, source, updated, attempts FROM updates
+                WHERE attempts < ? AND (nextAttempt <= ? OR ?)
+                ORDER BY received LIMIT ?
+                ''', (self.maxAttempts, start, force, PATIENT_QUEUE_BATCH_SIZE)).fetchall()
+        if not rows:
+            return 0
+
+        entries = [{'prefecture': r[1], 'date': r[2], 'cases': r[3], 'deceased': r[4], 'source': r[5]}
+                   for r in rows]
+        # Invalid entries would fail the same way on every attempt.
+        results = []
+        for entry in entries:
+            error = sync_patients.validateEntry(entry)
+            results.append({'error': error, 'permanent': True} if error else None)
+        valid = [i for i in range(len(entries)) if results[i] is None]
+        try:
+            batchResults = sync_patients.writePatientsBatch([entries[i] for i in valid]) if valid else []
+        except Exception as e:
+            traceback.print_exc()
+            batchResults = [{'error': str(e)}] * len(valid)
+        for i, result in zip(valid, batchResults):
+            results[i] = result
+
+        written = 0
+        now = time.time()
+        with self.lock, self.transaction() as db:
+            for row, result in zip(rows, results):
+                key, updated, attempts = row[0], row[6], row[7]
+                if 'error' not in result:
+                    # Keep the entry if a newer value arrived while we were writing.
+                    db.execute('DELETE FROM updates WHERE key = ? AND updated = ?', (key, updated))
+                    written += 1
+                else:
+                    print('Failed to write %s: %s' % (key, result['error']))
+                    backoff = self.window * (2 ** attempts)
+                    attempts = self.maxAttempts if result.get('permanent') else attempts + 1
+                    db.execute('''
+                        UPDATE updates SET attempts = ?, lastError = ?, nextAttempt = ?
+                        WHERE key = ? AND updated = ?
+                        ''', (attempts, result['error'], now + backoff, key, updated))
+
+        self.lastFlush = now
+        self.lastFlushSeconds = now - start
+        self.lastFlushCount = written
+        return written
+
+    def flushLoop(self):
+        while True:
+            try:
+                while self.flush():
+                    pass
+            except Exception:
+                traceback.print_exc()
+            self.wakeup.wait(self.window)
+            self.wakeup.clear()
+
+    def status(self):
+        now = time.time()
+        with self.lock, self.transaction() as db:
+            depth, oldest = db.execute(
+                'SELECT COUNT(*), MIN(received) FROM updates WHERE attempts < ?',
+                (self.maxAttempts,)).fetchone()
+            failed = db.execute(
+                'SELECT key, attempts, lastError FROM updates WHERE attempts >= ?',
+                (self.maxAttempts,)).fetchall()
+        return {
+            'depth': depth,
+            'flushLagSeconds': now - oldest if oldest else 0,
+            'failed': [{'key': f[0], 'attempts': f[1], 'error': f[2]} for f in failed],
+            'lastFlush': self.lastFlush,
+            'lastFlushSeconds': self.lastFlushSeconds,
+            'lastFlushCount': self.lastFlushCount,
+        }
+
+
+_queue = None
+_queueLock = threading.Lock()
+
+
+def getWriteQueue():
+    global _queue
+    with _queueLock:
+        if _queue is None:
+            _queue = PatientWriteQueue()
+        return _queue